@@ -0,0 +1,126 @@
+import asyncio
+import time
+from concurrent.futures import Executor
+from typing import Any, Callable, List, Optional
+
+
+class MicroBatcher:
+    """
+    Collects concurrent submissions into batches and runs `batch_fn` once per batch.
+
+    A batch is closed as soon as it holds `max_batch_size` items or `max_wait_ms`
+    has passed since its first item arrived, whichever comes first, so the extra
+    latency a request pays for batching is bounded by `max_wait_ms`.
+
+    `batch_fn` is a blocking callable taking a list of items and returning a list
+    of results in the same order. A result that is an `Exception` instance is
+    raised to that caller only; an exception raised by `batch_fn` itself fails
+    the whole batch.
+
+    Up to `concurrency` batches are in flight at once, each running on the
+    executor passed to `start` (the loop's default executor if none).
+
+    `on_batch(name, batch_size, seconds)`, if given, is called after every batch.
+    """
+
+    def __init__(
+        self,
+        batch_fn: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        name: str = "batcher",
+        concurrency: int = 1,
+        on_batch: Optional[Callable[[str, int, float], None]] = None,
+    ):
+        assert max_batch_size >= 1, max_batch_size
+        assert concurrency >= 1, concurrency
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_ms / 1000.0
+        self.name = name
+        self.concurrency = concurrency
+        self.on_batch = on_batch
+        self.executor: Optional[Executor] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+
+    async def start(self, executor: Optional[Executor] = None):
+        if self._workers:
+            return
+        self.executor = executor
+        self._queue = asyncio.Queue()
+        self._workers = [
+            asyncio.create_task(self._run(), name=f"{self.name}-{k}") for k in range(self.concurrency)
+        ]
+
+    async def stop(self):
+        if not self._workers:
+            return
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        # Fail whatever is still waiting so no caller hangs on shutdown
+        while not self._queue.empty():
+            _, fut = self._queue.get_nowait()
+            if not fut.done():
+                fut.set_exception(RuntimeError(f"{self.name} stopped"))
+
+    async def submit(self, item: Any) -> Any:
+        if not self._workers:
+            raise RuntimeError(f"{self.name} is not running")
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, fut))
+        return await fut
+
+    def qsize(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _collect(self) -> list:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_wait_s
+        while len(batch) < self.max_batch_size:
+            # Whatever is already queued joins the batch without waiting
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            # Callers that gave up (client disconnect, timeout) don't need to be computed
+            batch = [(item, fut) for item, fut in batch if not fut.done()]
+            if not batch:
+                continue
+            items = [item for item, _ in batch]
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self.executor, self.batch_fn, items)
+            except asyncio.CancelledError:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(RuntimeError(f"{self.name} stopped"))
+                raise
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            if self.on_batch is not None:
+                self.on_batch(self.name, len(items), time.perf_counter() - start)
+            for (_, fut), res in zip(batch, results):
+                if fut.done():
+                    continue
+                if isinstance(res, Exception):
+                    fut.set_exception(res)
+                else:
+                    fut.set_result(res)
@@ -0,0 +1,107 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any, Hashable, Optional
+
+import numpy as np
+
+
+def image_key(img_bytes: bytes) -> str:
+    """Content address of an upload: identical files share cache entries whatever their name."""
+    return hashlib.sha256(img_bytes).hexdigest()
+
+
+def estimate_nbytes(obj: Any) -> int:
+    """Rough memory footprint of a cached value (arrays, tensors, Instances and containers of them)."""
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if hasattr(obj, "element_size") and hasattr(obj, "numel"):  # torch.Tensor
+        return obj.element_size() * obj.numel()
+    if hasattr(obj, "get_fields"):  # detectron2 Instances
+        return estimate_nbytes(obj.get_fields())
+    if hasattr(obj, "tensor"):  # detectron2 Boxes / ROIMasks
+        return estimate_nbytes(obj.tensor)
+    if isinstance(obj, dict):
+        return sum(estimate_nbytes(v) for v in obj.values())
+    if hasattr(obj, "__dataclass_fields__"):
+        return sum(estimate_nbytes(getattr(obj, name)) for name in obj.__dataclass_fields__)
+    if isinstance(obj, (list, tuple)):
+        return 8 * len(obj) + sum(estimate_nbytes(v) for v in obj)
+    return 8
+
+
+class DetectionCache:
+    """
+    Thread-safe LRU cache with a per-entry TTL and a total memory budget.
+
+    Keys are tuples whose first element names the kind of value stored
+    (e.g. ``("person", image_key)``); hits and misses are counted per kind.
+    An entry larger than the whole budget is not stored.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_s: float = 600.0, max_bytes: int = 256 * 1024 ** 2):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (value, nbytes, expires_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.max_bytes > 0
+
+    def get(self, key: tuple) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses[key[0]] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits[key[0]] += 1
+            return entry[0]
+
+    def put(self, key: tuple, value: Any, nbytes: Optional[int] = None):
+        if not self.enabled:
+            return
+        if nbytes is None:
+            nbytes = estimate_nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, nbytes, time.monotonic() + self.ttl_s)
+            self._bytes += nbytes
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        _, nbytes, _ = self._entries.pop(key)
+        self._bytes -= nbytes
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": dict(self.hits),
+                "misses": dict(self.misses),
+                "evictions": self.evictions,
+            }
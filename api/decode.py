@@ -0,0 +1,164 @@
+import io
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# --- OPTIONAL: libjpeg-turbo for region-of-interest decode ---
+try:
+    import turbojpeg
+    _TURBOJPEG = turbojpeg.TurboJPEG()
+except Exception:  # module or native library missing
+    _TURBOJPEG = None
+
+EXIF_ORIENTATION = 0x0112
+# EXIF orientations that rotate by 90°, i.e. swap width and height once applied
+TRANSPOSING_ORIENTATIONS = (5, 6, 7, 8)
+
+
+# Flags that make libjpeg scale by 1/N in the DCT domain (other codecs decode, then resize)
+REDUCED_DECODE_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+class InvalidImageError(ValueError):
+    pass
+
+
+@dataclass
+class DetectionFrame:
+    """An image handed to a detector, possibly smaller than the upload it was decoded from."""
+    image: np.ndarray
+    scale_x: float = 1.0  # full-resolution pixels per pixel of `image`
+    scale_y: float = 1.0
+    offset_x: int = 0  # where `image` starts in the decoded frame, for a tile of it
+    offset_y: int = 0
+
+    def to_full_res(self, xyxy: np.ndarray) -> np.ndarray:
+        xyxy = np.asarray(xyxy, dtype=np.float64) + [self.offset_x, self.offset_y, self.offset_x, self.offset_y]
+        return (xyxy * [self.scale_x, self.scale_y, self.scale_x, self.scale_y]).astype(int)
+
+
+def decode_image(img_bytes: bytes) -> np.ndarray:
+    nparr = np.frombuffer(img_bytes, np.uint8)
+    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    if img is None:
+        raise InvalidImageError("Invalid image data.")
+    return img
+
+
+def reduced_decode_factor(shape: tuple, min_side: int) -> int:
+    """Largest 1/N reduction that keeps the long side of `shape` at least `min_side` pixels."""
+    for factor in (8, 4, 2):
+        if max(shape[:2]) / factor >= min_side:
+            return factor
+    return 1
+
+
+def decode_for_detection(img_bytes: bytes, full_shape: tuple, factor: int) -> DetectionFrame:
+    """Decode at 1/factor resolution; the frame maps boxes back to `full_shape` coordinates."""
+    if factor == 1:
+        return DetectionFrame(decode_image(img_bytes))
+    img = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), REDUCED_DECODE_FLAGS[factor])
+    if img is None:
+        raise InvalidImageError("Invalid image data.")
+    return DetectionFrame(img, full_shape[1] / img.shape[1], full_shape[0] / img.shape[0])
+
+
+def region_decodable(img_bytes: bytes) -> bool:
+    """Whether `decode_region` can avoid decoding the full frame for this upload."""
+    if _TURBOJPEG is None:
+        return False
+    fmt, _, _, orientation = _header(img_bytes)
+    return fmt == "JPEG" and orientation == 1
+
+
+class _BufferReader(io.RawIOBase):
+    """Seekable read-only file over a bytes-like object; io.BytesIO copies anything but bytes."""
+
+    def __init__(self, buf):
+        self._view = memoryview(buf).cast("B")
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = max(0, min(len(b), len(self._view) - self._pos))
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._view)}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def close(self):
+        self._view.release()
+        super().close()
+
+
+def _header(img_bytes: bytes) -> Tuple[str, int, int, int]:
+    # Uploads come in as a bytearray (api/upload.py), which must not be copied to read the header
+    f = io.BytesIO(img_bytes) if isinstance(img_bytes, bytes) else _BufferReader(img_bytes)
+    try:
+        with f, Image.open(f) as im:
+            return im.format, im.width, im.height, im.getexif().get(EXIF_ORIENTATION, 1)
+    except Exception:
+        raise InvalidImageError("Invalid image data.")
+
+
+def probe_shape(img_bytes: bytes) -> tuple:
+    """
+    (H, W, 3) of the image `decode_image` would return, read from the file header only.
+    OpenCV applies the EXIF orientation, so the header size is transposed for rotated photos.
+    """
+    _, w, h, orientation = _header(img_bytes)
+    if orientation in TRANSPOSING_ORIENTATIONS:
+        w, h = h, w
+    return (h, w, 3)
+
+
+def decode_region(img_bytes: bytes, box: Tuple[int, int, int, int]) -> np.ndarray:
+    """
+    Decode only the (x1, y1, x2, y2) region of an upload, as a contiguous BGR array.
+
+    Upright JPEGs are cut losslessly to the region (widened to whole MCUs) with
+    libjpeg-turbo before decoding, when it is installed. Every other case decodes
+    the full frame and slices it.
+    """
+    x1, y1, x2, y2 = box
+    if region_decodable(img_bytes):
+        region = _decode_jpeg_region(img_bytes, box)
+        if region is not None:
+            return region
+    return np.ascontiguousarray(decode_image(img_bytes)[y1:y2, x1:x2])
+
+
+def _decode_jpeg_region(img_bytes: bytes, box: Tuple[int, int, int, int]) -> Optional[np.ndarray]:
+    x1, y1, x2, y2 = box
+    try:
+        _, _, subsample, _ = _TURBOJPEG.decode_header(img_bytes)
+        # The lossless crop must start on an MCU boundary
+        ax = x1 - x1 % turbojpeg.tjMCUWidth[subsample]
+        ay = y1 - y1 % turbojpeg.tjMCUHeight[subsample]
+        cropped = _TURBOJPEG.crop(img_bytes, ax, ay, x2 - ax, y2 - ay)
+        region = _TURBOJPEG.decode(cropped)
+    except Exception:
+        return None
+    region = region[y1 - ay:y2 - ay, x1 - ax:x2 - ax]
+    if region.shape[:2] != (y2 - y1, x2 - x1):
+        return None
+    return np.ascontiguousarray(region)
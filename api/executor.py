@@ -0,0 +1,103 @@
+import asyncio
+import math
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Optional
+
+
+class QueueFullError(Exception):
+    """Raised when the executor already holds as many requests as it is allowed to."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Inference queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class InferenceExecutor:
+    """
+    Owns the worker pool that model inference runs on, and bounds how much work
+    may wait for it.
+
+    At most `max_workers + max_queue` requests are admitted at once (running or
+    waiting); one more raises `QueueFullError` right away instead of growing the
+    backlog. Every admitted request is given `timeout_s` to finish.
+
+    `kind="thread"` shares the models loaded in the server process between
+    workers. `kind="process"` starts `max_workers` spawned processes which each
+    run `initializer(*initargs)` (i.e. load their models) once.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 1,
+        max_queue: int = 32,
+        timeout_s: float = 60.0,
+        kind: str = "thread",
+        initializer: Optional[Callable[[], None]] = None,
+    ):
+        assert kind in ("thread", "process"), kind
+        assert max_workers >= 1, max_workers
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout_s = timeout_s
+        self.kind = kind
+        self.initializer = initializer
+        self.pool: Optional[Executor] = None
+        self._pending = 0
+        # Moving average of how long one admitted request takes, used for Retry-After
+        self._avg_latency_s = 1.0
+
+    @property
+    def capacity(self) -> int:
+        return self.max_workers + self.max_queue
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def start(self, initargs: tuple = ()):
+        if self.pool is not None:
+            return
+        if self.kind == "process":
+            # spawn (not fork): a forked child would inherit CUDA and OpenMP state it can't use
+            self.pool = ProcessPoolExecutor(
+                self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=self.initializer,
+                initargs=initargs,
+            )
+        else:
+            self.pool = ThreadPoolExecutor(self.max_workers, thread_name_prefix="inference")
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def retry_after(self) -> int:
+        backlog = max(1, self._pending - self.max_workers + 1)
+        return max(1, min(60, math.ceil(self._avg_latency_s * backlog / self.max_workers)))
+
+    @contextmanager
+    def slot(self):
+        """Reserve a place in the queue, or raise `QueueFullError` if there is none."""
+        if self._pending >= self.capacity:
+            raise QueueFullError(self.retry_after())
+        self._pending += 1
+        try:
+            yield
+        finally:
+            self._pending -= 1
+
+    async def run(self, fn: Callable[..., Awaitable[Any]], *args) -> Any:
+        """
+        Admit one request and await `fn(*args)` under the per-request timeout.
+        Raises `QueueFullError` or `asyncio.TimeoutError`.
+        """
+        loop = asyncio.get_running_loop()
+        with self.slot():
+            start = loop.time()
+            result = await asyncio.wait_for(fn(*args), self.timeout_s)
+            self._avg_latency_s = 0.8 * self._avg_latency_s + 0.2 * (loop.time() - start)
+            return result
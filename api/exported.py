@@ -0,0 +1,110 @@
+import json
+import os
+from typing import List, Optional
+
+import numpy as np
+import torch
+
+from detectron2.config import instantiate
+from detectron2.data import transforms as T
+from detectron2.modeling.postprocessing import detector_postprocess
+from detectron2.structures import Instances
+
+# --- OPTIONAL: ONNX Runtime backend ---
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+METADATA_FILE = "export.json"
+ARTIFACT_FILES = {"torchscript": "model.ts", "onnx": "model.onnx"}
+
+
+class ExportedModel:
+    """
+    `model(inputs)` of an exported PercepTree, i.e. list of {"image", "height", "width"}
+    in, list of {"instances"} out, as from the eager Mask R-CNN.
+
+    The artifact maps one preprocessed CHW image to the flattened Instances at the input
+    resolution (scripts/export_perceptree.py). Rescaling the boxes and pasting the 28x28
+    masks into the crop is done here, since it depends on the output size.
+    """
+
+    def __init__(self, run, outputs_schema):
+        self.run = run
+        self.outputs_schema = outputs_schema
+
+    def __call__(self, inputs: List[dict]) -> List[dict]:
+        return self.inference(inputs)
+
+    def inference(self, inputs: List[dict], do_postprocess: bool = True) -> list:
+        """As GeneralizedRCNN.inference: without postprocessing, the Instances at the input resolution."""
+        results = []
+        for x in inputs:
+            instances = self.outputs_schema(self.run(x["image"]))[0]["instances"]
+            # The schema restores image_size as a tensor
+            results.append(Instances(tuple(int(s) for s in instances.image_size), **instances.get_fields()))
+        if not do_postprocess:
+            return results
+        return [{"instances": detector_postprocess(r, x["height"], x["width"])} for r, x in zip(results, inputs)]
+
+
+class ExportedPredictor:
+    """
+    Drop-in for the DefaultPredictor that api/main.py uses (`aug`, `input_format`, `model`,
+    `preprocess`, `postprocess`), backed by a TorchScript or ONNX artifact instead of a model built from the config.
+    """
+
+    def __init__(self, export_dir: str, backend: str, device: str = "cpu", onnx_threads: int = 0):
+        """`backend` is "torchscript" (on `device`) or "onnxruntime" (CPU)."""
+        with open(os.path.join(export_dir, METADATA_FILE)) as f:
+            meta = json.load(f)
+        self.metadata = meta
+        self.input_format = meta["input_format"]
+        self.aug = T.ResizeShortestEdge([meta["min_size_test"]] * 2, meta["max_size_test"])
+        schema = instantiate(meta["outputs_schema"])
+
+        if backend == "torchscript":
+            module = torch.jit.load(os.path.join(export_dir, ARTIFACT_FILES["torchscript"]), map_location=device)
+
+            def run(image: torch.Tensor) -> tuple:
+                return module(image.to(device))
+
+        elif backend == "onnxruntime":
+            if onnxruntime is None:
+                raise ImportError("PERCEPTREE_BACKEND=onnxruntime needs the onnxruntime package.")
+            options = onnxruntime.SessionOptions()
+            if onnx_threads > 0:
+                options.intra_op_num_threads = onnx_threads
+            session = onnxruntime.InferenceSession(
+                os.path.join(export_dir, ARTIFACT_FILES["onnx"]), options, providers=["CPUExecutionProvider"]
+            )
+            input_name = session.get_inputs()[0].name
+
+            def run(image: torch.Tensor) -> tuple:
+                outputs = session.run(None, {input_name: image.cpu().numpy().astype(np.float32)})
+                return tuple(torch.from_numpy(o) for o in outputs)
+
+        else:
+            raise ValueError(f"Unknown exported model backend: {backend}")
+        self.model = ExportedModel(run, schema)
+
+    def __call__(self, original_image: np.ndarray) -> dict:
+        with torch.no_grad():
+            return self.postprocess(self.model([self.preprocess(original_image)])[0])
+
+    def preprocess(self, original_image: np.ndarray, transform: Optional[T.Transform] = None) -> dict:
+        """As DefaultPredictor.preprocess on the host."""
+        if transform is None:
+            transform = self.aug.get_transform(original_image)
+        if self.input_format == "RGB":
+            original_image = original_image[:, :, ::-1]
+        height, width = original_image.shape[:2]
+        image = transform.apply_image(original_image)
+        image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+        return {"image": image, "height": height, "width": width}
+
+    def postprocess(self, predictions: dict) -> dict:
+        # Exported models always run in fp32
+        return predictions
+
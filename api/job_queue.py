@@ -0,0 +1,225 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+TERMINAL_STATES = ("done", "failed")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    payload BLOB,
+    result TEXT,
+    error TEXT,
+    code INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created);
+"""
+
+
+class JobQueueFullError(Exception):
+    pass
+
+
+class JobQueue:
+    """
+    Persistent FIFO of analysis jobs in a SQLite file, drained by `workers` asyncio tasks.
+
+    A job is an uploaded payload plus JSON params; `handler(params, payload)` turns it
+    into a JSON-able result. The payload is dropped once the job is finished, the job
+    row itself after `ttl_s`. Jobs that were running when the server stopped are queued
+    again on the next start, up to `max_attempts` starts in total, so an input that
+    crashes the process can't crash it forever.
+
+    SQLite is only touched from worker threads (`asyncio.to_thread`) under one lock.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        handler: Callable[[dict, bytes], Awaitable[Any]],
+        describe_error: Callable[[Exception], Tuple[int, str]],
+        workers: int = 1,
+        max_queued: int = 10000,
+        ttl_s: float = 24 * 3600.0,
+        max_attempts: int = 3,
+    ):
+        self.path = path
+        self.handler = handler
+        self.describe_error = describe_error
+        self.workers = workers
+        self.max_queued = max_queued
+        self.ttl_s = ttl_s
+        self.max_attempts = max_attempts
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._changed: Optional[asyncio.Condition] = None
+        self._finished = 0  # jobs finished so far, bumped under `_changed`
+
+    # --- SQLITE (blocking, called through asyncio.to_thread) ---
+    def _execute(self, sql: str, args: tuple = ()) -> list:
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def _open(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        # Whatever was running when the server stopped gets another go
+        self._execute(
+            "UPDATE jobs SET status = 'failed', payload = NULL, code = 500, finished = ?, "
+            "error = 'Analysis was interrupted too many times.' WHERE status = 'running' AND attempts >= ?",
+            (time.time(), self.max_attempts),
+        )
+        self._execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+
+    def _insert(self, params: dict, payload: bytes) -> str:
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            (queued,) = self._db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()
+            if queued >= self.max_queued:
+                raise JobQueueFullError(f"Job queue is full ({queued} jobs waiting).")
+            self._db.execute(
+                "INSERT INTO jobs (id, status, params, payload, created) VALUES (?, 'queued', ?, ?, ?)",
+                (job_id, json.dumps(params), payload, time.time()),
+            )
+        return job_id
+
+    def _claim(self) -> Optional[sqlite3.Row]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, params, payload FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                self._db.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, started = ? WHERE id = ?",
+                    (time.time(), row["id"]),
+                )
+            return row
+
+    def _finish(self, job_id: str, result: Any = None, code: Optional[int] = None, error: Optional[str] = None):
+        status = "failed" if error is not None else "done"
+        self._execute(
+            "UPDATE jobs SET status = ?, result = ?, code = ?, error = ?, payload = NULL, finished = ? WHERE id = ?",
+            (status, None if result is None else json.dumps(result), code, error, time.time(), job_id),
+        )
+
+    def _purge(self):
+        self._execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished < ?", (time.time() - self.ttl_s,)
+        )
+
+    def _status(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, status, result, error, code, created, started, finished FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            out = {"job_id": row["id"], "status": row["status"], "created": row["created"]}
+            if row["status"] == "queued":
+                (ahead,) = self._db.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created < ?", (row["created"],)
+                ).fetchone()
+                out["position"] = ahead
+        if row["started"] is not None:
+            out["started"] = row["started"]
+        if row["finished"] is not None:
+            out["finished"] = row["finished"]
+        if row["result"] is not None:
+            out["result"] = json.loads(row["result"])
+        if row["error"] is not None:
+            out.update(code=row["code"], detail=row["error"])
+        return out
+
+    def _counts(self) -> dict:
+        rows = self._execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status")
+        return {row["status"]: row["n"] for row in rows}
+
+    # --- ASYNC API ---
+    async def start(self):
+        if self._tasks:
+            return
+        await asyncio.to_thread(self._open)
+        self._wakeup = asyncio.Event()
+        self._changed = asyncio.Condition()
+        self._wakeup.set()  # recovered jobs may be waiting already
+        self._tasks = [asyncio.create_task(self._work(), name=f"job-worker-{k}") for k in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._db is not None:
+            # Jobs cancelled mid-run are still 'running' and are queued again on the next start
+            self._db.close()
+            self._db = None
+
+    async def submit(self, params: dict, payload: bytes) -> dict:
+        """Queue a job and return its status (raises `JobQueueFullError`)."""
+        job_id = await asyncio.to_thread(self._insert, params, payload)
+        self._wakeup.set()
+        return await self.status(job_id)
+
+    async def status(self, job_id: str) -> Optional[dict]:
+        return await asyncio.to_thread(self._status, job_id)
+
+    async def wait(self, job_id: str, timeout_s: float) -> Optional[dict]:
+        """Status of a job once it is finished, or after `timeout_s` whatever it is (long poll)."""
+        deadline = time.monotonic() + timeout_s
+        while True:
+            # Taken before the read, so a job finishing between the read and the wait below
+            # wakes it up instead of being missed
+            finished = self._finished
+            status = await self.status(job_id)
+            remaining = deadline - time.monotonic()
+            if status is None or status["status"] in TERMINAL_STATES or remaining <= 0:
+                return status
+            async with self._changed:
+                try:
+                    await asyncio.wait_for(self._changed.wait_for(lambda: self._finished != finished), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def counts(self) -> dict:
+        return await asyncio.to_thread(self._counts)
+
+    async def _work(self):
+        while True:
+            job = await asyncio.to_thread(self._claim)
+            if job is None:
+                self._wakeup.clear()
+                await asyncio.to_thread(self._purge)
+                try:
+                    # Also look again now and then, in case a wakeup raced with clear()
+                    await asyncio.wait_for(self._wakeup.wait(), 5.0)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                result = await self.handler(json.loads(job["params"]), job["payload"])
+                await asyncio.to_thread(self._finish, job["id"], result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                code, detail = self.describe_error(e)
+                await asyncio.to_thread(self._finish, job["id"], None, code, detail)
+            async with self._changed:
+                self._finished += 1
+                self._changed.notify_all()
@@ -0,0 +1,110 @@
+import os
+import time
+import uuid
+import zipfile
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import BinaryIO, Callable, Dict, Iterable, List, Optional, Tuple
+
+from .upload import read_image_file
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
+
+
+@dataclass
+class BatchItem:
+    """One image of a batch upload. `read` returns its bytes, so archive members are only inflated when analyzed."""
+    name: str
+    read: Callable[[], bytes]
+
+
+def _read_member(archive: zipfile.ZipFile, info: zipfile.ZipInfo, max_bytes: int) -> bytearray:
+    with archive.open(info) as f:
+        return read_image_file(f, max_bytes, info.file_size)
+
+
+def expand_uploads(uploads: Iterable[Tuple[str, BinaryIO]], max_image_bytes: int) -> List[BatchItem]:
+    """
+    Turn uploaded (filename, file) pairs into batch items. A ZIP archive contributes
+    one item per image it contains, named "<archive>/<member>"; anything else is
+    taken as an image. Reading an item fails if it is over `max_image_bytes` or not
+    an image (see read_image_file).
+    """
+    items = []
+    for filename, f in uploads:
+        filename = filename or f"file{len(items)}"
+        if zipfile.is_zipfile(f):
+            f.seek(0)
+            archive = zipfile.ZipFile(f)
+            for info in archive.infolist():
+                member = info.filename
+                if info.is_dir() or member.startswith("__MACOSX/") or os.path.basename(member).startswith("."):
+                    continue
+                if not member.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                items.append(BatchItem(
+                    f"{filename}/{member}",
+                    lambda a=archive, m=info: _read_member(a, m, max_image_bytes),
+                ))
+        else:
+            f.seek(0)
+            items.append(BatchItem(filename, lambda f=f: read_image_file(f, max_image_bytes)))
+    return items
+
+
+@dataclass
+class BatchJob:
+    """Results of a /predict_batch job so far, keyed by item name."""
+    job_id: str
+    created: float = field(default_factory=time.time)
+    updated: float = field(default_factory=time.time)
+    results: Dict[str, dict] = field(default_factory=dict)
+
+    def record(self, name: str, line: dict):
+        self.results[name] = line
+        self.updated = time.time()
+
+    def done(self, name: str) -> bool:
+        return name in self.results and self.results[name]["status"] == "ok"
+
+    def total(self, names: Iterable[str]) -> int:
+        """Images in the job once `names` are analyzed too: a resumed upload may send only the rest."""
+        return len(self.results.keys() | set(names))
+
+    def summary(self) -> dict:
+        failed = sum(1 for line in self.results.values() if line["status"] != "ok")
+        return {"job_id": self.job_id, "completed": len(self.results) - failed, "failed": failed}
+
+
+class BatchJobStore:
+    """
+    In-memory registry of batch jobs, so an interrupted upload can be resumed by
+    sending the rest of the files (or all of them again) with the same job id.
+    Jobs idle for longer than `ttl_s` are dropped, oldest first beyond `max_jobs`.
+    """
+
+    def __init__(self, max_jobs: int = 256, ttl_s: float = 24 * 3600.0):
+        self.max_jobs = max_jobs
+        self.ttl_s = ttl_s
+        self._jobs: "OrderedDict[str, BatchJob]" = OrderedDict()
+
+    def get(self, job_id: str) -> Optional[BatchJob]:
+        self._expire()
+        job = self._jobs.get(job_id)
+        if job is not None:
+            self._jobs.move_to_end(job_id)
+        return job
+
+    def get_or_create(self, job_id: Optional[str] = None) -> BatchJob:
+        job = self.get(job_id) if job_id else None
+        if job is None:
+            job = BatchJob(job_id or uuid.uuid4().hex)
+            self._jobs[job.job_id] = job
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+        return job
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl_s
+        for job_id in [j for j, job in self._jobs.items() if job.updated < cutoff]:
+            del self._jobs[job_id]
@@ -2,19 +2,62 @@ import cv2
 import numpy as np
 from ultralytics import YOLO
 import torch
+import contextlib
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Dict, List, Tuple
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from typing import Dict, Iterator, List, Optional, Tuple
+from dataclasses import dataclass
 import io
+import os
 import json
+import math
+import asyncio
+import tempfile
+import time
 import traceback
+import zipfile
+
+from .batching import MicroBatcher
+from .cache import DetectionCache, image_key
+from .decode import (
+    DetectionFrame,
+    InvalidImageError,
+    decode_for_detection,
+    decode_region,
+    probe_shape,
+    reduced_decode_factor,
+    region_decodable,
+)
+from .executor import InferenceExecutor, QueueFullError
+from .job_queue import JobQueue, JobQueueFullError
+from .jobs import BatchItem, BatchJob, BatchJobStore, expand_uploads
+from .measure import TrunkProfile
+from .metrics import SIZE_BUCKETS, MetricsRegistry, RequestTimer, memory_high_water
+from .pipeline import Pipeline, Stage
+from .shared_weights import (
+    SharedState,
+    attach_weights,
+    limit_threads,
+    release_memory,
+    share_weights,
+    shared_nbytes,
+)
+from .tiling import detect_tiled, needs_tiles, parse_grid
+from .upload import UploadTooLargeError, copy_video_file, read_image_file
+from .video import FrameSampler, box_iou, robust_summary, track_box, tracking_frame
+from .warmup import Readiness, load_in_parallel, parse_shapes, set_classes_cached
 
 # --- CHECK DETECTRON2 ---
 try:
     from detectron2.engine import DefaultPredictor
+    from detectron2.data import transforms as T
     from detectron2.config import get_cfg
     from detectron2 import model_zoo
+    from detectron2.modeling.postprocessing import detector_postprocess
+    from .exported import ExportedPredictor
     DETECTRON2_AVAILABLE = True
 except ImportError:
     DETECTRON2_AVAILABLE = False
@@ -22,55 +65,366 @@ except ImportError:
 
 # --- CONSTANTS ---
 HUMAN_HEIGHT_CM = 170.0 
+DBH_HEIGHT_CM = 130.0
+# Extra heights (m, comma separated) to report stem diameter at, e.g. "0.5,1.0,2.0,3.0"
+TAPER_HEIGHTS_M = [float(h) for h in os.getenv("PERCEPTREE_TAPER_HEIGHTS_M", "").split(",") if h.strip()]
 PERCEPTREE_MODEL_WEIGHTS = "output/ResNext-101_fold_01.pth" 
+# fp32 | fp16 (CUDA) | bf16 | int8 (CPU); check a mode with scripts/check_precision.py first
+PERCEPTREE_PRECISION = os.getenv("PERCEPTREE_PRECISION", "fp32")
+# Only the best instance of a crop is used (TrunkProfile), so by default the ROI heads keep just
+# that one: the mask head runs on it alone and only its mask is pasted, with the same top-1 as
+# before. PERCEPTREE_PROPOSALS also caps the RPN proposals the box head scores (0 keeps the
+# config's 1000), which can change the top-1; check a value with scripts/check_fast_path.py first.
+PERCEPTREE_DETECTIONS = int(os.getenv("PERCEPTREE_DETECTIONS", "1"))
+PERCEPTREE_PROPOSALS = int(os.getenv("PERCEPTREE_PROPOSALS", "0"))
+# "eager" builds the model from the model zoo config. "torchscript" or "onnxruntime" (CPU) load the
+# artifact that scripts/export_perceptree.py wrote to PERCEPTREE_EXPORT_DIR instead (always fp32).
+PERCEPTREE_BACKEND = os.getenv("PERCEPTREE_BACKEND", "eager")
+PERCEPTREE_EXPORT_DIR = os.getenv("PERCEPTREE_EXPORT_DIR", "output/perceptree_export")
 YOLO_PERSON_MODEL_PATH = 'yolov8n.pt'
 YOLO_WORLD_MODEL_PATH = 'inference_pretrained/yolov8s-worldv2.pt'
 
+# --- BATCHING ---
+# Concurrent /predict calls are grouped into one batch of up to MAX_BATCH_SIZE images,
+# waiting at most MAX_BATCH_WAIT_MS after the first one arrives.
+MAX_BATCH_SIZE = int(os.getenv("PERCEPTREE_MAX_BATCH_SIZE", "8"))
+MAX_BATCH_WAIT_MS = float(os.getenv("PERCEPTREE_MAX_BATCH_WAIT_MS", "10"))
+
+# --- INFERENCE EXECUTOR ---
+# "thread": workers share the models loaded in this process, so keep 1 worker per model copy.
+# "process": every worker is a separate process with its own copy of the models.
+INFERENCE_POOL = os.getenv("PERCEPTREE_INFERENCE_POOL", "thread")
+INFERENCE_WORKERS = int(os.getenv("PERCEPTREE_INFERENCE_WORKERS", "1"))
+# Requests allowed to wait for a worker before /predict answers 503
+INFERENCE_MAX_QUEUE = int(os.getenv("PERCEPTREE_INFERENCE_MAX_QUEUE", "64"))
+INFERENCE_TIMEOUT_S = float(os.getenv("PERCEPTREE_INFERENCE_TIMEOUT_S", "120"))
+# With the process pool on CPU, the server process loads every model once and moves the weights
+# to shared memory; the inference processes attach to them read-only instead of loading a copy
+# each. Run this instead of several uvicorn workers.
+SHARE_WEIGHTS = os.getenv("PERCEPTREE_SHARE_WEIGHTS", "1") == "1"
+# Intra-op threads of each inference process; 0 is an equal share of the cores
+WORKER_THREADS = int(os.getenv("PERCEPTREE_WORKER_THREADS", "0"))
+
+# --- INFERENCE ENGINE ---
+# "pipeline": decode → (person ‖ tree) → trunk, each stage with its own queue and worker
+#             thread, so consecutive requests overlap. Needs the models in this process.
+# "batch": whole requests are micro-batched and analyzed end to end on the executor.
+INFERENCE_ENGINE = os.getenv("PERCEPTREE_ENGINE", "pipeline" if INFERENCE_POOL == "thread" else "batch")
+DECODE_WORKERS = int(os.getenv("PERCEPTREE_DECODE_WORKERS", "2"))
+# The YOLO models letterbox to 640px, so frames for detection are decoded at the smallest
+# 1/2, 1/4 or 1/8 scale whose long side is still at least this many pixels.
+DETECT_MIN_SIDE = int(os.getenv("PERCEPTREE_DETECT_MIN_SIDE", "640"))
+
+# --- TILED DETECTION ---
+# Photos whose long side is at least TILE_MIN_SIDE px are also run through the detectors as a
+# COLSxROWS grid of overlapping tiles, in the same batch as the full frame, and the detections
+# of all of them are merged. Each tile is decoded with DETECT_MIN_SIDE px on its long side, so
+# small, distant trees are seen at a higher resolution. Costs 1 + COLS*ROWS detector inputs
+# per photo. Empty (the default) disables tiling.
+TILE_GRID = parse_grid(os.getenv("PERCEPTREE_TILE_GRID", ""))
+TILE_OVERLAP = float(os.getenv("PERCEPTREE_TILE_OVERLAP", "0.2"))
+TILE_MIN_SIDE = int(os.getenv("PERCEPTREE_TILE_MIN_SIDE", "2000"))
+
+# --- TRUNK CROP ---
+# "band": PercepTree only sees the trunk from BAND_MARGIN_CM below the lowest to BAND_MARGIN_CM
+#         above the highest measuring height (1.3m and the taper heights), resized by the factor
+#         the whole tree crop would get, so the trunk looks the same to it at a fraction of the
+#         pixels. If no trunk is found there, the whole tree crop is tried next.
+# "tree": the whole tree box, as PercepTree's own test-time resize makes of it.
+TRUNK_CROP_POLICY = os.getenv("PERCEPTREE_TRUNK_CROP", "band")
+BAND_MARGIN_CM = float(os.getenv("PERCEPTREE_BAND_MARGIN_CM", "50"))
+FPN_STRIDE = 32
+# Tree crops under 32px are measured on the trunk around the 1.3m line only, upsampled until
+# its short side is TRUNK_MIN_SIDE px, but by no more than TRUNK_MAX_UPSAMPLE times.
+TRUNK_MIN_SIDE = int(os.getenv("PERCEPTREE_TRUNK_MIN_SIDE", "64"))
+TRUNK_MAX_UPSAMPLE = float(os.getenv("PERCEPTREE_TRUNK_MAX_UPSAMPLE", "4"))
+
+# --- MULTI-TREE ---
+# With multi_tree, every tree detection of at least MULTI_TREE_MIN_CONF (the most confident
+# MULTI_TREE_MAX of them) is measured too, and all their trunk crops go through PercepTree
+# together with the rest of the batch, at most TRUNK_BATCH_SIZE crops per forward call.
+MULTI_TREE_MIN_CONF = float(os.getenv("PERCEPTREE_MULTI_TREE_MIN_CONF", "0.25"))
+MULTI_TREE_MAX = int(os.getenv("PERCEPTREE_MULTI_TREE_MAX", "32"))
+TRUNK_BATCH_SIZE = int(os.getenv("PERCEPTREE_TRUNK_BATCH_SIZE", str(4 * MAX_BATCH_SIZE)))
+
+# --- DETECTION CACHE ---
+# Detector boxes and PercepTree masks are cached by image content, so re-submitting a photo
+# with another person_height or an edited box only redoes the geometry. 0 entries disables it.
+# With process workers every process keeps its own cache.
+CACHE_MAX_ENTRIES = int(os.getenv("PERCEPTREE_CACHE_MAX_ENTRIES", "1024"))
+CACHE_TTL_S = float(os.getenv("PERCEPTREE_CACHE_TTL_S", "900"))
+CACHE_MAX_MB = float(os.getenv("PERCEPTREE_CACHE_MAX_MB", "256"))
+
+# --- UPLOADS ---
+# An image is read from the spooled upload into one buffer of its size, after its size and
+# first bytes were checked. Requests whose Content-Length is over the limit (plus room for
+# the multipart framing) are turned away before their body is read; /predict_batch takes up
+# to BATCH_MAX_UPLOAD_MB per request, each image in it still at most MAX_UPLOAD_MB.
+MAX_UPLOAD_MB = float(os.getenv("PERCEPTREE_MAX_UPLOAD_MB", "30"))
+BATCH_MAX_UPLOAD_MB = float(os.getenv("PERCEPTREE_BATCH_MAX_UPLOAD_MB", "2048"))
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+# --- VIDEO ---
+# POST /predict_video samples a clip at VIDEO_SAMPLE_FPS, at most VIDEO_MAX_FRAMES frames.
+# The detectors only run on keyframes: the first frame, every VIDEO_KEYFRAME_INTERVAL-th
+# sampled frame after it and any frame a box was lost on. In between, the person and tree
+# boxes are tracked with optical flow and passed on as override boxes, so only PercepTree
+# runs, and not at all on a frame whose tracked boxes still overlap the last analyzed ones
+# by VIDEO_REUSE_IOU. Height and DBH are the medians over the analyzed frames.
+VIDEO_SAMPLE_FPS = float(os.getenv("PERCEPTREE_VIDEO_SAMPLE_FPS", "5"))
+VIDEO_MAX_FRAMES = int(os.getenv("PERCEPTREE_VIDEO_MAX_FRAMES", "60"))
+VIDEO_KEYFRAME_INTERVAL = int(os.getenv("PERCEPTREE_VIDEO_KEYFRAME_INTERVAL", "10"))
+VIDEO_REUSE_IOU = float(os.getenv("PERCEPTREE_VIDEO_REUSE_IOU", "0.9"))
+VIDEO_MAX_UPLOAD_MB = float(os.getenv("PERCEPTREE_VIDEO_MAX_UPLOAD_MB", "200"))
+VIDEO_JPEG_QUALITY = 95
+
+# --- BATCH JOBS ---
+# Images of one /predict_batch upload analyzed at once; enough to fill the batchers twice over.
+BATCH_MAX_IN_FLIGHT = int(os.getenv("PERCEPTREE_BATCH_MAX_IN_FLIGHT", str(2 * MAX_BATCH_SIZE)))
+# Finished jobs are kept this long so an interrupted upload can be resumed with its job id
+BATCH_JOB_TTL_S = float(os.getenv("PERCEPTREE_BATCH_JOB_TTL_S", str(24 * 3600)))
+BATCH_MAX_JOBS = int(os.getenv("PERCEPTREE_BATCH_MAX_JOBS", "256"))
+
+# --- ASYNC JOB QUEUE ---
+# POST /jobs only stores the upload in a SQLite queue and returns a job id; JOB_WORKERS
+# tasks feed queued jobs to the inference engine. Queued jobs survive a restart.
+JOB_DB_PATH = os.getenv("PERCEPTREE_JOB_DB", "output/jobs.sqlite3")
+JOB_WORKERS = int(os.getenv("PERCEPTREE_JOB_WORKERS", str(MAX_BATCH_SIZE)))
+JOB_MAX_QUEUED = int(os.getenv("PERCEPTREE_JOB_MAX_QUEUED", "10000"))
+JOB_TTL_S = float(os.getenv("PERCEPTREE_JOB_TTL_S", str(24 * 3600)))
+# Longest a GET /jobs/{id}?wait=... long poll is held open
+JOB_MAX_WAIT_S = float(os.getenv("PERCEPTREE_JOB_MAX_WAIT_S", "30"))
+
+# --- STARTUP ---
+# YOLO-World's CLIP embeddings of its class names are kept here, so CLIP isn't loaded on boot
+TEXT_EMBEDDING_CACHE_DIR = os.getenv("PERCEPTREE_TEXT_EMBEDDING_DIR", "output/text_embeddings")
+# Synthetic warm-up inferences before /ready reports ready: image sizes (WxH, comma separated),
+# batch sizes and rounds. PERCEPTREE_WARMUP_RUNS=0 disables warm-up.
+WARMUP_SHAPES = parse_shapes(os.getenv("PERCEPTREE_WARMUP_SHAPES", "4000x3000"))
+WARMUP_BATCH_SIZES = [int(b) for b in os.getenv("PERCEPTREE_WARMUP_BATCH_SIZES", "1").split(",") if b.strip()]
+WARMUP_RUNS = int(os.getenv("PERCEPTREE_WARMUP_RUNS", "1"))
+
 # --- GLOBAL MODELS DICT ---
 models: Dict[str, any] = {}
+readiness = Readiness()
 
-# --- LIFESPAN (MODEL LOADING) ---
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    print("--- 🚀 STARTING SYSTEM ---")
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    print(f"Device: {device}")
+# --- METRICS ---
+# Exposed on /metrics. With process workers, steps that run inside the worker processes
+# (everything but the "analyze" batcher) are not recorded; debug timings still are.
+metrics = MetricsRegistry()
+STAGE_SECONDS = metrics.histogram(
+    "perceptree_stage_seconds", "Wall time of one call of an analysis step; a call may cover a whole batch."
+)
+BATCH_SIZE = metrics.histogram("perceptree_batch_size", "Items per batch run by a batcher or pipeline stage.", SIZE_BUCKETS)
+BATCH_SECONDS = metrics.histogram("perceptree_batch_seconds", "Wall time of one batch of a batcher or pipeline stage.")
+REQUEST_SECONDS = metrics.histogram("perceptree_request_seconds", "Time until the response starts, by route.")
+REQUESTS = metrics.counter("perceptree_requests_total", "Responses by route and HTTP status.")
+MODEL_LOAD_SECONDS = metrics.gauge(
+    "perceptree_model_load_seconds", "Time it took to load each model at startup.",
+    collect=lambda: [({"model": name}, seconds) for name, seconds in readiness.load_s.items()],
+)
+MEMORY_HIGH_WATER = metrics.gauge(
+    "perceptree_memory_high_water_bytes", "Peak memory allocated on each device since startup.", collect=memory_high_water
+)
+
+def queue_depths():
+    depths = [({"queue": "executor"}, inference_executor.pending)]
+    if INFERENCE_ENGINE == "pipeline":
+        depths += [({"queue": name}, depth) for name, depth in pipeline.queue_depths().items()]
+    else:
+        depths.append(({"queue": batcher.name}, batcher.qsize()))
+    return depths
 
-    # 1. Load YOLO Person
+QUEUE_DEPTH = metrics.gauge("perceptree_queue_depth", "Items waiting in each queue.", collect=queue_depths)
+
+def observe_batch(name: str, size: int, seconds: float):
+    BATCH_SIZE.observe(size, stage=name)
+    BATCH_SECONDS.observe(seconds, stage=name)
+
+# --- MODEL LOADING ---
+def get_device() -> str:
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+def load_yolo_person(shared: Optional[SharedState] = None):
     try:
-        models["yolo_person"] = YOLO(YOLO_PERSON_MODEL_PATH)
-        models["yolo_person"].to(device)
+        model = YOLO(YOLO_PERSON_MODEL_PATH)
+        if shared is not None:
+            model.fuse()  # shared weights are taken after fusing
+            attach_weights(model.model, shared)
+        model.to(get_device())
+        models["yolo_person"] = model
         print("✅ YOLO Person Loaded.")
     except Exception as e:
         print(f"❌ Failed to load YOLO Person: {e}")
 
-    # 2. Load YOLO Tree
+def load_yolo_tree(shared: Optional[SharedState] = None):
     try:
-        models["yolo_tree"] = YOLO(YOLO_WORLD_MODEL_PATH)
-        models["yolo_tree"].set_classes(["tree"])
-        models["yolo_tree"].to(device)
+        model = YOLO(YOLO_WORLD_MODEL_PATH)
+        if set_classes_cached(model, ["tree"], YOLO_WORLD_MODEL_PATH, TEXT_EMBEDDING_CACHE_DIR):
+            print("✅ YOLO-World text embeddings loaded from cache.")
+        if shared is not None:
+            model.fuse()
+            attach_weights(model.model, shared)
+        model.to(get_device())
+        models["yolo_tree"] = model
         print("✅ YOLO Tree Loaded.")
     except Exception as e:
         print(f"❌ Failed to load YOLO Tree: {e}")
 
-    # 3. Load Detectron2 (PercepTree)
-    if DETECTRON2_AVAILABLE:
-        try:
-            cfg = get_cfg()
-            cfg.merge_from_file(model_zoo.get_config_file("COCO-InstanceSegmentation/mask_rcnn_X_101_32x8d_FPN_3x.yaml"))
-            cfg.MODEL.ROI_HEADS.NUM_CLASSES = 1
-            cfg.MODEL.WEIGHTS = PERCEPTREE_MODEL_WEIGHTS
-            cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.5
-            cfg.MODEL.DEVICE = device
-            
-            models["perceptree"] = DefaultPredictor(cfg)
-            print("✅ Detectron2 (PercepTree) Loaded.")
-        except Exception as e:
-            print(f"❌ Failed to load Detectron2: {e}")
-            models["perceptree"] = None
-    
-    print("--- ✅ SYSTEM READY ---")
+def perceptree_cfg(
+    device: str, precision: str = "fp32", detections: int = PERCEPTREE_DETECTIONS, proposals: int = PERCEPTREE_PROPOSALS
+):
+    cfg = get_cfg()
+    cfg.merge_from_file(model_zoo.get_config_file("COCO-InstanceSegmentation/mask_rcnn_X_101_32x8d_FPN_3x.yaml"))
+    cfg.MODEL.ROI_HEADS.NUM_CLASSES = 1
+    cfg.MODEL.WEIGHTS = PERCEPTREE_MODEL_WEIGHTS
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.5
+    cfg.MODEL.DEVICE = device
+    cfg.TEST.DETECTIONS_PER_IMAGE = detections
+    if proposals:
+        # Per FPN level before NMS, over all levels after
+        cfg.MODEL.RPN.PRE_NMS_TOPK_TEST = min(cfg.MODEL.RPN.PRE_NMS_TOPK_TEST, proposals)
+        cfg.MODEL.RPN.POST_NMS_TOPK_TEST = min(cfg.MODEL.RPN.POST_NMS_TOPK_TEST, proposals)
+    if precision != "fp32":
+        cfg.TEST.PRECISION = precision
+    return cfg
+
+def load_perceptree(shared: Optional[SharedState] = None):
+    if not DETECTRON2_AVAILABLE:
+        return
+    try:
+        if PERCEPTREE_BACKEND == "eager":
+            cfg = perceptree_cfg(get_device(), PERCEPTREE_PRECISION)
+            if shared is not None:
+                cfg.MODEL.WEIGHTS = ""  # don't read the checkpoint, the weights are replaced below
+            predictor = DefaultPredictor(cfg)
+            if shared is not None:
+                attach_weights(predictor.model, shared)
+            models["perceptree"] = predictor
+        else:
+            models["perceptree"] = ExportedPredictor(
+                PERCEPTREE_EXPORT_DIR, PERCEPTREE_BACKEND, get_device(), onnx_threads=torch.get_num_threads()
+            )
+        print(f"✅ Detectron2 (PercepTree, {PERCEPTREE_BACKEND}) Loaded.")
+    except Exception as e:
+        print(f"❌ Failed to load Detectron2: {e}")
+        models["perceptree"] = None
+
+def load_models(shared: Optional[Dict[str, SharedState]] = None):
+    """Load the models, on top of the weights in `shared` (by model name) where there are some."""
+    print(f"Device: {get_device()}")
+    shared = shared or {}
+    # The three models are independent: load them side by side
+    readiness.load_s = load_in_parallel({
+        "yolo_person": lambda: load_yolo_person(shared.get("yolo_person")),
+        "yolo_tree": lambda: load_yolo_tree(shared.get("yolo_tree")),
+        "perceptree": lambda: load_perceptree(shared.get("perceptree")),
+    })
+
+def share_models() -> Dict[str, SharedState]:
+    """
+    Load the models here and move their weights to shared memory for the inference
+    processes. Only the shared tensors are kept; this process doesn't run inference.
+    """
+    load_models()
+    shared = {}
+    for name in ("yolo_person", "yolo_tree"):
+        if models.get(name) is not None:
+            models[name].fuse()  # the processes fuse theirs too, so the layouts match
+            shared[name] = share_weights(models[name].model)
+    # Dynamically quantized (int8) and exported models are loaded by every process
+    predictor = models.get("perceptree")
+    if PERCEPTREE_BACKEND == "eager" and PERCEPTREE_PRECISION != "int8" and predictor is not None:
+        shared["perceptree"] = share_weights(predictor.model)
+    models.clear()
+    release_memory()
+    print(f"✅ {sum(shared_nbytes(s) for s in shared.values()) / 2**20:.0f} MB of weights shared: {', '.join(shared)}")
+    return shared
+
+def warm_up():
+    """
+    Run every loaded model on synthetic images of the WARMUP_SHAPES, so the first real
+    requests don't pay for lazy allocations, kernel selection and first-call JIT.
+    """
+    rng = np.random.default_rng(0)
+    for h, w in WARMUP_SHAPES:
+        img = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+        img_bytes = cv2.imencode(".jpg", img)[1].tobytes()
+        frame = decode_for_detection(img_bytes, img.shape, detection_factor(img_bytes, img.shape))
+        # Roughly where a trunk crop falls: the lower part of a tree box in the middle
+        crop = np.ascontiguousarray(img[h // 3:, 2 * w // 5:3 * w // 5])
+        for _ in range(WARMUP_RUNS):
+            for batch_size in WARMUP_BATCH_SIZES:
+                if models.get("yolo_person") is not None:
+                    detect_persons([frame] * batch_size)
+                if models.get("yolo_tree") is not None:
+                    detect_trees([frame] * batch_size)
+                if models.get("perceptree") is not None:
+                    profile_trunks([TrunkInput(crop)] * batch_size)
+
+def start_worker(shared: Optional[Dict[str, SharedState]] = None):
+    """Initializer of inference processes: load the models (attached to `shared` weights), then warm them up."""
+    threads = limit_threads(WORKER_THREADS, INFERENCE_WORKERS)
+    print(f"Inference process {os.getpid()}: {threads} threads")
+    load_models(shared)
+    release_memory()
+    warm_up()
+
+def worker_ready(hold_s: float = 0.0) -> int:
+    """
+    The pid of the inference process this runs in, which has finished its initializer.
+    Holding the process for `hold_s` sends the other calls made at the same time to
+    other processes.
+    """
+    time.sleep(hold_s)
+    return os.getpid()
+
+
+# --- LIFESPAN ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    print("--- 🚀 STARTING SYSTEM ---")
+    readiness.set("loading")
+    in_processes = INFERENCE_ENGINE == "batch" and INFERENCE_POOL == "process"
+    shared_weights = None
+    if in_processes:
+        if SHARE_WEIGHTS and get_device() == "cpu":
+            shared_weights = await asyncio.to_thread(share_models)
+        print(f"Models will be loaded by {INFERENCE_WORKERS} inference processes.")
+    else:
+        await asyncio.to_thread(load_models)
+
+    # The shared weights must outlive the pool: processes are spawned on demand
+    inference_executor.start(initargs=(shared_weights,))
+    if INFERENCE_ENGINE == "pipeline":
+        await pipeline.start()
+    else:
+        await batcher.start(inference_executor.pool)
+    await job_queue.start()
+
+    readiness.set("warming")
+    start = time.perf_counter()
+    if in_processes:
+        # Every process loads and warms up in its initializer. Any process that is up can
+        # answer a call, so wait until each of them has answered one
+        loop = asyncio.get_running_loop()
+        ready_pids = set()
+        while len(ready_pids) < INFERENCE_WORKERS:
+            ready_pids.update(await asyncio.gather(*(
+                loop.run_in_executor(inference_executor.pool, worker_ready, 0.2) for _ in range(INFERENCE_WORKERS)
+            )))
+    elif WARMUP_RUNS > 0:
+        await asyncio.to_thread(warm_up)
+    readiness.warmup_s = time.perf_counter() - start
+    readiness.set("ready")
+    print(f"--- ✅ SYSTEM READY ({readiness.ready_after_s:.1f}s) ---")
     yield
+    await job_queue.stop()
+    if INFERENCE_ENGINE == "pipeline":
+        await pipeline.stop()
+    else:
+        await batcher.stop()
+    inference_executor.shutdown()
     models.clear()
     print("--- 🛑 SYSTEM SHUTDOWN ---")
 
@@ -84,87 +438,217 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    limit_mb = {"/predict_batch": BATCH_MAX_UPLOAD_MB, "/predict_video": VIDEO_MAX_UPLOAD_MB}.get(
+        request.url.path, MAX_UPLOAD_MB
+    )
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > limit_mb * 2**20 + MULTIPART_OVERHEAD_BYTES:
+        return JSONResponse({"detail": f"Upload is over the {limit_mb:g} MB limit."}, status_code=413)
+    return await call_next(request)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    path = route.path if route is not None else "unmatched"
+    REQUEST_SECONDS.observe(time.perf_counter() - start, route=path)
+    REQUESTS.inc(route=path, status=response.status_code)
+    return response
+
 # --- CORE LOGIC: IMAGE ANALYSIS ---
-def analyze_image(img_bytes: bytes, real_human_height: float, override_person_box=None, override_tree_box=None) -> dict:
-    # 1. Decode Image
-    nparr = np.frombuffer(img_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    if img is None:
-        raise HTTPException(status_code=400, detail="Invalid image data.")
-    
-    h_img, w_img = img.shape[:2]
-    
-    results = {
+@dataclass
+class AnalysisRequest:
+    img_bytes: bytes
+    real_human_height: float
+    override_person_box: Optional[list] = None
+    override_tree_box: Optional[list] = None
+    debug: bool = False  # add a per-step timing breakdown to the result
+    multi_tree: bool = False  # also measure every detected tree, under "trees"
+
+
+def detect_persons(frames: List[DetectionFrame]) -> List[List[np.ndarray]]:
+    """Run YOLO person (class=0) once over a batch of frames (and their tiles); returns full-resolution boxes per frame."""
+    if not frames:
+        return []
+    with STAGE_SECONDS.time(stage="person"):
+        dets = detect_tiled(
+            lambda images: models["yolo_person"](images, classes=[0], verbose=False),
+            frames, TILE_GRID, TILE_OVERLAP, TILE_MIN_SIDE,
+        )
+    return [[box for _, box in frame_dets] for frame_dets in dets]
+
+
+def detect_trees(frames: List[DetectionFrame]) -> List[List[Tuple[float, np.ndarray]]]:
+    """Run YOLO-World "tree" once over a batch of frames (and their tiles); returns full-resolution (conf, box) pairs per frame."""
+    if not frames:
+        return []
+    with STAGE_SECONDS.time(stage="tree"):
+        return detect_tiled(
+            lambda images: models["yolo_tree"].predict(images, verbose=False, conf=0.1),
+            frames, TILE_GRID, TILE_OVERLAP, TILE_MIN_SIDE,
+        )
+
+
+@dataclass
+class TrunkInput:
+    """A BGR crop for PercepTree and the factor to resize it by (None: the model's test-time resize)."""
+    image: np.ndarray
+    model_scale: Optional[float] = None
+
+
+def stride_multiple(size: float) -> int:
+    return max(FPN_STRIDE, int(round(size / FPN_STRIDE)) * FPN_STRIDE)
+
+
+def segment_trunks(crops: List[TrunkInput], paste_masks: bool = True) -> list:
+    """
+    Run PercepTree on a batch of crops with a single forward pass.
+    Uses the predictor's own preprocess and postprocess, as DefaultPredictor.__call__, except
+    that all crops go into one ImageList.
+    With paste_masks=False the masks are left as ROIMasks, for the caller to rasterize
+    only what it reads.
+    """
+    if not crops:
+        return []
+    predictor = models["perceptree"]
+    # Builds of detectron2 without TEST.PRECISION always run in fp32
+    precision = predictor.precision_context() if hasattr(predictor, "precision_context") else contextlib.nullcontext()
+    inputs = []
+    with torch.no_grad(), STAGE_SECONDS.time(stage="mask_rcnn"):
+        for item in crops:
+            transform = None
+            if item.model_scale is not None:
+                # Band crops are sized so this lands on whole FPN strides
+                height, width = item.image.shape[:2]
+                new_h, new_w = stride_multiple(height * item.model_scale), stride_multiple(width * item.model_scale)
+                transform = T.ResizeTransform(height, width, new_h, new_w)
+            inputs.append(predictor.preprocess(item.image, transform))
+        with precision:
+            outputs = predictor.model(inputs) if paste_masks else predictor.model.inference(inputs, do_postprocess=False)
+    if not paste_masks:
+        outputs = [
+            {"instances": detector_postprocess(o, x["height"], x["width"], paste_masks=False)}
+            for o, x in zip(outputs, inputs)
+        ]
+    # Back to fp32 (under TEST.PRECISION=fp16/bf16), as DefaultPredictor's own outputs
+    return [predictor.postprocess(o)["instances"] for o in outputs]
+
+
+def profile_trunks(crops: List[TrunkInput]) -> List[TrunkProfile]:
+    """PercepTree on a batch of crops, reduced to what DBH needs while the masks are still on the device."""
+    # A profile only needs the row extents of one mask, which come from its 28x28 cells directly
+    outputs = segment_trunks(crops, paste_masks=False)
+    with STAGE_SECONDS.time(stage="mask_postprocess"):
+        return [TrunkProfile.from_instances(instances) for instances in outputs]
+
+
+def measure_trunk_widths(profile: TrunkProfile, local_ys: List[int]) -> List[float]:
+    """Trunk width in crop pixels at each row of `local_ys`; the first one is the 1.3m line."""
+    # Take a small slice around each measuring point to handle noise
+    widths = profile.widths_at(local_ys, half_h=2)
+    if not profile.has_mask:
+        print("⚠️ No mask output, falling back to BBox.")
+    elif widths[0] is None:
+        print("⚠️ Gap in mask at 1.3m, falling back to BBox.")
+    else:
+        print(f"✅ DBH from Mask: {widths[0]:.2f}px")
+    # Fallback: If a slice is empty (gap in mask) or there is no mask, use BBox
+    return [w if w is not None else profile.box_width for w in widths]
+
+
+def new_result() -> dict:
+    return {
         "tree_height_m": 0.0,
         "dbh_cm": 0.0,
         "boxes": {"person": None, "tree": None},
         "warnings": []
     }
 
-    # 2. Find Person (Reference)
-    scale_person_box = None
-    if override_person_box:
-        scale_person_box = np.array(override_person_box, dtype=int)
-    elif "yolo_person" in models:
-        # Detect person class=0
-        res = models["yolo_person"](img, classes=[0], verbose=False)
-        boxes = [b.xyxy[0].cpu().numpy().astype(int) for r in res for b in r.boxes]
-        
-        # Heuristic: Pick tallest person
-        if boxes:
-            scale_person_box = max(boxes, key=lambda b: b[3] - b[1])
-        else:
-            # Fallback: Assume person is 1/3 image height at bottom left (Safe fallback)
-            dummy_h = h_img // 3
-            scale_person_box = np.array([10, h_img - dummy_h, 10 + dummy_h//3, h_img], dtype=int)
-            results["warnings"].append("Person not found. Using dummy box.")
-
-    if scale_person_box is not None:
-        results["boxes"]["person"] = scale_person_box.tolist()
-        person_h_px = scale_person_box[3] - scale_person_box[1]
-        scale_cm_per_px = real_human_height / person_h_px if person_h_px > 0 else 0
-        ground_y = scale_person_box[3]
-    else:
-        return results # Cannot calculate anything without scale
 
-    # 3. Find Tree (Target)
-    best_tree_box = None
-    if override_tree_box:
-        best_tree_box = np.array(override_tree_box, dtype=int)
-    elif "yolo_tree" in models:
-        res = models["yolo_tree"].predict(img, verbose=False, conf=0.1)
-        # Pick highest confidence tree
-        all_boxes = []
-        for r in res:
-            for b in r.boxes:
-                all_boxes.append((b.conf[0], b.xyxy[0].cpu().numpy().astype(int)))
-        
-        if all_boxes:
-            best_tree_box = max(all_boxes, key=lambda x: x[0])[1]
+PERSON_NOT_FOUND = "Person not found. Using dummy box."
 
-    if best_tree_box is None:
+
+def choose_person_box(boxes: List[np.ndarray], img_shape: tuple, results: dict) -> np.ndarray:
+    # Heuristic: Pick tallest person
+    if boxes:
+        return max(boxes, key=lambda b: b[3] - b[1])
+    # Fallback: Assume person is 1/3 image height at bottom left (Safe fallback)
+    h_img = img_shape[0]
+    dummy_h = h_img // 3
+    results["warnings"].append(PERSON_NOT_FOUND)
+    return np.array([10, h_img - dummy_h, 10 + dummy_h//3, h_img], dtype=int)
+
+
+def choose_tree_box(candidates: List[Tuple[float, np.ndarray]]) -> Optional[np.ndarray]:
+    # Pick highest confidence tree
+    if candidates:
+        return max(candidates, key=lambda x: x[0])[1]
+    return None
+
+
+def choose_trees(candidates: List[Tuple[float, np.ndarray]]) -> List[Tuple[float, np.ndarray]]:
+    """The tree detections multi-tree mode measures, most confident first."""
+    kept = sorted((c for c in candidates if c[0] >= MULTI_TREE_MIN_CONF), key=lambda c: -c[0])
+    return kept[:MULTI_TREE_MAX]
+
+
+def person_scale(results: dict, person_box: np.ndarray, real_human_height: float) -> float:
+    """Record the reference box and return the cm-per-pixel scale it implies."""
+    results["boxes"]["person"] = person_box.tolist()
+    person_h_px = person_box[3] - person_box[1]
+    return real_human_height / person_h_px if person_h_px > 0 else 0
+
+
+CropBox = Tuple[int, int, int, int]
+
+
+@dataclass(frozen=True)
+class TrunkCrop:
+    """
+    The (x1, y1, x2, y2) region of the photo PercepTree runs on, upsampled `scale` times.
+    PercepTree resizes it by `model_scale` (None: its own test-time resize); `fallback` is
+    the crop to try when it finds no trunk in this one.
+    """
+    box: CropBox
+    scale: float = 1.0
+    model_scale: Optional[float] = None
+    fallback: Optional["TrunkCrop"] = None
+
+    def local_y(self, y: int) -> int:
+        """Row of the (upsampled) crop that shows row `y` of the photo."""
+        return int((y - self.box[1]) * self.scale)
+
+
+def plan_trunk_crop(
+    results: dict, img_shape: tuple, tree_box: Optional[np.ndarray], scale_cm_per_px: float, ground_y: int
+) -> Optional[TrunkCrop]:
+    """
+    Fill in the tree box and height, then work out the crop PercepTree measures DBH on.
+    Returns None if DBH can't be measured.
+    """
+    if tree_box is None:
         results["warnings"].append("Tree not found by YOLO.")
-        return results
-    
-    results["boxes"]["tree"] = best_tree_box.tolist()
-    
+        return None
+
+    results["boxes"]["tree"] = tree_box.tolist()
+
     # Calculate Tree Height
-    tree_h_px = best_tree_box[3] - best_tree_box[1]
+    tree_h_px = tree_box[3] - tree_box[1]
     results["tree_height_m"] = (tree_h_px * scale_cm_per_px) / 100.0
 
     # 4. MEASURE DBH (Using Detectron2)
     # Check Model
     if models.get("perceptree") is None:
         results["warnings"].append("Detectron2 not ready.")
-        return results
-
-    # Calculate Global Y for 1.3m Height
-    pixel_1m3 = 130.0 / scale_cm_per_px
-    dbh_y_global = int(ground_y - pixel_1m3)
+        return None
 
     # --- SAFE CROP LOGIC ---
-    tx1, ty1, tx2, ty2 = best_tree_box
-    
+    h_img, w_img = img_shape[:2]
+    tx1, ty1, tx2, ty2 = tree_box
+
     # Clamp coordinates to image bounds
     tx1 = int(max(0, min(tx1, w_img - 1)))
     ty1 = int(max(0, min(ty1, h_img - 1)))
@@ -176,96 +660,822 @@ def analyze_image(img_bytes: bytes, real_human_height: float, override_person_bo
 
     # Check minimum size for ResNet/FPN (32px stride)
     if crop_w < 32 or crop_h < 32:
+        dbh_y = ground_y - DBH_HEIGHT_CM / scale_cm_per_px if scale_cm_per_px > 0 else ty2
+        return small_trunk_crop(results, (tx1, ty1, tx2, ty2), dbh_y)
+
+    tree_crop = TrunkCrop((tx1, ty1, tx2, ty2))
+    if TRUNK_CROP_POLICY == "band" and scale_cm_per_px > 0:
+        return band_crop(tree_crop, img_shape, ground_y, scale_cm_per_px) or tree_crop
+    return tree_crop
+
+
+def model_resize_scale(height: int, width: int) -> float:
+    """The factor PercepTree's test-time resize (ResizeShortestEdge) scales a crop of this size by."""
+    aug = models["perceptree"].aug
+    scale = aug.short_edge_length[0] / min(height, width)
+    if max(height, width) * scale > aug.max_size:
+        scale = aug.max_size / max(height, width)
+    return scale
+
+
+def grow_to_stride(lo: int, hi: int, model_scale: float, limit: int) -> Tuple[int, int]:
+    """Widen [lo, hi) evenly, within [0, limit), until it resizes to a whole number of FPN strides."""
+    target = math.ceil(math.ceil((hi - lo) * model_scale / FPN_STRIDE) * FPN_STRIDE / model_scale)
+    target = min(target, limit)
+    lo = max(0, lo - (target - (hi - lo)) // 2)
+    hi = min(limit, lo + target)
+    return max(0, hi - target), hi
+
+
+def band_crop(tree_crop: TrunkCrop, img_shape: tuple, ground_y: int, scale_cm_per_px: float) -> Optional[TrunkCrop]:
+    """
+    The breast-height band of the tree crop (see TRUNK_CROP_POLICY), falling back to the
+    whole crop. None if the band isn't much smaller than the crop anyway.
+    """
+    if scale_cm_per_px <= 0:
+        return None
+    tx1, ty1, tx2, ty2 = tree_crop.box
+    heights_cm = [DBH_HEIGHT_CM] + [h * 100.0 for h in TAPER_HEIGHTS_M]
+    y1 = max(ty1, int(ground_y - (max(heights_cm) + BAND_MARGIN_CM) / scale_cm_per_px))
+    y2 = min(ty2, int(ground_y - (min(heights_cm) - BAND_MARGIN_CM) / scale_cm_per_px) + 1)
+    if y2 <= y1:
+        return None  # the measuring heights are outside the tree box
+    model_scale = model_resize_scale(ty2 - ty1, tx2 - tx1)
+    h_img, w_img = img_shape[:2]
+    x1, x2 = grow_to_stride(tx1, tx2, model_scale, w_img)
+    y1, y2 = grow_to_stride(y1, y2, model_scale, h_img)
+    if y2 - y1 > 0.75 * (ty2 - ty1):
+        return None
+    return TrunkCrop((x1, y1, x2, y2), model_scale=model_scale, fallback=tree_crop)
+
+
+def small_trunk_crop(results: dict, tree_box: CropBox, dbh_y: float) -> Optional[TrunkCrop]:
+    """
+    Crop of a small or distant tree: only the trunk around the 1.3m line, upsampled, so
+    the mask is pasted finer than the photo's pixels and the width isn't whole pixels.
+    """
+    tx1, ty1, tx2, ty2 = tree_box
+    crop_w, crop_h = tx2 - tx1, ty2 - ty1
+    # A band a few box widths high around the 1.3m line, kept inside the tree box
+    half_h = max(2 * crop_w, 16)
+    y1 = int(max(ty1, min(dbh_y - half_h, ty2 - 2 * half_h)))
+    y2 = int(min(ty2, y1 + 2 * half_h))
+    short_side = min(crop_w, y2 - y1)
+    scale = min(TRUNK_MAX_UPSAMPLE, max(1.0, TRUNK_MIN_SIDE / short_side))
+    if short_side * scale < 32:
         results["warnings"].append(f"Tree too small/far ({crop_w}x{crop_h}px) for Detectron2.")
-        return results
+        return None
+    results["warnings"].append(f"Small tree ({crop_w}x{crop_h}px): DBH measured on its trunk upsampled {scale:.1f}x.")
+    return TrunkCrop((tx1, y1, tx2, y2), scale)
 
+
+def cut_crop(img: np.ndarray, box: CropBox) -> np.ndarray:
+    tx1, ty1, tx2, ty2 = box
     # *** CRITICAL FIX: Make memory contiguous ***
-    tree_crop = np.ascontiguousarray(img[ty1:ty2, tx1:tx2])
+    return np.ascontiguousarray(img[ty1:ty2, tx1:tx2])
 
-    try:
-        # INFERENCE
-        d2_out = models["perceptree"](tree_crop)
-        instances = d2_out["instances"]
-        
-        if len(instances) == 0:
-            results["warnings"].append("Detectron2 found no trunk in the crop.")
-            return results
 
-        # Process the best instance (highest score)
-        # Note: Detectron2 sorts by score by default
-        best_inst = instances[0]
-        
-        # Calculate Local Y in Crop coordinates
-        local_y = dbh_y_global - ty1
-        
-        final_width_px = 0.0
-
-        if best_inst.has("pred_masks"):
-            # Mask is a boolean matrix of shape (H_crop, W_crop)
-            mask = best_inst.pred_masks[0].cpu().numpy()
-            mask_h, mask_w = mask.shape
-            
-            # Clamp local_y within mask bounds
-            safe_y = int(max(0, min(local_y, mask_h - 1)))
-            
-            # Take a small slice around the measuring point to handle noise
-            slice_half_h = 2 
-            y_start = max(0, safe_y - slice_half_h)
-            y_end = min(mask_h, safe_y + slice_half_h + 1)
-            
-            # Extract slice
-            mask_slice = mask[y_start:y_end, :] # Shape (h_slice, W)
-            
-            # Find widths for each row in slice
-            widths = []
-            for row in mask_slice:
-                pixels = np.where(row)[0] # Indices of True values
-                if len(pixels) > 0:
-                    w = pixels[-1] - pixels[0] + 1 # +1 because width includes both ends
-                    widths.append(w)
-            
-            if widths:
-                final_width_px = sum(widths) / len(widths)
-                print(f"✅ DBH from Mask: {final_width_px:.2f}px")
-            else:
-                # Fallback: If slice is empty (gap in mask), use BBox
-                print("⚠️ Gap in mask at 1.3m, falling back to BBox.")
-                box = best_inst.pred_boxes[0].tensor.cpu().numpy()[0]
-                final_width_px = box[2] - box[0]
+def upsample(img: np.ndarray, scale: float) -> np.ndarray:
+    if scale == 1.0:
+        return img
+    return cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
+
+
+def finish_dbh(results: dict, profile: TrunkProfile, crop_box: TrunkCrop, ground_y: int, scale_cm_per_px: float):
+    if not profile.found:
+        results["warnings"].append("Detectron2 found no trunk in the crop.")
+        return
+    if scale_cm_per_px <= 0:
+        results["warnings"].append("No scale from the person box, DBH can't be measured.")
+        return
+
+    heights_cm = [DBH_HEIGHT_CM] + [h * 100.0 for h in TAPER_HEIGHTS_M]
+    # Calculate Global Y for each height (1.3m first), then Local Y in Crop coordinates
+    local_ys = [crop_box.local_y(int(ground_y - h / scale_cm_per_px)) for h in heights_cm]
+    # Widths come back in crop pixels, which are 1/scale photo pixels
+    widths_px = [w / crop_box.scale for w in measure_trunk_widths(profile, local_ys)]
+
+    results["dbh_cm"] = widths_px[0] * scale_cm_per_px
+    if TAPER_HEIGHTS_M:
+        results["taper"] = [
+            {"height_m": h, "diameter_cm": w * scale_cm_per_px} for h, w in zip(TAPER_HEIGHTS_M, widths_px[1:])
+        ]
+
+
+def report_dbh_failure(results: dict, e: Exception):
+    print(f"❌ Detectron2 Error: {e}")
+    traceback.print_exc()
+    results["warnings"].append(f"Detectron2 failed: {str(e)}")
+
+
+@dataclass
+class ExecutionPlan:
+    """
+    What one request still has to compute, given its override boxes and the cache.
+    A detector runs only when the request needs its output and it isn't cached. The
+    shape comes from the file header, a frame is decoded (at `detect_factor`) only for
+    a detector, and the trunk crop is decoded at full resolution on its own.
+    """
+    key: str
+    shape: Optional[tuple] = None
+    person_dets: Optional[list] = None
+    tree_dets: Optional[list] = None
+    run_person: bool = False
+    run_tree: bool = False
+    detect_factor: int = 1
+
+    @property
+    def needs_frame(self) -> bool:
+        return self.run_person or self.run_tree
+
+
+def make_plan(req: AnalysisRequest) -> ExecutionPlan:
+    """Raises InvalidImageError if the upload isn't a readable image."""
+    with STAGE_SECONDS.time(stage="plan"):
+        return _make_plan(req)
+
+
+def _make_plan(req: AnalysisRequest) -> ExecutionPlan:
+    plan = ExecutionPlan(image_key(req.img_bytes))
+    plan.shape = detection_cache.get(("shape", plan.key))
+    if plan.shape is None:
+        plan.shape = probe_shape(req.img_bytes)
+        detection_cache.put(("shape", plan.key), plan.shape)
+    if not req.override_person_box and "yolo_person" in models:
+        plan.person_dets = detection_cache.get(("person", plan.key))
+        plan.run_person = plan.person_dets is None
+    # Without a person there is no scale, and then the tree isn't needed either
+    has_scale = bool(req.override_person_box) or "yolo_person" in models
+    if has_scale and not req.override_tree_box and "yolo_tree" in models:
+        plan.tree_dets = detection_cache.get(("tree", plan.key))
+        plan.run_tree = plan.tree_dets is None
+    if plan.needs_frame:
+        plan.detect_factor = detection_factor(req.img_bytes, plan.shape)
+    return plan
+
+
+def detection_factor(img_bytes: bytes, shape: tuple) -> int:
+    # A reduced frame can't supply the trunk crop; if the crop can't be decoded on its
+    # own either, decode the full frame once and let it serve both.
+    if models.get("perceptree") is not None and not region_decodable(img_bytes):
+        return 1
+    if needs_tiles(shape, TILE_GRID, TILE_MIN_SIDE):
+        return reduced_decode_factor(shape, DETECT_MIN_SIDE * max(TILE_GRID))
+    return reduced_decode_factor(shape, DETECT_MIN_SIDE)
+
+
+def decode_frame(req: AnalysisRequest, plan: ExecutionPlan) -> DetectionFrame:
+    with STAGE_SECONDS.time(stage="decode"):
+        return decode_for_detection(req.img_bytes, plan.shape, plan.detect_factor)
+
+
+def trunk_crop(req: AnalysisRequest, plan: ExecutionPlan, frame: Optional[DetectionFrame], crop: TrunkCrop) -> TrunkInput:
+    with STAGE_SECONDS.time(stage="crop"):
+        if frame is not None and plan.detect_factor == 1:
+            img = cut_crop(frame.image, crop.box)
         else:
-             # Fallback: No mask, use BBox
-             print("⚠️ No mask output, falling back to BBox.")
-             box = best_inst.pred_boxes[0].tensor.cpu().numpy()[0]
-             final_width_px = box[2] - box[0]
+            img = decode_region(req.img_bytes, crop.box)
+        return TrunkInput(upsample(img, crop.scale), crop.model_scale)
 
-        results["dbh_cm"] = final_width_px * scale_cm_per_px
 
-    except Exception as e:
-        print(f"❌ Detectron2 Error: {e}")
-        traceback.print_exc()
-        results["warnings"].append(f"Detectron2 failed: {str(e)}")
+# What PercepTree has to measure: (result the DBH goes into, crop, ground row of that tree)
+TrunkTarget = Tuple[dict, TrunkCrop, int]
+
+
+def plan_trees(
+    results: dict,
+    req: AnalysisRequest,
+    plan: ExecutionPlan,
+    tree_dets: Optional[list],
+    person_box: np.ndarray,
+    scale_cm_per_px: float,
+) -> List[TrunkTarget]:
+    """
+    Fill in the tree of a request and, in multi-tree mode, one entry of results["trees"]
+    per detected tree, and return the trunk crops to measure them on.
+
+    The person stands by the main tree, so it is measured from the person's feet; every
+    other tree from the bottom of its own box. All of them share the person's scale, so
+    their sizes hold for trees about as far from the camera as the person.
+    """
+    ground_y = int(person_box[3])
+    if req.override_tree_box:
+        tree_box = np.array(req.override_tree_box, dtype=int)
+    else:
+        tree_box = choose_tree_box(tree_dets or [])
+    targets = []
+    crop_box = plan_trunk_crop(results, plan.shape, tree_box, scale_cm_per_px, ground_y)
+    if crop_box is not None:
+        targets.append((results, crop_box, ground_y))
+    if not req.multi_tree:
+        return targets
+
+    results["trees"] = []
+    for conf, box in choose_trees(tree_dets or []):
+        tree = {"confidence": conf, "tree_height_m": 0.0, "dbh_cm": 0.0, "boxes": {"tree": None}, "warnings": []}
+        results["trees"].append(tree)
+        tree_ground = ground_y if tree_box is not None and np.array_equal(box, tree_box) else int(box[3])
+        crop_box = plan_trunk_crop(tree, plan.shape, box, scale_cm_per_px, tree_ground)
+        if crop_box is not None:
+            targets.append((tree, crop_box, tree_ground))
+    return targets
+
+
+def analyze_batch(requests: List[AnalysisRequest]) -> list:
+    """
+    Analyze a batch of uploads, running each model stage once for the whole batch.
+    Returns one result dict per request (or the exception that request failed with).
+    Each request only runs the stages its ExecutionPlan asks for.
+    """
+    outputs: list = [None] * len(requests)
+    plans: Dict[int, ExecutionPlan] = {}
+    imgs: Dict[int, DetectionFrame] = {}
+    # Every step covers the whole batch, so all requests share one breakdown
+    timer = RequestTimer()
+
+    # 1. Decode Images (only those a detector has to see; the rest just read their header)
+    for i, req in enumerate(requests):
+        try:
+            with timer.step("decode"):
+                plan = make_plan(req)
+                if plan.needs_frame:
+                    imgs[i] = decode_frame(req, plan)
+        except InvalidImageError as e:
+            outputs[i] = e
+            continue
+        plans[i] = plan
+        outputs[i] = new_result()
+
+    # 2. Find Person (Reference)
+    need_person = [i for i in plans if plans[i].run_person]
+    with timer.step("person"):
+        person_dets = detect_persons([imgs[i] for i in need_person])
+    for i, boxes in zip(need_person, person_dets):
+        detection_cache.put(("person", plans[i].key), boxes)
+        plans[i].person_dets = boxes
 
+    # From here on, what goes wrong with one request's geometry only fails that request
+    person_boxes: Dict[int, np.ndarray] = {}
+    scales: Dict[int, float] = {}
+    for i, plan in plans.items():
+        try:
+            if requests[i].override_person_box:
+                person_boxes[i] = np.array(requests[i].override_person_box, dtype=int)
+            elif plan.person_dets is not None:
+                person_boxes[i] = choose_person_box(plan.person_dets, plan.shape, outputs[i])
+            else:
+                continue  # Cannot calculate anything without scale
+            scales[i] = person_scale(outputs[i], person_boxes[i], requests[i].real_human_height)
+        except Exception as e:
+            outputs[i] = e
+
+    # 3. Find Tree (Target)
+    need_tree = [i for i in scales if plans[i].run_tree]
+    with timer.step("tree"):
+        tree_dets = detect_trees([imgs[i] for i in need_tree])
+    for i, candidates in zip(need_tree, tree_dets):
+        detection_cache.put(("tree", plans[i].key), candidates)
+        plans[i].tree_dets = candidates
+
+    targets: List[Tuple[int, TrunkTarget]] = []
+    for i in scales:
+        try:
+            trees = plan_trees(outputs[i], requests[i], plans[i], plans[i].tree_dets, person_boxes[i], scales[i])
+        except Exception as e:
+            outputs[i] = e
+            continue
+        targets.extend((i, target) for target in trees)
+
+    # 4. INFERENCE: the trunk crops of all trees of the batch together, each crop once
+    # (a second pass on the whole tree crop for bands that showed no trunk)
+    pending = targets
+    while pending:
+        profiles: Dict[tuple, object] = {}
+        crops: Dict[tuple, TrunkInput] = {}
+        for i, (_, crop_box, _) in pending:
+            key = ("trunk", plans[i].key, crop_box)
+            if key in profiles or key in crops or isinstance(outputs[i], Exception):
+                continue
+            profile = detection_cache.get(key)
+            if profile is not None:
+                profiles[key] = profile
+                continue
+            try:
+                with timer.step("crop"):
+                    crops[key] = trunk_crop(requests[i], plans[i], imgs.get(i), crop_box)
+            except InvalidImageError as e:
+                outputs[i] = e
+        keys = list(crops)
+        for start in range(0, len(keys), TRUNK_BATCH_SIZE):
+            chunk = keys[start:start + TRUNK_BATCH_SIZE]
+            try:
+                with timer.step("trunk"):
+                    found = profile_trunks([crops[key] for key in chunk])
+                for key, profile in zip(chunk, found):
+                    profiles[key] = profile
+                    detection_cache.put(key, profile)
+            except Exception as e:
+                profiles.update((key, e) for key in chunk)
+
+        retry = []
+        for i, (result, crop_box, ground_y) in pending:
+            if isinstance(outputs[i], Exception):
+                continue
+            profile = profiles[("trunk", plans[i].key, crop_box)]
+            if isinstance(profile, Exception):
+                report_dbh_failure(result, profile)
+            elif not profile.found and crop_box.fallback is not None:
+                retry.append((i, (result, crop_box.fallback, ground_y)))
+            else:
+                try:
+                    finish_dbh(result, profile, crop_box, ground_y, scales[i])
+                except Exception as e:
+                    outputs[i] = e
+        pending = retry
+
+    for i, req in enumerate(requests):
+        if req.debug and isinstance(outputs[i], dict):
+            outputs[i]["timings_ms"] = timer.as_ms()
+    return outputs
+
+
+def analyze_image(
+    img_bytes: bytes, real_human_height: float, override_person_box=None, override_tree_box=None, multi_tree=False
+) -> dict:
+    req = AnalysisRequest(img_bytes, real_human_height, override_person_box, override_tree_box, multi_tree=multi_tree)
+    result = analyze_batch([req])[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def decode_batch(items: List[Tuple[AnalysisRequest, ExecutionPlan, Optional[TrunkCrop]]]) -> list:
+    """Decode stage: items are (request, plan, None) for a detection frame or (request, plan, trunk crop)."""
+    out = []
+    for req, plan, box in items:
+        try:
+            if box is None:
+                out.append(decode_frame(req, plan))
+            else:
+                out.append(trunk_crop(req, plan, None, box))
+        except InvalidImageError as e:
+            out.append(e)
+    return out
+
+
+async def analyze_pipelined(req: AnalysisRequest) -> dict:
+    """
+    Analyze one upload on the stage pipeline. Every stage batches and runs on its own
+    worker, so this request's trunk stage overlaps with other requests' detection stages.
+    Only the stages its ExecutionPlan asks for are run.
+    """
+    timer = RequestTimer()
+    results = await _analyze_pipelined(req, timer)
+    if req.debug:
+        results["timings_ms"] = timer.as_ms()
     return results
 
+
+async def _analyze_pipelined(req: AnalysisRequest, timer: RequestTimer) -> dict:
+    with timer.step("plan"):
+        plan = await asyncio.to_thread(make_plan, req)  # hashing a large upload releases the GIL
+    img = None
+    if plan.needs_frame:
+        with timer.step("decode"):
+            img = await pipeline["decode"].submit((req, plan, None))
+    results = new_result()
+
+    async def detect(kind: str) -> list:
+        with timer.step(kind):
+            dets = await pipeline[kind].submit(img)
+        detection_cache.put((kind, plan.key), dets)
+        return dets
+
+    # 2 + 3. Person and Tree detection run concurrently on the same frame
+    person_job = detect("person") if plan.run_person else asyncio.sleep(0, plan.person_dets)
+    tree_job = detect("tree") if plan.run_tree else asyncio.sleep(0, plan.tree_dets)
+    person_dets, tree_dets = await asyncio.gather(person_job, tree_job)
+
+    if req.override_person_box:
+        person_box = np.array(req.override_person_box, dtype=int)
+    elif person_dets is not None:
+        person_box = choose_person_box(person_dets, plan.shape, results)
+    else:
+        # Cannot calculate anything without scale
+        return results
+    scale_cm_per_px = person_scale(results, person_box, req.real_human_height)
+
+    targets = plan_trees(results, req, plan, tree_dets, person_box, scale_cm_per_px)
+
+    # 4. INFERENCE: all crops go to the trunk stage at once, which batches them
+    profiles: Dict[TrunkCrop, asyncio.Future] = {}
+
+    async def profile_crop(crop_box: TrunkCrop) -> TrunkProfile:
+        profile = detection_cache.get(("trunk", plan.key, crop_box))
+        if profile is None:
+            with timer.step("crop"):
+                if img is not None and plan.detect_factor == 1:
+                    crop = trunk_crop(req, plan, img, crop_box)
+                else:
+                    crop = await pipeline["decode"].submit((req, plan, crop_box))
+            with timer.step("trunk"):
+                profile = await pipeline["trunk"].submit(crop)
+            detection_cache.put(("trunk", plan.key, crop_box), profile)
+        return profile
+
+    async def measure(result: dict, crop_box: TrunkCrop, ground_y: int):
+        # Again on the whole tree crop if its breast-height band showed no trunk
+        while True:
+            if crop_box not in profiles:
+                profiles[crop_box] = asyncio.ensure_future(profile_crop(crop_box))
+            try:
+                profile = await profiles[crop_box]
+            except InvalidImageError:
+                raise
+            except Exception as e:
+                report_dbh_failure(result, e)
+                return
+            if profile.found or crop_box.fallback is None:
+                break
+            crop_box = crop_box.fallback
+        finish_dbh(result, profile, crop_box, ground_y, scale_cm_per_px)
+
+    await asyncio.gather(*(measure(*target) for target in targets))
+    return results
+
+
+def describe_error(e: Exception) -> Tuple[int, str]:
+    """HTTP status and message for an analysis that failed outside a /predict request."""
+    if isinstance(e, asyncio.TimeoutError):
+        return 504, f"Analysis timed out after {inference_executor.timeout_s:g}s."
+    if isinstance(e, UploadTooLargeError):
+        return 413, str(e)
+    if isinstance(e, (InvalidImageError, InvalidBoxError, zipfile.BadZipFile)):
+        return 400, str(e) or "Invalid image data."
+    print(f"❌ Server Error: {e}")
+    return 500, str(e)
+
+
+async def analyze_when_admitted(req: AnalysisRequest) -> dict:
+    """Like `inference_executor.run(analyze, req)`, but waits for room while the queue is full."""
+    while True:
+        try:
+            return await inference_executor.run(analyze, req)
+        except QueueFullError as e:
+            await asyncio.sleep(e.retry_after)
+
+
+def next_video_frame(frames: Iterator, prev_gray: Optional[np.ndarray], boxes: Optional[list]) -> Optional[tuple]:
+    """
+    The next sampled (time, frame) of a clip, its tracking frame, and `boxes` tracked from
+    the previous tracking frame into it (None if there was nothing to track or a box was lost).
+    """
+    item = next(frames, None)
+    if item is None:
+        return None
+    t, frame = item
+    gray, scale = tracking_frame(frame)
+    tracked = None
+    if boxes is not None and prev_gray is not None:
+        h, w = frame.shape[:2]
+        tracked = [track_box(prev_gray, gray, box, scale) for box in boxes]
+        if any(box is None for box in tracked):
+            tracked = None
+        else:
+            tracked = [np.clip(box, 0, [w, h, w, h]).astype(int) for box in tracked]
+    return t, frame, gray, tracked
+
+
+def encode_frame(frame: np.ndarray) -> bytes:
+    ok, buf = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, VIDEO_JPEG_QUALITY])
+    if not ok:
+        raise InvalidImageError("Could not encode a video frame.")
+    return buf.tobytes()
+
+
+def detected_boxes(result: Optional[dict]) -> Optional[list]:
+    """The person and tree boxes a keyframe's detectors found, to be tracked; None if either is missing."""
+    if result is None or PERSON_NOT_FOUND in result["warnings"] or result["boxes"]["tree"] is None:
+        return None
+    return [np.array(result["boxes"]["person"]), np.array(result["boxes"]["tree"])]
+
+
+async def analyze_video(path: str, person_height: float) -> dict:
+    """
+    Measure the tree of a clip (see VIDEO_SAMPLE_FPS): frames are read and tracked in
+    order, keyframes analyzed as they come and the tracked frames in between analyzed
+    concurrently, each as its own request through the inference queue.
+    """
+    frames = iter(FrameSampler(path, VIDEO_SAMPLE_FPS, VIDEO_MAX_FRAMES))
+    records: List[dict] = []
+    tasks = []
+    in_flight = asyncio.Semaphore(BATCH_MAX_IN_FLIGHT)
+
+    async def analyze_frame(record: dict, frame: np.ndarray, boxes: Optional[list] = None) -> Optional[dict]:
+        async with in_flight:
+            img_bytes = await asyncio.to_thread(encode_frame, frame)
+            person_box, tree_box = [b.tolist() for b in boxes] if boxes else (None, None)
+            try:
+                result = await analyze_when_admitted(AnalysisRequest(img_bytes, person_height, person_box, tree_box))
+            except Exception as e:
+                record["error"] = describe_error(e)[1]
+                return None
+        record.update(analyzed=True, tree_height_m=result["tree_height_m"], dbh_cm=result["dbh_cm"])
+        if result["warnings"]:
+            record["warnings"] = result["warnings"]
+        return result
+
+    boxes = analyzed_boxes = prev_gray = None
+    since_keyframe = 0
+    while True:
+        step = await asyncio.to_thread(next_video_frame, frames, prev_gray, boxes)
+        if step is None:
+            break
+        t, frame, prev_gray, tracked = step
+        record = {"t": round(t, 3), "keyframe": False, "analyzed": False}
+        records.append(record)
+        if tracked is None or since_keyframe >= VIDEO_KEYFRAME_INTERVAL:
+            record["keyframe"] = True
+            boxes = analyzed_boxes = detected_boxes(await analyze_frame(record, frame))
+            since_keyframe = 1
+            continue
+        boxes = tracked
+        since_keyframe += 1
+        if all(box_iou(a, b) >= VIDEO_REUSE_IOU for a, b in zip(tracked, analyzed_boxes)):
+            continue  # the same view as the last analyzed frame
+        analyzed_boxes = tracked
+        tasks.append(asyncio.create_task(analyze_frame(record, frame, tracked)))
+    await asyncio.gather(*tasks)
+
+    heights = [r["tree_height_m"] for r in records if r.get("tree_height_m")]
+    dbhs = [r["dbh_cm"] for r in records if r.get("dbh_cm")]
+    height, dbh = robust_summary(heights), robust_summary(dbhs)
+    warnings = []
+    if not records:
+        warnings.append("No frames could be read from the video.")
+    elif not dbhs:
+        warnings.append("No frame gave a DBH measurement.")
+    return {
+        "tree_height_m": height["median"],
+        "dbh_cm": dbh["median"],
+        "tree_height_stats": height,
+        "dbh_stats": dbh,
+        "frames": {
+            "sampled": len(records),
+            "keyframes": sum(r["keyframe"] for r in records),
+            "analyzed": sum(r["analyzed"] for r in records),
+        },
+        "per_frame": records,
+        "warnings": warnings,
+    }
+
+
+async def run_job(params: dict, payload: bytes) -> dict:
+    req = AnalysisRequest(
+        payload, params["person_height"], params.get("person_box"), params.get("tree_box"),
+        multi_tree=params.get("multi_tree", False),
+    )
+    return jsonable_encoder(await analyze_when_admitted(req))
+
+
+detection_cache = DetectionCache(CACHE_MAX_ENTRIES, CACHE_TTL_S, int(CACHE_MAX_MB * 1024 ** 2))
+batch_jobs = BatchJobStore(BATCH_MAX_JOBS, BATCH_JOB_TTL_S)
+job_queue = JobQueue(
+    JOB_DB_PATH, run_job, describe_error, workers=JOB_WORKERS, max_queued=JOB_MAX_QUEUED, ttl_s=JOB_TTL_S
+)
+inference_executor = InferenceExecutor(
+    INFERENCE_WORKERS, INFERENCE_MAX_QUEUE, INFERENCE_TIMEOUT_S, INFERENCE_POOL, initializer=start_worker
+)
+if INFERENCE_ENGINE == "pipeline":
+    pipeline = Pipeline({
+        "decode": Stage(decode_batch, MAX_BATCH_SIZE, 0, "decode", workers=DECODE_WORKERS, on_batch=observe_batch),
+        "person": Stage(detect_persons, MAX_BATCH_SIZE, MAX_BATCH_WAIT_MS, "person", on_batch=observe_batch),
+        "tree": Stage(detect_trees, MAX_BATCH_SIZE, MAX_BATCH_WAIT_MS, "tree", on_batch=observe_batch),
+        "trunk": Stage(profile_trunks, TRUNK_BATCH_SIZE, MAX_BATCH_WAIT_MS, "trunk", on_batch=observe_batch),
+    })
+    analyze = analyze_pipelined
+else:
+    batcher = MicroBatcher(
+        analyze_batch, MAX_BATCH_SIZE, MAX_BATCH_WAIT_MS, name="analyze", concurrency=INFERENCE_WORKERS,
+        on_batch=observe_batch,
+    )
+    analyze = batcher.submit
+
+
 # --- ROUTES ---
+async def read_upload(file: UploadFile) -> bytearray:
+    """The uploaded image, size-capped and checked to be an image before it is read into memory."""
+    return await asyncio.to_thread(read_image_file, file.file, int(MAX_UPLOAD_MB * 2**20), file.size)
+
+
+class InvalidBoxError(ValueError):
+    pass
+
+
+def parse_box(text: Optional[str], name: str) -> Optional[list]:
+    """A box form field, JSON [x1, y1, x2, y2] with x2 > x1 and y2 > y1; None if it is empty."""
+    if not text:
+        return None
+    try:
+        box = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise InvalidBoxError(f"Invalid {name}: {e}")
+    numbers = isinstance(box, list) and len(box) == 4 and all(
+        isinstance(v, (int, float)) and not isinstance(v, bool) and math.isfinite(v) for v in box
+    )
+    if not numbers or box[2] <= box[0] or box[3] <= box[1]:
+        raise InvalidBoxError(f"Invalid {name}: expected [x1, y1, x2, y2] with x2 > x1 and y2 > y1, got {text}")
+    return box
+
 @app.post("/predict")
 async def predict(
     file: UploadFile = File(...),
     person_box: str = Form(None),
     tree_box: str = Form(None),
-    person_height: float = Form(170.0) # Nhận chiều cao người từ Client (mặc định 170cm)
+    person_height: float = Form(170.0), # Nhận chiều cao người từ Client (mặc định 170cm)
+    multi_tree: bool = Form(False), # also measure every other tree in the photo, under "trees"
+    debug: bool = False, # ?debug=true: add a per-step timing breakdown (ms) to the result
 ):
+    start = time.perf_counter()
     try:
-        content = await file.read()
-        p_box = json.loads(person_box) if person_box else None
-        t_box = json.loads(tree_box) if tree_box else None
+        content = await read_upload(file)
+        p_box = parse_box(person_box, "person_box")
+        t_box = parse_box(tree_box, "tree_box")
         
         # Truyền chiều cao người vào hàm phân tích
-        return analyze_image(content, person_height, p_box, t_box)
+        req = AnalysisRequest(content, person_height, p_box, t_box, debug=debug, multi_tree=multi_tree)
+        results = await inference_executor.run(analyze, req)
+        if debug:
+            results.setdefault("timings_ms", {})["total"] = round((time.perf_counter() - start) * 1000.0, 2)
+        return results
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=f"Analysis timed out after {inference_executor.timeout_s:g}s.")
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except (InvalidImageError, InvalidBoxError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         print(f"❌ Server Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/predict_video")
+async def predict_video(
+    file: UploadFile = File(...),
+    person_height: float = Form(170.0),
+):
+    """
+    Measure a tree from a short clip with the person standing next to it (see VIDEO_SAMPLE_FPS):
+    robust height and DBH over the frames, plus what was measured on each analyzed frame.
+    """
+    with tempfile.NamedTemporaryFile(prefix="perceptree_", suffix=".video", delete=False) as dst:
+        path = dst.name
+    try:
+        with open(path, "wb") as dst:
+            await asyncio.to_thread(copy_video_file, file.file, dst, int(VIDEO_MAX_UPLOAD_MB * 2**20), file.size)
+        return await analyze_video(path, person_height)
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:  # not a video (InvalidImageError), or one OpenCV can't open
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        os.remove(path)
+
+async def analyze_item(item: BatchItem, person_height: float, multi_tree: bool = False) -> dict:
+    """Analyze one image of a batch and describe the outcome as one NDJSON line."""
+    line = {"name": item.name}
+    try:
+        req = AnalysisRequest(await asyncio.to_thread(item.read), person_height, multi_tree=multi_tree)
+        line.update(status="ok", result=await analyze_when_admitted(req))
+    except Exception as e:
+        code, detail = describe_error(e)
+        line.update(status="error", code=code, detail=detail)
+    return line
+
+
+async def stream_batch(job: BatchJob, items: List[BatchItem], person_height: float, multi_tree: bool = False):
+    """
+    Yield NDJSON: a header line, one line per image as soon as it is finished (not in
+    upload order), then a summary. Images this job already analyzed are replayed
+    from the job instead of being run again. "total" counts the images of the whole
+    job, including those of earlier uploads that this one doesn't repeat.
+    """
+    total = job.total(item.name for item in items)
+    yield json.dumps({"job_id": job.job_id, "total": total}) + "\n"
+
+    todo = []
+    for item in items:
+        if job.done(item.name):
+            yield json.dumps({**job.results[item.name], "resumed": True}) + "\n"
+        else:
+            todo.append(item)
+
+    # Start at most BATCH_MAX_IN_FLIGHT images at a time so one large upload can't hold
+    # the whole inference queue, yet keeps enough in flight to fill every batch.
+    pending = set()
+    todo.reverse()
+    try:
+        while todo or pending:
+            while todo and len(pending) < BATCH_MAX_IN_FLIGHT:
+                pending.add(asyncio.create_task(analyze_item(todo.pop(), person_height, multi_tree)))
+            finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                line = jsonable_encoder(task.result())
+                job.record(line["name"], line)
+                yield json.dumps(line) + "\n"
+    finally:
+        # The client went away: what finished stays recorded for a resumed upload
+        for task in pending:
+            task.cancel()
+
+    yield json.dumps({**job.summary(), "total": total}) + "\n"
+
+
+@app.post("/predict_batch")
+async def predict_batch(
+    files: List[UploadFile] = File(...),
+    person_height: float = Form(170.0),
+    multi_tree: bool = Form(False),
+    job_id: str = Form(None),
+):
+    """
+    Analyze many images in one request: any number of image files and/or ZIP archives
+    of images. Results are streamed back as NDJSON as each image finishes. Sending the
+    `job_id` from the first line again resumes the job: images that already succeeded
+    are not analyzed again.
+    """
+    try:
+        items = expand_uploads(((f.filename, f.file) for f in files), int(MAX_UPLOAD_MB * 2**20))
+    except zipfile.BadZipFile as e:
+        raise HTTPException(status_code=400, detail=f"Invalid ZIP archive: {e}")
+    if not items:
+        raise HTTPException(status_code=400, detail="No images in the upload.")
+    job = batch_jobs.get_or_create(job_id)
+    return StreamingResponse(stream_batch(job, items, person_height, multi_tree), media_type="application/x-ndjson")
+
+@app.get("/predict_batch/{job_id}")
+def batch_job_status(job_id: str):
+    job = batch_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job id.")
+    return {**job.summary(), "results": list(job.results.values())}
+
+@app.post("/jobs", status_code=202)
+async def submit_job(
+    file: UploadFile = File(...),
+    person_box: str = Form(None),
+    tree_box: str = Form(None),
+    person_height: float = Form(170.0),
+    multi_tree: bool = Form(False),
+):
+    """Queue an analysis and return its job id right away; poll GET /jobs/{job_id} for the result."""
+    try:
+        content = await read_upload(file)
+        params = {
+            "person_height": person_height,
+            "person_box": parse_box(person_box, "person_box"),
+            "tree_box": parse_box(tree_box, "tree_box"),
+            "multi_tree": multi_tree,
+        }
+        return await job_queue.submit(params, content)
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except (InvalidImageError, InvalidBoxError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+
+@app.get("/jobs")
+async def job_counts():
+    return await job_queue.counts()
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str, wait: float = 0.0):
+    """Status of a job, with its result once done. `wait` (s) holds the request until the job finishes."""
+    status = await job_queue.wait(job_id, min(max(wait, 0.0), JOB_MAX_WAIT_S))
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job id.")
+    return status
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    counts = await job_queue.counts()
+    for status in ("queued", "running"):
+        QUEUE_DEPTH.set(counts.get(status, 0), queue=f"jobs_{status}")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache/stats")
+def cache_stats():
+    return detection_cache.stats()
+
+@app.get("/ready")
+def ready():
+    """Readiness probe: 503 until the models are loaded and warmed up."""
+    if not readiness.ready:
+        raise HTTPException(status_code=503, detail=readiness.as_dict())
+    return readiness.as_dict()
+
 @app.get("/")
 def root():
     return {"status": "ok", "message": "PercepTree API is running."}
\ No newline at end of file
@@ -0,0 +1,91 @@
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+
+def row_extents(mask: torch.Tensor, rows: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Leftmost and rightmost foreground column of each row of a (H, W) mask, or of
+    the given `rows` only. Rows without foreground get -1 for both.
+
+    Everything runs on the mask's device with argmax reductions, so only the two
+    index vectors ever need to leave it.
+    """
+    band = mask if rows is None else mask.index_select(0, rows.to(mask.device))
+    present = band.bool().any(dim=1)
+    band = band.to(torch.uint8)
+    width = band.shape[1]
+    # argmax returns the first maximum: the first foreground pixel from either side
+    left = band.argmax(dim=1)
+    right = width - 1 - band.flip(1).argmax(dim=1)
+    missing = torch.full_like(left, -1)
+    return torch.where(present, left, missing), torch.where(present, right, missing)
+
+
+def band_widths(left: np.ndarray, right: np.ndarray, ys: Sequence[int], half_h: int = 2) -> List[Optional[float]]:
+    """
+    Mean foreground width over rows [y - half_h, y + half_h] for each y, computed from
+    per-row extents. Each y is clamped into the mask first; rows past the mask edge and
+    empty rows are skipped, and a band with no foreground gives None.
+    """
+    n_rows = len(left)
+    if n_rows == 0:
+        return [None] * len(ys)
+    centers = np.clip(np.asarray(ys, dtype=int), 0, n_rows - 1)
+    rows = centers[:, None] + np.arange(-half_h, half_h + 1)[None, :]  # (K, 2*half_h + 1)
+    inside = (rows >= 0) & (rows < n_rows)
+    rows = np.clip(rows, 0, n_rows - 1)
+    # +1 because width includes both ends
+    widths = (right[rows] - left[rows] + 1).astype(np.float64)
+    valid = inside & (left[rows] >= 0)
+    counts = valid.sum(axis=1)
+    sums = np.where(valid, widths, 0.0).sum(axis=1)
+    return [float(s / c) if c > 0 else None for s, c in zip(sums, counts)]
+
+
+@dataclass
+class TrunkProfile:
+    """
+    What DBH measurement needs from one PercepTree result: the width of the best
+    instance's box and the per-row extents of its mask (None if it has no mask).
+    A profile of a crop where nothing was found has no box width.
+
+    The mask may be pasted already, or still be the ROIMasks of an unpasted result,
+    whose extents are computed without rasterizing it.
+    """
+    box_width: Optional[float] = None
+    left: Optional[np.ndarray] = None
+    right: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_instances(cls, instances) -> "TrunkProfile":
+        """Profile of the highest-scoring instance (Detectron2 sorts by score)."""
+        if len(instances) == 0:
+            return cls()
+        box = instances.pred_boxes.tensor[0]
+        profile = cls(box_width=float(box[2] - box[0]))
+        if instances.has("pred_masks"):
+            masks = instances.pred_masks
+            if hasattr(masks, "row_extents"):  # ROIMasks
+                height, width = instances.image_size
+                rows = torch.arange(height, device=masks.device)
+                left, right = (e[0] for e in masks[:1].row_extents(instances.pred_boxes[:1], rows, width))
+            else:
+                left, right = row_extents(masks[0])
+            profile.left, profile.right = left.cpu().numpy(), right.cpu().numpy()
+        return profile
+
+    @property
+    def found(self) -> bool:
+        return self.box_width is not None
+
+    @property
+    def has_mask(self) -> bool:
+        return self.left is not None
+
+    def widths_at(self, ys: Sequence[int], half_h: int = 2) -> List[Optional[float]]:
+        if not self.has_mask:
+            return [None] * len(ys)
+        return band_widths(self.left, self.right, ys, half_h)
@@ -0,0 +1,183 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# --- OPTIONAL: peak RSS (not available on Windows) ---
+try:
+    import resource
+except ImportError:
+    resource = None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(**labels) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format(name: str, labels: Iterable[Tuple[str, str]], value: float) -> str:
+    labels = list(labels)
+    if labels:
+        escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+        name += "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+    if math.isinf(value):
+        return f"{name} {'+Inf' if value > 0 else '-Inf'}"
+    value = float(value)
+    return f"{name} {int(value)}" if value.is_integer() else f"{name} {value!r}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        return lines + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = _labels(**labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            return [_format(self.name, key, v) for key, v in sorted(self._values.items())]
+
+
+class Gauge(Metric):
+    """A gauge that is either set directly or read from `collect()` at scrape time."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, collect: Optional[Callable[[], Iterable[Tuple[Dict[str, str], float]]]] = None):
+        super().__init__(name, help)
+        self.collect = collect
+        self._values: Dict[Labels, float] = {}
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[_labels(**labels)] = value
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        if self.collect is not None:
+            for labels, value in self.collect():
+                values[_labels(**labels)] = value
+        return [_format(self.name, key, v) for key, v in sorted(values.items())]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+        self._counts: Dict[Labels, List[int]] = {}  # per bucket, not cumulative; last one is +Inf
+        self._sums: Dict[Labels, float] = {}
+
+    def observe(self, value: float, **labels):
+        key = _labels(**labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sums[key] = self._sums.get(key, 0.0) + value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key in sorted(self._counts):
+                total = 0
+                for bound, count in zip(self.buckets + (math.inf,), self._counts[key]):
+                    total += count
+                    le = "+Inf" if math.isinf(bound) else f"{bound:g}"
+                    lines.append(_format(f"{self.name}_bucket", key + (("le", le),), total))
+                lines.append(_format(f"{self.name}_sum", key, self._sums[key]))
+                lines.append(_format(f"{self.name}_count", key, total))
+        return lines
+
+
+class MetricsRegistry:
+    """The metrics of one process, rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def _add(self, metric: Metric):
+        assert metric.name not in self._metrics, metric.name
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._add(Counter(name, help))
+
+    def gauge(self, name: str, help: str, collect=None) -> Gauge:
+        return self._add(Gauge(name, help, collect))
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, buckets))
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self._metrics.values() for line in metric.render()) + "\n"
+
+
+class RequestTimer:
+    """How long each step of one request took, waiting for its batch included."""
+
+    def __init__(self):
+        self.timings: Dict[str, float] = {}
+
+    @contextmanager
+    def step(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+    def as_ms(self) -> Dict[str, float]:
+        return {name: round(seconds * 1000.0, 2) for name, seconds in self.timings.items()}
+
+
+def memory_high_water() -> List[Tuple[Dict[str, str], float]]:
+    """Peak bytes allocated per CUDA device, and peak resident memory of this process."""
+    samples = []
+    try:
+        import torch
+        if torch.cuda.is_available():
+            for d in range(torch.cuda.device_count()):
+                samples.append(({"device": f"cuda:{d}"}, float(torch.cuda.max_memory_allocated(d))))
+    except Exception:
+        pass
+    if resource is not None:
+        # ru_maxrss is in KiB on Linux
+        samples.append(({"device": "cpu"}, float(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)))
+    return samples
@@ -0,0 +1,59 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from .batching import MicroBatcher
+
+
+class Stage(MicroBatcher):
+    """
+    One step of a `Pipeline`: a MicroBatcher with its own queue and its own worker
+    threads, so it runs concurrently with the other stages. A model that is only
+    used by one single-worker stage is only ever called from one thread.
+    """
+
+    def __init__(
+        self,
+        batch_fn: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        name: str = "stage",
+        workers: int = 1,
+        on_batch: Optional[Callable[[str, int, float], None]] = None,
+    ):
+        super().__init__(batch_fn, max_batch_size, max_wait_ms, name=name, concurrency=workers, on_batch=on_batch)
+        self._pool: Optional[ThreadPoolExecutor] = None
+
+    async def start(self, executor=None):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self.concurrency, thread_name_prefix=self.name)
+        await super().start(executor or self._pool)
+
+    async def stop(self):
+        await super().stop()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+class Pipeline:
+    """
+    A set of named stages that are started and stopped together. How a request
+    moves between the stages is up to the caller, which awaits `pipeline[name].submit`.
+    """
+
+    def __init__(self, stages: Dict[str, Stage]):
+        self.stages = stages
+
+    def __getitem__(self, name: str) -> Stage:
+        return self.stages[name]
+
+    async def start(self):
+        for stage in self.stages.values():
+            await stage.start()
+
+    async def stop(self):
+        for stage in self.stages.values():
+            await stage.stop()
+
+    def queue_depths(self) -> Dict[str, int]:
+        return {name: stage.qsize() for name, stage in self.stages.items()}
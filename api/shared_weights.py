@@ -0,0 +1,62 @@
+import ctypes
+import ctypes.util
+import os
+from typing import Dict, Optional
+
+import cv2
+import torch
+from torch import nn
+
+SharedState = Dict[str, torch.Tensor]
+
+
+def share_weights(module: nn.Module) -> SharedState:
+    """
+    Move the parameters and buffers of `module` into shared memory, in place, and
+    return its state dict. Sent to a spawned process, the tensors in it are passed as
+    handles to the same memory rather than copied.
+    """
+    module.share_memory()
+    return module.state_dict()
+
+
+def attach_weights(module: nn.Module, state: SharedState):
+    """
+    Make `module` use the shared tensors of `state` instead of its own weights, which are
+    freed. `module` must have the structure the state was taken from. Inference never
+    writes to the weights, so all processes read the same pages.
+    """
+    module.load_state_dict(state, assign=True)
+
+
+def release_memory():
+    """
+    Hand memory freed by replaced weights back to the OS. glibc keeps freed blocks of
+    up to 32 MB in its heap, so without this the copies a process no longer uses would
+    still count towards its resident size. No-op on other C libraries.
+    """
+    libc = ctypes.util.find_library("c")
+    try:
+        ctypes.CDLL(libc).malloc_trim(0)
+    except (OSError, AttributeError, TypeError):
+        pass
+
+
+def shared_nbytes(state: SharedState) -> int:
+    return sum(t.numel() * t.element_size() for t in state.values())
+
+
+def limit_threads(num_threads: Optional[int] = None, workers: int = 1) -> int:
+    """
+    Cap the intra-op threads of torch and OpenCV in this process, by default to an equal
+    share of the cores for each of `workers` processes, so they don't oversubscribe the CPU.
+    """
+    if not num_threads:
+        num_threads = max(1, (os.cpu_count() or 1) // workers)
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(num_threads)
+    except RuntimeError:
+        pass  # only settable before the first parallel op
+    cv2.setNumThreads(num_threads)
+    return num_threads
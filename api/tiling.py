@@ -0,0 +1,135 @@
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .decode import DetectionFrame
+
+Detection = Tuple[float, np.ndarray]  # (confidence, full-resolution xyxy box)
+
+# A box this close (frame px) to a tile edge that lies inside the frame was cut off by the tile
+EDGE_MARGIN_PX = 2
+
+
+def parse_grid(spec: str) -> Optional[Tuple[int, int]]:
+    """ "3x2" → (3, 2), i.e. (columns, rows); "" → None."""
+    if not spec.strip():
+        return None
+    cols, rows = (int(n) for n in spec.lower().split("x"))
+    assert cols >= 1 and rows >= 1, spec
+    return cols, rows
+
+
+def tile_boxes(width: int, height: int, grid: Tuple[int, int], overlap: float) -> List[Tuple[int, int, int, int]]:
+    """
+    (x1, y1, x2, y2) of a columns x rows grid of equal tiles that covers a width x height
+    image, each overlapping its neighbours by `overlap` of a tile.
+    """
+    cols, rows = grid
+    tile_w = width / (cols - (cols - 1) * overlap)
+    tile_h = height / (rows - (rows - 1) * overlap)
+    boxes = []
+    for r in range(rows):
+        for c in range(cols):
+            x1, y1 = round(c * tile_w * (1 - overlap)), round(r * tile_h * (1 - overlap))
+            boxes.append((x1, y1, min(width, round(x1 + tile_w)), min(height, round(y1 + tile_h))))
+    return boxes
+
+
+def needs_tiles(shape: tuple, grid: Optional[Tuple[int, int]], min_side: int) -> bool:
+    """Whether an image of full-resolution `shape` is tiled."""
+    return grid is not None and grid != (1, 1) and max(shape[:2]) >= min_side
+
+
+def split_frame(frame: DetectionFrame, grid: Tuple[int, int], overlap: float) -> List[Tuple[DetectionFrame, tuple]]:
+    """
+    The frame itself, then its tiles, each with the tile edges that lie inside the frame
+    as (left, top, right, bottom) flags. Tiles keep the frame's resolution.
+    """
+    h, w = frame.image.shape[:2]
+    out = [(frame, (False, False, False, False))]
+    for x1, y1, x2, y2 in tile_boxes(w, h, grid, overlap):
+        tile = DetectionFrame(
+            np.ascontiguousarray(frame.image[y1:y2, x1:x2]),
+            frame.scale_x, frame.scale_y, frame.offset_x + x1, frame.offset_y + y1,
+        )
+        out.append((tile, (x1 > 0, y1 > 0, x2 < w, y2 < h)))
+    return out
+
+
+def _truncated(xyxy: np.ndarray, size: tuple, inner_edges: tuple) -> bool:
+    h, w = size
+    x1, y1, x2, y2 = xyxy
+    touches = (x1 <= EDGE_MARGIN_PX, y1 <= EDGE_MARGIN_PX, x2 >= w - EDGE_MARGIN_PX, y2 >= h - EDGE_MARGIN_PX)
+    return any(t and inner for t, inner in zip(touches, inner_edges))
+
+
+def _area(box: np.ndarray) -> float:
+    return float(max(0, box[2] - box[0]) * max(0, box[3] - box[1]))
+
+
+def _intersection(a: np.ndarray, b: np.ndarray) -> float:
+    return _area(np.concatenate([np.maximum(a[:2], b[:2]), np.minimum(a[2:], b[2:])]))
+
+
+def merge_detections(
+    dets: Sequence[Tuple[float, np.ndarray, bool]], iou_threshold: float = 0.5, ios_threshold: float = 0.6
+) -> List[Detection]:
+    """
+    Merge the (confidence, box, truncated) detections of a frame and its tiles.
+
+    Whole boxes go through NMS at `iou_threshold`. A box cut off at a tile edge is then
+    folded into the first kept box that covers at least `ios_threshold` of it, which
+    grows to the union of both; one that matches nothing is kept as it is.
+    """
+    kept: List[List] = []
+    for conf, box, truncated in sorted(dets, key=lambda d: (d[2], -d[0])):
+        match = None
+        for k in kept:
+            inter = _intersection(k[1], box)
+            if truncated:
+                if inter >= ios_threshold * min(_area(k[1]), _area(box)):
+                    match = k
+                    break
+            elif inter >= iou_threshold * (_area(k[1]) + _area(box) - inter):
+                match = k
+                break
+        if match is None:
+            kept.append([conf, box])
+        elif truncated:
+            match[1] = np.concatenate([np.minimum(match[1][:2], box[:2]), np.maximum(match[1][2:], box[2:])])
+    return [(conf, box) for conf, box in kept]
+
+
+def detect_tiled(
+    predict: Callable[[List[np.ndarray]], list],
+    frames: List[DetectionFrame],
+    grid: Optional[Tuple[int, int]],
+    overlap: float,
+    min_side: int,
+) -> List[List[Detection]]:
+    """
+    Run an Ultralytics model once over a batch of frames plus, for frames of at least
+    `min_side` full-resolution pixels, the tiles of `grid`; merge what the tiles of
+    each frame found. Returns (confidence, full-resolution box) detections per frame.
+    """
+    groups = []
+    for f in frames:
+        full_shape = (f.image.shape[0] * f.scale_y, f.image.shape[1] * f.scale_x)
+        groups.append(split_frame(f, grid, overlap) if needs_tiles(full_shape, grid, min_side) else [(f, None)])
+    flat = [item for group in groups for item in group]
+    results = predict([tile.image for tile, _ in flat])
+
+    out, k = [], 0
+    for group in groups:
+        dets = []
+        for tile, inner_edges in group:
+            for b in results[k].boxes:
+                xyxy = b.xyxy[0].cpu().numpy()
+                cut = inner_edges is not None and _truncated(xyxy, tile.image.shape[:2], inner_edges)
+                dets.append((float(b.conf[0]), tile.to_full_res(xyxy), cut))
+            k += 1
+        if len(group) == 1:
+            out.append([(conf, box) for conf, box, _ in dets])
+        else:
+            out.append(merge_detections(dets))
+    return out
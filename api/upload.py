@@ -0,0 +1,115 @@
+import io
+import os
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+from .decode import InvalidImageError
+
+READ_CHUNK_BYTES = 1 << 20
+# Enough of the file to recognize every format below
+MAGIC_BYTES = 12
+
+
+class UploadTooLargeError(ValueError):
+    pass
+
+
+def sniff_image(head: bytes) -> Optional[str]:
+    """Format of an image from its first MAGIC_BYTES bytes, None if it isn't one the decoder reads."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "JPEG"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "PNG"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    if head.startswith(b"BM"):
+        return "BMP"
+    if head[:4] in (b"II*\x00", b"MM\x00*"):
+        return "TIFF"
+    return None
+
+
+def sniff_video(head: bytes) -> Optional[str]:
+    """Container of a video from its first MAGIC_BYTES bytes, None if it isn't one OpenCV usually reads."""
+    if head[4:8] == b"ftyp":
+        return "MP4"  # also MOV and 3GP
+    if head.startswith(b"\x1a\x45\xdf\xa3"):
+        return "MKV"  # also WebM
+    if head[:4] == b"RIFF" and head[8:12] == b"AVI ":
+        return "AVI"
+    return None
+
+
+def _file_size(f: BinaryIO) -> Optional[int]:
+    try:
+        pos = f.tell()
+        size = f.seek(0, os.SEEK_END) - pos
+        f.seek(pos)
+        return size
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+
+def _check_upload(f: BinaryIO, max_bytes: int, size: Optional[int], sniff, kinds: str) -> Tuple[bytes, Optional[int]]:
+    """Check the size and the first bytes of an upload; returns those bytes and the size."""
+    if size is None:
+        size = _file_size(f)
+    if size is not None and size > max_bytes:
+        raise UploadTooLargeError(f"Upload is {size / 2**20:.1f} MB; the limit is {max_bytes / 2**20:.1f} MB.")
+    head = f.read(MAGIC_BYTES)
+    if sniff(head) is None:
+        raise InvalidImageError(f"Not a {kinds} file.")
+    return head, size
+
+
+def _chunks(f: BinaryIO, max_bytes: int, total: int) -> Iterator[bytes]:
+    """The rest of a stream of unknown size, stopping as soon as it goes over the limit."""
+    while True:
+        chunk = f.read(READ_CHUNK_BYTES)
+        if not chunk:
+            return
+        total += len(chunk)
+        if total > max_bytes:
+            raise UploadTooLargeError(f"Upload is over the {max_bytes / 2**20:.1f} MB limit.")
+        yield chunk
+
+
+def read_image_file(f: BinaryIO, max_bytes: int, size: Optional[int] = None) -> bytearray:
+    """
+    Read an uploaded image from `f` (from its current position) into one buffer that is
+    allocated once, at the file's size, and filled chunk by chunk.
+
+    Raises UploadTooLargeError if the file is over `max_bytes` and InvalidImageError if it
+    doesn't start like an image, both before the buffer is allocated. `size` saves a seek
+    for files whose size is already known.
+    """
+    head, size = _check_upload(f, max_bytes, size, sniff_image, "JPEG, PNG, WebP, BMP or TIFF image")
+    if size is None:
+        return bytearray(b"".join([head, *_chunks(f, max_bytes, len(head))]))
+
+    buf = bytearray(max(size, len(head)))
+    view = memoryview(buf)
+    view[:len(head)] = head
+    pos = len(head)
+    while pos < size:
+        n = f.readinto(view[pos:min(size, pos + READ_CHUNK_BYTES)])
+        if not n:
+            break
+        pos += n
+    view.release()
+    del buf[pos:]  # the file was shorter than reported
+    return buf
+
+
+def copy_video_file(f: BinaryIO, dst: BinaryIO, max_bytes: int, size: Optional[int] = None) -> int:
+    """
+    Copy an uploaded video to `dst` chunk by chunk, for a decoder that needs a file path.
+    Checked like read_image_file (against video containers), before anything is written.
+    Returns the number of bytes copied.
+    """
+    head, size = _check_upload(f, max_bytes, size, sniff_video, "MP4, MOV, WebM, MKV or AVI video")
+    dst.write(head)
+    total = len(head)
+    for chunk in _chunks(f, max_bytes, total):
+        dst.write(chunk)
+        total += len(chunk)
+    return total
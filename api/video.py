@@ -0,0 +1,117 @@
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+# Tracking runs on grayscale frames downscaled to this long side
+TRACK_SIDE = 640
+# Points tracked per box (a GRID x GRID lattice) and how many must survive
+TRACK_GRID = 10
+TRACK_MIN_POINTS = 12
+# Largest forward-backward error (tracking px) of a point that is kept
+TRACK_MAX_FB_ERROR = 1.0
+MAD_TO_STD = 1.4826
+
+
+class FrameSampler:
+    """
+    The frames of a video file at about `sample_fps`, as (time in s, BGR frame), at most
+    `max_frames` of them. Skipped frames are only grabbed, not decoded into images.
+    """
+
+    def __init__(self, path: str, sample_fps: float, max_frames: int):
+        self.path = path
+        self.sample_fps = sample_fps
+        self.max_frames = max_frames
+
+    def __iter__(self) -> Iterator[Tuple[float, np.ndarray]]:
+        cap = cv2.VideoCapture(self.path)
+        if not cap.isOpened():
+            raise ValueError("Unreadable video.")
+        try:
+            fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+            step = max(1, round(fps / self.sample_fps))
+            index = sampled = 0
+            while sampled < self.max_frames and cap.grab():
+                if index % step == 0:
+                    ok, frame = cap.retrieve()
+                    if not ok:
+                        break
+                    yield index / fps, frame
+                    sampled += 1
+                index += 1
+        finally:
+            cap.release()
+
+
+def tracking_frame(frame: np.ndarray) -> Tuple[np.ndarray, float]:
+    """Grayscale copy of `frame` for tracking, and the factor its coordinates are scaled by."""
+    scale = min(1.0, TRACK_SIDE / max(frame.shape[:2]))
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    if scale < 1.0:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return gray, scale
+
+
+def track_box(prev: np.ndarray, cur: np.ndarray, box: Sequence[float], scale: float) -> Optional[np.ndarray]:
+    """
+    Median-flow tracking of an (x1, y1, x2, y2) full-resolution box from the tracking
+    frame `prev` to `cur`: a lattice of points in the box is followed with pyramidal
+    Lucas-Kanade, points that don't track back to where they started are dropped, and
+    the box moves by the median shift and scales by the median change of the distances
+    between points. None if too few points survive, e.g. after a cut or heavy blur.
+    """
+    x1, y1, x2, y2 = np.asarray(box, dtype=np.float32) * scale
+    if x2 - x1 < 2 or y2 - y1 < 2:
+        return None
+    xs = np.linspace(x1, x2, TRACK_GRID + 2, dtype=np.float32)[1:-1]
+    ys = np.linspace(y1, y2, TRACK_GRID + 2, dtype=np.float32)[1:-1]
+    points = np.stack(np.meshgrid(xs, ys), -1).reshape(-1, 1, 2)
+
+    forward, status_f, _ = cv2.calcOpticalFlowPyrLK(prev, cur, points, None)
+    backward, status_b, _ = cv2.calcOpticalFlowPyrLK(cur, prev, forward, None)
+    fb_error = np.linalg.norm(points - backward, axis=2).ravel()
+    good = (status_f.ravel() == 1) & (status_b.ravel() == 1) & (fb_error <= TRACK_MAX_FB_ERROR)
+    if good.sum() < TRACK_MIN_POINTS:
+        return None
+    old, new = points[good, 0], forward[good, 0]
+
+    dx, dy = np.median(new - old, axis=0)
+    i, j = np.triu_indices(len(old), 1)
+    old_dist = np.linalg.norm(old[i] - old[j], axis=1)
+    new_dist = np.linalg.norm(new[i] - new[j], axis=1)
+    valid = old_dist > 1e-3
+    s = float(np.median(new_dist[valid] / old_dist[valid])) if valid.any() else 1.0
+
+    cx, cy = (x1 + x2) / 2 + dx, (y1 + y2) / 2 + dy
+    half_w, half_h = (x2 - x1) * s / 2, (y2 - y1) * s / 2
+    return np.array([cx - half_w, cy - half_h, cx + half_w, cy + half_h]) / scale
+
+
+def box_iou(a: Sequence[float], b: Sequence[float]) -> float:
+    ix = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    iy = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    inter = ix * iy
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def robust_summary(values: List[float], max_deviations: float = 3.0) -> dict:
+    """
+    Median of per-frame measurements, and mean/std of the ones within `max_deviations`
+    robust standard deviations (1.4826 x MAD) of it, so a few frames with a bad mask or
+    a lost box don't move the estimate.
+    """
+    if not values:
+        return {"median": 0.0, "mean": 0.0, "std": 0.0, "frames": 0, "outliers": 0}
+    x = np.asarray(values, dtype=np.float64)
+    median = float(np.median(x))
+    sigma = MAD_TO_STD * float(np.median(np.abs(x - median)))
+    inliers = x[np.abs(x - median) <= max_deviations * sigma] if sigma > 0 else x[x == median]
+    return {
+        "median": median,
+        "mean": float(inliers.mean()),
+        "std": float(inliers.std()),
+        "frames": int(len(x)),
+        "outliers": int(len(x) - len(inliers)),
+    }
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+
+class Readiness:
+    """Startup progress of the server: "loading" → "warming" → "ready"."""
+
+    def __init__(self):
+        self.state = "loading"
+        self.started = time.monotonic()
+        self.load_s: Dict[str, float] = {}
+        self.warmup_s: Optional[float] = None
+        self.ready_after_s: Optional[float] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    def set(self, state: str):
+        self.state = state
+        if state == "ready":
+            self.ready_after_s = time.monotonic() - self.started
+
+    def as_dict(self) -> dict:
+        return {
+            "status": self.state,
+            "model_load_s": self.load_s,
+            "warmup_s": self.warmup_s,
+            "ready_after_s": self.ready_after_s,
+        }
+
+
+def load_in_parallel(loaders: Dict[str, Callable[[], None]]) -> Dict[str, float]:
+    """
+    Run independent model loaders on one thread each and return how long each took (s).
+    Loading is mostly file I/O, unpickling and device transfers, which overlap well.
+    """
+    def timed(fn: Callable[[], None]) -> float:
+        start = time.perf_counter()
+        fn()
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(len(loaders), thread_name_prefix="load") as pool:
+        futures = {name: pool.submit(timed, fn) for name, fn in loaders.items()}
+        return {name: fut.result() for name, fut in futures.items()}
+
+
+def parse_shapes(spec: str) -> List[Tuple[int, int]]:
+    """ "4000x3000,1600x1200" → [(3000, 4000), (1200, 1600)], i.e. (H, W) from WxH."""
+    shapes = []
+    for part in spec.split(","):
+        if part.strip():
+            w, h = part.lower().split("x")
+            shapes.append((int(h), int(w)))
+    return shapes
+
+
+def _text_embedding_path(cache_dir: str, weights_path: str, classes: Sequence[str]) -> str:
+    size = os.path.getsize(weights_path) if os.path.exists(weights_path) else 0
+    key = json.dumps([os.path.basename(weights_path), size, list(classes)])
+    stem = os.path.splitext(os.path.basename(weights_path))[0]
+    return os.path.join(cache_dir, f"{stem}-{hashlib.sha256(key.encode()).hexdigest()[:16]}.pt")
+
+
+def set_classes_cached(model, classes: Sequence[str], weights_path: str, cache_dir: str) -> bool:
+    """
+    `model.set_classes(classes)` for a YOLO-World model, with the CLIP text embeddings
+    it computes kept on disk. When they are cached, CLIP is neither loaded nor run.
+    Returns whether the cache was used.
+    """
+    classes = list(classes)
+    path = _text_embedding_path(cache_dir, weights_path, classes)
+    if os.path.exists(path):
+        try:
+            txt_feats = torch.load(path, map_location="cpu")
+            # What WorldModel.set_classes / YOLOWorld.set_classes would have set
+            model.model.txt_feats = txt_feats
+            model.model.model[-1].nc = len(classes)
+            model.model.names = classes
+            return True
+        except Exception as e:
+            print(f"⚠️ Ignoring unreadable text embedding cache {path}: {e}")
+
+    model.set_classes(classes)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        torch.save(model.model.txt_feats.detach().cpu(), tmp)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"⚠️ Could not cache text embeddings to {path}: {e}")
+    return False
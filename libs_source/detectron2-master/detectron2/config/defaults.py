@@ -589,6 +589,19 @@ _C.TEST.KEYPOINT_OKS_SIGMAS = []
 # Maximum number of detections to return per image during inference (100 is
 # based on the limit established for the COCO dataset).
 _C.TEST.DETECTIONS_PER_IMAGE = 100
+# Numerical precision DefaultPredictor runs the model in. One of:
+# - "fp32": full precision.
+# - "fp16", "bf16": run the model under torch.autocast with this dtype. "fp16" needs CUDA;
+#   "bf16" runs on CPU, or on GPUs that support it. Box decoding stays in fp32.
+# - "int8": int8 dynamic quantization of the fully-connected layers (the box head and the
+#   box predictor). CPU only.
+_C.TEST.PRECISION = "fp32"
+# Where DefaultPredictor resizes the input image:
+# - "host": with PIL on the CPU; the model gets a float32 image to move to its device.
+# - "device": the uint8 image goes to MODEL.DEVICE as is (through pinned memory on CUDA)
+#   and is resized and converted to RGB/BGR there; the model normalizes and pads it on
+#   the device as always.
+_C.TEST.PREPROCESS = "host"
 
 _C.TEST.AUG = CN({"ENABLED": False})
 _C.TEST.AUG.MIN_SIZES = (400, 500, 600, 700, 800, 900, 1000, 1100, 1200)
@@ -10,15 +10,21 @@ since they are meant to represent the "common default behavior" people need in t
 """
 
 import argparse
+import contextlib
 import logging
+import numpy as np
 import os
 import sys
 import weakref
 from collections import OrderedDict
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 import torch
+import torch.nn.functional as F
 from fvcore.nn.precise_bn import get_bn_modules
 from omegaconf import OmegaConf
+from PIL import Image
+from torch import nn
 from torch.nn.parallel import DistributedDataParallel
 
 import detectron2.data.transforms as T
@@ -37,6 +43,7 @@ from detectron2.evaluation import (
 )
 from detectron2.modeling import build_model
 from detectron2.solver import build_lr_scheduler, build_optimizer
+from detectron2.structures import ROIMasks
 from detectron2.utils import comm
 from detectron2.utils.collect_env import collect_env_info
 from detectron2.utils.env import seed_all_rng
@@ -53,6 +60,7 @@ __all__ = [
     "default_setup",
     "default_writers",
     "DefaultPredictor",
+    "BatchPredictor",
     "DefaultTrainer",
 ]
 
@@ -265,6 +273,8 @@ class DefaultPredictor:
     2. Always take BGR image as the input and apply conversion defined by `cfg.INPUT.FORMAT`.
     3. Apply resizing defined by `cfg.INPUT.{MIN,MAX}_SIZE_TEST`.
     4. Take one input image and produce a single output, instead of a batch.
+    5. Run the model in the precision defined by `cfg.TEST.PRECISION`.
+    6. Resize on the host or on the model's device, as defined by `cfg.TEST.PREPROCESS`.
 
     This is meant for simple demo purposes, so it does the above steps automatically.
     This is not meant for benchmarks or running complicated inference logic.
@@ -292,12 +302,19 @@ class DefaultPredictor:
         checkpointer = DetectionCheckpointer(self.model)
         checkpointer.load(cfg.MODEL.WEIGHTS)
 
+        self.precision = cfg.TEST.PRECISION
+        self._autocast_dtype = _autocast_dtype(self.precision, cfg.MODEL.DEVICE)
+        if self.precision == "int8":
+            self.model = _quantize_dynamic_int8(self.model)
+
         self.aug = T.ResizeShortestEdge(
             [cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST
         )
 
         self.input_format = cfg.INPUT.FORMAT
         assert self.input_format in ["RGB", "BGR"], self.input_format
+        self.preprocess_on = cfg.TEST.PREPROCESS
+        assert self.preprocess_on in ["host", "device"], self.preprocess_on
 
     def __call__(self, original_image):
         """
@@ -310,17 +327,263 @@ class DefaultPredictor:
                 See :doc:`/tutorials/models` for details about the format.
         """
         with torch.no_grad():  # https://github.com/sphinx-doc/sphinx/issues/4258
-            # Apply pre-processing to image.
-            if self.input_format == "RGB":
-                # whether the model expects BGR inputs or RGB
-                original_image = original_image[:, :, ::-1]
-            height, width = original_image.shape[:2]
-            image = self.aug.get_transform(original_image).apply_image(original_image)
-            image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
-
-            inputs = {"image": image, "height": height, "width": width}
-            predictions = self.model([inputs])[0]
-            return predictions
+            inputs = self.preprocess(original_image)
+            with self.precision_context():
+                predictions = self.model([inputs])[0]
+            return self.postprocess(predictions)
+
+    def preprocess(self, original_image, transform: Optional[T.Transform] = None):
+        """
+        Args:
+            original_image (np.ndarray): an image of shape (H, W, C) (in BGR order).
+            transform (Transform): the resize to apply, instead of the test-time resize
+                defined by `cfg.INPUT.{MIN,MAX}_SIZE_TEST`.
+
+        Returns:
+            dict: the model input for the image, in the format of :doc:`/tutorials/models`.
+        """
+        if transform is None:
+            transform = self.aug.get_transform(original_image)
+        if self.preprocess_on == "device":
+            return self._preprocess_on_device(original_image, transform)
+        # Apply pre-processing to image.
+        if self.input_format == "RGB":
+            # whether the model expects BGR inputs or RGB
+            original_image = original_image[:, :, ::-1]
+        height, width = original_image.shape[:2]
+        image = transform.apply_image(original_image)
+        image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+        return {"image": image, "height": height, "width": width}
+
+    def precision_context(self):
+        """
+        Returns:
+            a context manager to call `self.model` under, so that it runs
+            in the precision given by `cfg.TEST.PRECISION`.
+        """
+        if self._autocast_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(torch.device(self.cfg.MODEL.DEVICE).type, dtype=self._autocast_dtype)
+
+    def postprocess(self, predictions):
+        """
+        Args:
+            predictions (dict): the output of `self.model` for one image.
+
+        Returns:
+            dict: the same predictions, with the outputs of a model run in fp16 or
+            bf16 (see :meth:`precision_context`) cast back to fp32.
+        """
+        return _to_fp32(predictions)
+
+    def _preprocess_on_device(self, original_image, transform: T.Transform):
+        """
+        Like `preprocess`, but with the image sent to the model's device as uint8 (a quarter
+        of the bytes of float32) and resized there. On CPU, where uint8 can be resized
+        directly, this also saves PIL's copies of the image and a full-size float32 one.
+        """
+        height, width = original_image.shape[:2]
+        device = torch.device(self.cfg.MODEL.DEVICE)
+
+        # (H, W, C) viewed as a channels-last (1, C, H, W) batch, without a copy
+        image = torch.from_numpy(np.ascontiguousarray(original_image)).permute(2, 0, 1)[None]
+        if device.type == "cuda":
+            image = image.pin_memory().to(device, non_blocking=True)
+        else:
+            image = image.to(device)
+        if isinstance(transform, T.ResizeTransform):
+            mode = _RESIZE_MODES[transform.interp]
+            if device.type != "cpu" or mode == "nearest":
+                image = image.float()  # uint8 is only resized by the CPU kernels with antialiasing
+            image = F.interpolate(
+                image,
+                size=(transform.new_h, transform.new_w),
+                mode=mode,
+                align_corners=None if mode == "nearest" else False,
+                antialias=mode != "nearest",
+            )
+            if image.is_floating_point():
+                image = image.round_().clamp_(0, 255)  # as PIL, which returns uint8
+        image = image[0].float()
+        if self.input_format == "RGB":
+            # whether the model expects BGR inputs or RGB
+            image = image.flip(0)
+        return {"image": image, "height": height, "width": width}
+
+
+_RESIZE_MODES = {Image.NEAREST: "nearest", Image.BILINEAR: "bilinear", Image.BICUBIC: "bicubic"}
+
+
+class BatchPredictor(DefaultPredictor):
+    """
+    Like :class:`DefaultPredictor`, but takes a list of images of any sizes and runs
+    them through the model in batches, so the device is not limited to one image per
+    forward pass.
+
+    Images are preprocessed in parallel threads (the resize releases the GIL), then ordered
+    by their resized size, so that images of the same shape share a batch. Each batch goes
+    through the model as one list, which pads it into a single `ImageList`. An image in a
+    batch with larger ones can get slightly different detections than when run alone,
+    since the RPN also ranks anchors over the padding.
+
+    With `batch_size=0` the batch size is chosen on the first call. On CUDA, one image of
+    the largest size the test-time resize produces is run to measure the memory an
+    image needs. The batch size is then as many such images as fit in free device
+    memory, with some margin, up to `max_batch_size`. On CPU, where batching saves
+    little, it is `min(4, max_batch_size)`. A batch that still runs out of device memory
+    is split in half and retried, and later batches keep the smaller size.
+
+    The preprocessing threads are shut down by :meth:`close`, or when the predictor is
+    garbage collected.
+
+    Examples:
+    ::
+        pred = BatchPredictor(cfg)
+        outputs = pred([cv2.imread(f) for f in files])
+        pred.close()
+    """
+
+    def __init__(self, cfg, batch_size: int = 0, max_batch_size: int = 32, num_workers: int = 4):
+        """
+        Args:
+            cfg: same as for :class:`DefaultPredictor`.
+            batch_size (int): images per forward pass; 0 to tune it to the device.
+            max_batch_size (int): upper bound of a tuned batch size.
+            num_workers (int): threads that preprocess images; 0 to do it in the caller.
+        """
+        super().__init__(cfg)
+        self.batch_size = batch_size
+        self.max_batch_size = max_batch_size
+        self._pool = ThreadPoolExecutor(num_workers) if num_workers > 0 else None
+        # The finalizer must not hold `self`, or the predictor would never be collected
+        self._finalizer = weakref.finalize(self, _shutdown_pool, self._pool)
+
+    def close(self):
+        """
+        Shut down the preprocessing threads. Later calls preprocess in the caller.
+        """
+        self._pool = None
+        self._finalizer()
+
+    def __call__(self, original_images: List):
+        """
+        Args:
+            original_images (list[np.ndarray]): images of shape (H, W, C) (in BGR order),
+                of any sizes.
+
+        Returns:
+            list[dict]: the output of the model for each image, in order.
+        """
+        if self.batch_size <= 0:
+            self.batch_size = self.tune_batch_size()
+        if self._pool is not None:
+            inputs = list(self._pool.map(self.preprocess, original_images))
+        else:
+            inputs = [self.preprocess(img) for img in original_images]
+
+        order = sorted(range(len(inputs)), key=lambda i: tuple(inputs[i]["image"].shape[1:]))
+        inputs = [inputs[i] for i in order]
+
+        outputs = []
+        with torch.no_grad():
+            while len(outputs) < len(inputs):
+                batch = inputs[len(outputs) : len(outputs) + self.batch_size]
+                try:
+                    with self.precision_context():
+                        predictions = self.model(batch)
+                except torch.cuda.OutOfMemoryError:
+                    if len(batch) == 1:
+                        raise
+                    torch.cuda.empty_cache()
+                    self.batch_size = len(batch) // 2
+                    logging.getLogger(__name__).warning(
+                        f"Out of memory with {len(batch)} images; "
+                        f"using batches of {self.batch_size}."
+                    )
+                    continue
+                outputs.extend(self.postprocess(p) for p in predictions)
+        results = [None] * len(outputs)
+        for i, output in zip(order, outputs):
+            results[i] = output
+        return results
+
+    def tune_batch_size(self) -> int:
+        """
+        Returns:
+            int: the number of images of the largest test size that fit in free device
+            memory at once, with margin, at most `max_batch_size`.
+        """
+        device = torch.device(self.cfg.MODEL.DEVICE)
+        if device.type != "cuda":
+            return min(4, self.max_batch_size)
+        height, width = self.cfg.INPUT.MIN_SIZE_TEST, self.cfg.INPUT.MAX_SIZE_TEST
+        # Noise rather than a blank image, so the heads see as many proposals as usual
+        image = torch.randint(0, 256, (3, height, width), dtype=torch.uint8).float()
+
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        before = torch.cuda.memory_allocated(device)
+        with torch.no_grad(), self.precision_context():
+            self.model([{"image": image, "height": height, "width": width}])
+        torch.cuda.synchronize(device)
+        per_image = max(torch.cuda.max_memory_allocated(device) - before, 1)
+        # Memory the caching allocator holds but doesn't use is available too
+        free = torch.cuda.mem_get_info(device)[0]
+        free += torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+        batch_size = max(1, min(self.max_batch_size, int(free * 0.8 / per_image)))
+        logging.getLogger(__name__).info(
+            f"BatchPredictor: {per_image / 2**20:.0f} MB per {height}x{width} image, "
+            f"batch size {batch_size}."
+        )
+        return batch_size
+
+
+def _autocast_dtype(precision: str, device: str) -> Optional[torch.dtype]:
+    """
+    The dtype to autocast to for `precision` on `device`, or None to run as is.
+    Raises ValueError for an unknown precision, or one the device does not support.
+    """
+    device_type = torch.device(device).type
+    if precision in ("fp32", "int8"):
+        if precision == "int8" and device_type != "cpu":
+            raise ValueError("TEST.PRECISION='int8' is only supported on CPU.")
+        return None
+    if precision == "fp16":
+        if device_type != "cuda":
+            raise ValueError("TEST.PRECISION='fp16' needs a CUDA device; use 'bf16' on CPU.")
+        return torch.float16
+    if precision == "bf16":
+        if device_type == "cuda" and not torch.cuda.is_bf16_supported():
+            raise ValueError("This GPU does not support bf16; use 'fp16'.")
+        return torch.bfloat16
+    raise ValueError(f"Unknown TEST.PRECISION '{precision}'.")
+
+
+def _quantize_dynamic_int8(model: nn.Module) -> nn.Module:
+    """
+    Quantize the weights of all `nn.Linear` layers of an eval-mode model to int8,
+    with activations quantized dynamically. Convolutions are left in fp32, since
+    dynamic quantization does not support them.
+    """
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def _shutdown_pool(pool: Optional[ThreadPoolExecutor]):
+    if pool is not None:
+        pool.shutdown()
+
+
+def _to_fp32(predictions):
+    """Cast the floating point outputs of a model run under autocast back to fp32."""
+    instances = predictions.get("instances") if isinstance(predictions, dict) else None
+    if instances is not None:
+        half = (torch.float16, torch.bfloat16)
+        for name, value in instances.get_fields().items():
+            if isinstance(value, torch.Tensor) and value.dtype in half:
+                instances.set(name, value.float())
+            elif isinstance(value, ROIMasks) and value.tensor.dtype in half:
+                instances.set(name, ROIMasks(value.tensor.float()))
+    return predictions
 
 
 class DefaultTrainer(TrainerBase):
@@ -7,12 +7,22 @@ from torch.nn import functional as F
 
 from detectron2.structures import Boxes
 
-__all__ = ["paste_masks_in_image"]
+__all__ = ["paste_masks_in_image", "paste_masks_in_rows", "mask_row_extents"]
 
 
 BYTES_PER_FLOAT = 4
-# TODO: This memory limit may be too much or too little. It would be better to
-# determine it based on available resources.
+# Memory to paste one pixel of one mask: the sampling grid (2 floats), the sampled
+# value and the binarized one
+BYTES_PER_PIXEL = 3 * BYTES_PER_FLOAT + 1
+# Share of the free memory of a CUDA device that a chunk of masks may use
+GPU_MEM_FRACTION = 0.25
+# Memory that a chunk of masks may use on CPU. Chunks save the per-call overhead of small
+# masks and are split across intra-op threads, but are slower once they outgrow the cache.
+CPU_MEM_LIMIT = 2 * 1024 ** 2
+# Masks are only pasted together while this many times their own pixels cover the
+# pixels of the chunk, which are padded to its largest window
+MAX_CHUNK_PADDING = 1.5
+# Memory limit of the GPU chunks when scripting or tracing
 GPU_MEM_LIMIT = 1024 ** 3  # 1 GB memory limit
 
 
@@ -110,6 +120,9 @@ def paste_masks_in_image(
     assert len(boxes) == N, boxes.shape
 
     img_h, img_w = image_shape
+    if not torch.jit.is_scripting() and not torch.jit.is_tracing():
+        return _paste_masks_in_windows(masks, boxes, img_h, img_w, threshold)
+    # Scripting and tracing keep the original code path
 
     # The actual implementation split the input into chunks,
     # and paste them chunk by chunk.
@@ -147,6 +160,212 @@ def paste_masks_in_image(
     return img_masks
 
 
+def paste_masks_in_rows(
+    masks: torch.Tensor,
+    boxes: Boxes,
+    rows: torch.Tensor,
+    image_width: int,
+    threshold: float = 0.5,
+):
+    """
+    Like :func:`paste_masks_in_image`, but only rasterize the given rows of the image.
+    The result is exactly those rows of the full pasted masks, in
+    O(N * len(rows) * image_width) time and memory instead of O(N * image_height * image_width).
+
+    Args:
+        masks (tensor): Tensor of shape (Bimg, Hmask, Wmask), as in :func:`paste_masks_in_image`.
+        boxes (Boxes or Tensor): A Boxes of length Bimg or Tensor of shape (Bimg, 4).
+        rows (tensor): 1D integer tensor of image rows, in any order.
+        image_width (int): width of the image.
+        threshold (float): as in :func:`paste_masks_in_image`.
+
+    Returns:
+        Tensor: of shape (Bimg, len(rows), image_width). Same dtype as
+        :func:`paste_masks_in_image`.
+    """
+    assert masks.shape[-1] == masks.shape[-2], "Only square mask predictions are supported"
+    if not isinstance(boxes, torch.Tensor):
+        boxes = boxes.tensor
+    N, R = len(masks), len(rows)
+    device = boxes.device
+    assert len(boxes) == N, boxes.shape
+    out = torch.zeros(
+        N, R, image_width, device=device, dtype=torch.bool if threshold >= 0 else torch.uint8
+    )
+    if N == 0 or R == 0:
+        return out
+
+    # Only the columns covered by some box can be non-zero, as with skip_empty
+    x0_int = int(torch.clamp(boxes[:, 0].min().floor() - 1, min=0))
+    x1_int = int(torch.clamp(boxes[:, 2].max().ceil() + 1, max=image_width))
+    if x1_int <= x0_int:
+        return out
+    x0, y0, x1, y1 = torch.split(boxes, 1, dim=1)  # each is Nx1
+    # Same sample locations as _do_paste_mask
+    img_y = rows.to(device=device, dtype=torch.float32) + 0.5
+    img_x = torch.arange(x0_int, x1_int, device=device, dtype=torch.float32) + 0.5
+    img_y = (img_y - y0) / (y1 - y0) * 2 - 1
+    img_x = (img_x - x0) / (x1 - x0) * 2 - 1
+    gx = img_x[:, None, :].expand(N, R, img_x.size(1))
+    gy = img_y[:, :, None].expand(N, R, img_x.size(1))
+    grid = torch.stack([gx, gy], dim=3)
+
+    if not masks.dtype.is_floating_point:
+        masks = masks.float()
+    sampled = F.grid_sample(masks[:, None], grid.to(masks.dtype), align_corners=False)[:, 0]
+    if threshold >= 0:
+        out[:, :, x0_int:x1_int] = sampled >= threshold
+    else:
+        out[:, :, x0_int:x1_int] = (sampled * 255).to(dtype=torch.uint8)
+    return out
+
+
+def mask_row_extents(
+    masks: torch.Tensor,
+    boxes: Boxes,
+    rows: torch.Tensor,
+    image_width: int,
+    threshold: float = 0.5,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    The leftmost and rightmost columns of the given rows that :func:`paste_masks_in_image`
+    would set, computed from the masks without rasterizing them.
+
+    Along an image row, the pasted mask is a piecewise linear function of x: the mask is
+    first interpolated between its two rows around the row, then between neighbouring
+    cells (with zeros outside the mask). So on each linear piece, the columns at or above
+    `threshold` are solved for directly. This takes O(N * len(rows) * Wmask) time.
+    Where a sample lands within float rounding of the threshold, the result may differ
+    from the rasterized masks by one column.
+
+    Args:
+        masks, boxes, rows, image_width: as in :func:`paste_masks_in_rows`.
+        threshold (float): in (0, 1].
+
+    Returns:
+        (Tensor, Tensor): int64 tensors of shape (Bimg, len(rows)), the first and last
+        column of each row that belongs to the mask, or -1 for both in rows without any.
+    """
+    assert masks.shape[-1] == masks.shape[-2], "Only square mask predictions are supported"
+    assert 0 < threshold <= 1, threshold
+    if not isinstance(boxes, torch.Tensor):
+        boxes = boxes.tensor
+    N, R, M = len(masks), len(rows), masks.shape[-1]
+    device = boxes.device
+    assert len(boxes) == N, boxes.shape
+    if N == 0 or R == 0:
+        empty = torch.full((N, R), -1, dtype=torch.int64, device=device)
+        return empty, empty.clone()
+
+    boxes = boxes.double()
+    x0, y0, x1, y1 = torch.split(boxes, 1, dim=1)  # each is Nx1
+    # Zero-padded masks, so that samples up to one cell outside fade to 0 as in grid_sample
+    padded = F.pad(masks.to(device=device, dtype=torch.float64), (1, 1, 1, 1))
+
+    # Vertical interpolation: the row's profile over the M + 2 padded columns
+    v = (rows.to(device=device, dtype=torch.float64)[None] + 0.5 - y0) / (y1 - y0) * M - 0.5
+    top = v.floor()
+    wy = (v - top)[:, :, None]
+    top = top.long() + 1  # index in the padded mask
+    i0 = top.clamp(0, M + 1)
+    i1 = (top + 1).clamp(0, M + 1)
+    n = torch.arange(N, device=device)[:, None]
+    profile = padded[n, i0] * (1 - wy) + padded[n, i1] * wy  # (N, R, M + 2)
+
+    # Columns [lo, hi] (in mask cells) of each linear piece where the profile >= threshold
+    a, b = profile[:, :, :-1], profile[:, :, 1:]
+    k = torch.arange(-1, M, device=device, dtype=torch.float64)
+    valid = (a >= threshold) | (b >= threshold)
+    delta = torch.where(a == b, torch.ones_like(a), b - a)
+    lo = torch.where(a >= threshold, k, k + (threshold - a) / delta)
+    hi = torch.where(b >= threshold, k + 1, k + (threshold - a) / delta)
+
+    # Mask cells to image columns, whose centers are at x + 0.5
+    scale = (x1 - x0)[:, :, None] / M
+    left = torch.ceil((lo + 0.5) * scale + x0[:, :, None] - 0.5)
+    right = torch.floor((hi + 0.5) * scale + x0[:, :, None] - 0.5)
+    left = left.clamp(min=0)
+    right = right.clamp(max=image_width - 1)
+    valid &= left <= right
+
+    big = float(image_width)
+    left = torch.where(valid, left, torch.full_like(left, big)).amin(dim=2)
+    right = torch.where(valid, right, torch.full_like(right, -1.0)).amax(dim=2)
+    found = right >= 0
+    missing = torch.full_like(left, -1.0)
+    return torch.where(found, left, missing).long(), torch.where(found, right, missing).long()
+
+
+def _paste_memory_budget(device: torch.device) -> int:
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        return int(free * GPU_MEM_FRACTION)
+    return CPU_MEM_LIMIT
+
+
+@torch.jit.unused
+def _paste_masks_in_windows(masks, boxes, img_h: int, img_w: int, threshold: float):
+    """
+    :func:`paste_masks_in_image` in chunks of masks that are sampled together, each in its
+    own window: the pixels of its box and a one pixel border, outside of which it is 0
+    (as with skip_empty). Masks are sorted by window size, and a chunk is as large as the
+    memory budget of the device (:func:`_paste_memory_budget`) and MAX_CHUNK_PADDING allow.
+    Samples are taken at the same locations and in the same precision as
+    :func:`_do_paste_mask`, so the result is the same as pasting the masks one by one.
+    """
+    N = len(masks)
+    device = boxes.device
+    img_masks = torch.zeros(
+        N, img_h, img_w, device=device, dtype=torch.bool if threshold >= 0 else torch.uint8
+    )
+    x0_int = torch.clamp(boxes[:, 0].floor() - 1, min=0).long()
+    y0_int = torch.clamp(boxes[:, 1].floor() - 1, min=0).long()
+    x1_int = torch.clamp(boxes[:, 2].ceil() + 1, max=img_w).long()
+    y1_int = torch.clamp(boxes[:, 3].ceil() + 1, max=img_h).long()
+    windows = torch.stack([x0_int, y0_int, x1_int - x0_int, y1_int - y0_int], dim=1)
+    windows = windows.clamp(min=0).tolist()  # one sync, instead of one per mask
+
+    order = sorted(range(N), key=lambda i: windows[i][2] * windows[i][3], reverse=True)
+    budget = _paste_memory_budget(device) // BYTES_PER_PIXEL
+    chunks, chunk = [], []
+    max_h = max_w = area = 0
+    for i in order:
+        x0, y0, w, h = windows[i]
+        if w == 0 or h == 0:
+            continue
+        new_h, new_w = max(max_h, h), max(max_w, w)
+        padded = (len(chunk) + 1) * new_h * new_w
+        if chunk and (padded > budget or padded > MAX_CHUNK_PADDING * (area + w * h)):
+            chunks.append((chunk, max_h, max_w))
+            chunk, new_h, new_w, area = [], h, w, 0
+        chunk.append(i)
+        max_h, max_w, area = new_h, new_w, area + w * h
+    if chunk:
+        chunks.append((chunk, max_h, max_w))
+
+    if not masks.dtype.is_floating_point:
+        masks = masks.float()
+    for chunk, h, w in chunks:
+        inds = torch.as_tensor(chunk, device=device)
+        x0, y0, x1, y1 = torch.split(boxes[inds], 1, dim=1)  # each is Nx1
+        img_y = (y0_int[inds, None] + torch.arange(h, device=device)).to(torch.float32) + 0.5
+        img_x = (x0_int[inds, None] + torch.arange(w, device=device)).to(torch.float32) + 0.5
+        img_y = (img_y - y0) / (y1 - y0) * 2 - 1
+        img_x = (img_x - x0) / (x1 - x0) * 2 - 1
+        gx = img_x[:, None, :].expand(len(chunk), h, w)
+        gy = img_y[:, :, None].expand(len(chunk), h, w)
+        grid = torch.stack([gx, gy], dim=3)
+        pasted = F.grid_sample(masks[inds, None], grid.to(masks.dtype), align_corners=False)[:, 0]
+        if threshold >= 0:
+            pasted = pasted >= threshold
+        else:
+            pasted = (pasted * 255).to(dtype=torch.uint8)
+        for k, i in enumerate(chunk):
+            x0, y0, w_i, h_i = windows[i]
+            img_masks[i, y0 : y0 + h_i, x0 : x0 + w_i] = pasted[k, :h_i, :w_i]
+    return img_masks
+
+
 # The below are the original paste function (from Detectron1) which has
 # larger quantization error.
 # It is faster on CPU, while the aligned one is faster on GPU thanks to grid_sample.
@@ -7,7 +7,11 @@ from detectron2.structures import Instances, ROIMasks
 
 # perhaps should rename to "resize_instance"
 def detector_postprocess(
-    results: Instances, output_height: int, output_width: int, mask_threshold: float = 0.5
+    results: Instances,
+    output_height: int,
+    output_width: int,
+    mask_threshold: float = 0.5,
+    paste_masks: bool = True,
 ):
     """
     Resize the output instances.
@@ -23,6 +27,9 @@ def detector_postprocess(
             `results.image_size` contains the input image resolution the detector sees.
             This object might be modified in-place.
         output_height, output_width: the desired output resolution.
+        mask_threshold (float): threshold of the pasted masks.
+        paste_masks (bool): if False, `pred_masks` is returned as :class:`ROIMasks` in the
+            output resolution of the boxes, to be pasted (or partly rasterized) by the caller.
 
     Returns:
         Instances: the resized output from the model, based on the output resolution
@@ -64,9 +71,12 @@ def detector_postprocess(
         else:
             # pred_masks is a tensor of shape (N, 1, M, M)
             roi_masks = ROIMasks(results.pred_masks[:, 0, :, :])
-        results.pred_masks = roi_masks.to_bitmasks(
-            results.pred_boxes, output_height, output_width, mask_threshold
-        ).tensor  # TODO return ROIMasks/BitMask object in the future
+        if paste_masks:
+            results.pred_masks = roi_masks.to_bitmasks(
+                results.pred_boxes, output_height, output_width, mask_threshold
+            ).tensor  # TODO return ROIMasks/BitMask object in the future
+        else:
+            results.pred_masks = roi_masks
 
     if results.has("pred_keypoints"):
         results.pred_keypoints[:, :, 0] *= scale_x
@@ -2,7 +2,7 @@
 import copy
 import itertools
 import numpy as np
-from typing import Any, Iterator, List, Union
+from typing import Any, Iterator, List, Tuple, Union
 import pycocotools.mask as mask_util
 import torch
 from torch import device
@@ -461,6 +461,10 @@ class ROIMasks:
     Represent masks by N smaller masks defined in some ROIs. Once ROI boxes are given,
     full-image bitmask can be obtained by "pasting" the mask on the region defined
     by the corresponding ROI box.
+
+    When only part of the masks is needed, index the instances first (e.g. `masks[:1]`
+    with `boxes[:1]`), and use :meth:`to_bitmask_rows` or :meth:`row_extents` instead of
+    pasting all of every mask.
     """
 
     def __init__(self, tensor: torch.Tensor):
@@ -525,3 +529,37 @@ class ROIMasks:
             threshold=threshold,
         )
         return BitMasks(bitmasks)
+
+    @torch.jit.unused
+    def to_bitmask_rows(self, boxes: torch.Tensor, rows: torch.Tensor, width, threshold=0.5):
+        """
+        Args:
+            boxes: the ROI boxes, as in :meth:`to_bitmasks`.
+            rows (Tensor): 1D integer tensor of image rows.
+            width (int): image width.
+            threshold (float): binarization threshold.
+
+        Returns:
+            Tensor: (N, len(rows), width), the given rows of the bitmasks that
+            :meth:`to_bitmasks` would return.
+        """
+        from detectron2.layers import paste_masks_in_rows
+
+        return paste_masks_in_rows(self.tensor, boxes, rows, width, threshold=threshold)
+
+    @torch.jit.unused
+    def row_extents(
+        self, boxes: torch.Tensor, rows: torch.Tensor, width, threshold=0.5
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            boxes, rows, width, threshold: as in :meth:`to_bitmask_rows`.
+
+        Returns:
+            (Tensor, Tensor): (N, len(rows)) first and last foreground column of each row
+            of the pasted masks (-1 in rows without foreground), computed without pasting.
+            See :func:`detectron2.layers.mask_row_extents`.
+        """
+        from detectron2.layers import mask_row_extents
+
+        return mask_row_extents(self.tensor, boxes, rows, width, threshold=threshold)
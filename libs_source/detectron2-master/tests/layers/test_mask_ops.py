@@ -2,10 +2,12 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
 
 import contextlib
+import copy
 import io
 import numpy as np
 import unittest
 from collections import defaultdict
+from unittest import mock
 import torch
 import tqdm
 from fvcore.common.benchmark import benchmark
@@ -15,12 +17,17 @@ from torch.nn import functional as F
 
 from detectron2.data import MetadataCatalog
 from detectron2.layers.mask_ops import (
+    BYTES_PER_PIXEL,
+    _do_paste_mask,
+    mask_row_extents,
     pad_masks,
     paste_mask_in_image_old,
     paste_masks_in_image,
+    paste_masks_in_rows,
     scale_boxes,
 )
-from detectron2.structures import BitMasks, Boxes, BoxMode, PolygonMasks
+from detectron2.modeling.postprocessing import detector_postprocess
+from detectron2.structures import BitMasks, Boxes, BoxMode, Instances, PolygonMasks, ROIMasks
 from detectron2.structures.masks import polygons_to_bitmask
 from detectron2.utils.file_io import PathManager
 from detectron2.utils.testing import random_boxes
@@ -165,34 +172,130 @@ class TestMaskCropPaste(unittest.TestCase):
         self.assertTrue(torch.equal(out, scripted_out))
 
 
+class TestPasteChunks(unittest.TestCase):
+    def test_matches_one_by_one(self):
+        torch.manual_seed(0)
+        N = 40
+        masks = torch.rand(N, 28, 28)
+        boxes = random_boxes(N, 250)
+        boxes[:5, 2:] += 100  # partly outside the image
+        ref = _paste_one_by_one(masks, boxes, (300, 320))
+        self.assertTrue(torch.equal(paste_masks_in_image(masks, boxes, (300, 320)), ref))
+        # Chunks of a few masks each
+        with mock.patch("detectron2.layers.mask_ops.CPU_MEM_LIMIT", 50000 * BYTES_PER_PIXEL):
+            self.assertTrue(torch.equal(paste_masks_in_image(masks, boxes, (300, 320)), ref))
+
+
+class TestPasteRows(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        N = 16
+        # Smooth blobs, so rows have several foreground runs and soft edges
+        masks = F.avg_pool2d(torch.rand(N, 1, 28, 28), 5, 1, 2)[:, 0]
+        self.masks = ((masks - 0.5) * 6 + 0.5).clamp(0, 1)
+        boxes = random_boxes(N, 300)
+        boxes[:, 1::2] *= 0.6
+        self.boxes = Boxes(boxes)
+        self.image_shape = (200, 320)
+        self.full = paste_masks_in_image(self.masks, self.boxes, self.image_shape)
+
+    def test_rows_match_full_paste(self):
+        rows = torch.tensor([0, 7, 100, 42, 199])
+        out = paste_masks_in_rows(self.masks, self.boxes, rows, self.image_shape[1])
+        self.assertTrue(torch.equal(out, self.full[:, rows]))
+        out = paste_masks_in_rows(self.masks, self.boxes, rows, self.image_shape[1], threshold=-1)
+        full = paste_masks_in_image(self.masks, self.boxes, self.image_shape, threshold=-1)
+        self.assertTrue(torch.equal(out, full[:, rows]))
+
+    def test_row_extents(self):
+        rows = torch.arange(self.image_shape[0])
+        left, right = mask_row_extents(self.masks, self.boxes, rows, self.image_shape[1])
+        full = self.full.to(torch.uint8)
+        present = self.full.any(dim=2)
+        ref_left = torch.where(present, full.argmax(dim=2), -1)
+        ref_right = torch.where(present, full.shape[2] - 1 - full.flip(2).argmax(dim=2), -1)
+        self.assertTrue(torch.equal(left >= 0, present))
+        self.assertLessEqual((left - ref_left).abs().max().item(), 1)
+        self.assertLessEqual((right - ref_right).abs().max().item(), 1)
+        self.assertGreater((left == ref_left).float().mean().item(), 0.99)
+
+    def test_empty(self):
+        rows = torch.arange(3)
+        left, right = mask_row_extents(self.masks[:0], self.boxes[:0], rows, 10)
+        self.assertEqual(left.shape, (0, 3))
+        self.assertEqual(
+            paste_masks_in_rows(self.masks, self.boxes, rows[:0], 10).shape, (16, 0, 10)
+        )
+
+    def test_postprocess_without_pasting(self):
+        results = Instances((100, 160))
+        results.pred_boxes = Boxes(self.boxes.tensor / 2)
+        results.pred_masks = self.masks[:, None]
+        results.scores = torch.rand(len(self.masks))
+        lazy = detector_postprocess(copy.deepcopy(results), 200, 320, paste_masks=False)
+        pasted = detector_postprocess(results, 200, 320)
+        self.assertIsInstance(lazy.pred_masks, ROIMasks)
+        rows = torch.tensor([10, 50])
+        out = lazy.pred_masks[:2].to_bitmask_rows(lazy.pred_boxes[:2], rows, 320)
+        self.assertTrue(torch.equal(out, pasted.pred_masks[:2][:, rows]))
+
+
+def _paste_one_by_one(masks, boxes, image_shape):
+    # What paste_masks_in_image did on CPU: one mask at a time, in its own region
+    img_masks = torch.zeros((len(masks),) + image_shape, dtype=torch.bool, device=masks.device)
+    for i in range(len(masks)):
+        mask, region = _do_paste_mask(masks[i : i + 1, None], boxes[i : i + 1], *image_shape)
+        img_masks[(i,) + region] = mask[0] >= 0.5
+    return img_masks
+
+
+def _paste_all_at_once(masks, boxes, image_shape):
+    # What paste_masks_in_image did on GPU (in 1 GB chunks): all masks over the whole image
+    mask, _ = _do_paste_mask(masks[:, None], boxes, *image_shape, skip_empty=False)
+    return mask >= 0.5
+
+
 def benchmark_paste():
-    S = 800
-    H, W = image_shape = (S, S)
-    N = 64
-    torch.manual_seed(42)
-    masks = torch.rand(N, 28, 28)
-
-    center = torch.rand(N, 2) * 600 + 100
-    wh = torch.clamp(torch.randn(N, 2) * 40 + 200, min=50)
-    x0y0 = torch.clamp(center - wh * 0.5, min=0.0)
-    x1y1 = torch.clamp(center + wh * 0.5, max=S)
-    boxes = Boxes(torch.cat([x0y0, x1y1], axis=1))
-
-    def func(device, n=3):
-        m = masks.to(device=device)
-        b = boxes.to(device=device)
+    """
+    Time paste_masks_in_image against pasting one mask at a time and all masks at once over
+    the whole image, for several numbers of masks and image sizes, on CPU (and CUDA).
+    """
+    methods = {
+        "adaptive": paste_masks_in_image,
+        "one_by_one": _paste_one_by_one,
+        "all_at_once": _paste_all_at_once,
+    }
+
+    def func(device, method, n, size):
+        torch.manual_seed(42)
+        S = size
+        masks = torch.rand(n, 28, 28, device=device)
+        center = torch.rand(n, 2) * S * 0.8 + S * 0.1
+        wh = torch.clamp(torch.randn(n, 2) * S / 20 + S / 4, min=S / 16)
+        x0y0 = torch.clamp(center - wh * 0.5, min=0.0)
+        x1y1 = torch.clamp(center + wh * 0.5, max=S)
+        boxes = torch.cat([x0y0, x1y1], axis=1).to(device)
+        paste = methods[method]
 
         def bench():
-            for _ in range(n):
-                paste_masks_in_image(m, b, image_shape)
+            paste(masks, boxes, (S, S))
             if device.type == "cuda":
                 torch.cuda.synchronize()
 
         return bench
 
-    specs = [{"device": torch.device("cpu"), "n": 3}]
+    devices = [torch.device("cpu")]
     if torch.cuda.is_available():
-        specs.append({"device": torch.device("cuda"), "n": 3})
+        devices.append(torch.device("cuda"))
+    specs = []
+    for device in devices:
+        for size in [512, 1333]:
+            for n in [1, 16, 100]:
+                for method in methods:
+                    nbytes = n * size * size * BYTES_PER_PIXEL
+                    if method == "all_at_once" and nbytes > 2 * 1024 ** 3:
+                        continue
+                    specs.append({"device": device, "method": method, "n": n, "size": size})
 
     benchmark(func, "paste_masks", specs, num_iters=10, warmup_iters=2)
 
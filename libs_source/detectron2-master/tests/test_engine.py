@@ -1,6 +1,8 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
 
+import gc
 import json
+import numpy as np
 import os
 import tempfile
 import time
@@ -10,10 +12,19 @@ import torch
 from fvcore.common.checkpoint import Checkpointer
 from torch import nn
 
+import detectron2.data.transforms as T
 from detectron2 import model_zoo
 from detectron2.config import configurable, get_cfg
-from detectron2.engine import DefaultTrainer, SimpleTrainer, default_setup, hooks
+from detectron2.engine import (
+    BatchPredictor,
+    DefaultPredictor,
+    DefaultTrainer,
+    SimpleTrainer,
+    default_setup,
+    hooks,
+)
 from detectron2.modeling.meta_arch import META_ARCH_REGISTRY
+from detectron2.structures import Boxes, Instances, ROIMasks
 from detectron2.utils.events import CommonMetricPrinter, JSONWriter
 
 
@@ -35,6 +46,32 @@ class _SimpleModel(nn.Module):
         return {"loss": x.sum() + sum([x.mean() for x in self.parameters()])}
 
 
+@META_ARCH_REGISTRY.register()
+class _LinearDetector(nn.Module):
+    """Scores the mean color of each image with a linear layer; records the dtype it saw."""
+
+    @configurable
+    def __init__(self):
+        super().__init__()
+        self.mod = nn.Linear(3, 1)
+        self.score_dtype = None
+
+    @classmethod
+    def from_config(cls, cfg):
+        return {}
+
+    def forward(self, batched_inputs):
+        outputs = []
+        for x in batched_inputs:
+            score = self.mod(x["image"].mean(dim=(1, 2))[None] / 255.0)[:, 0]
+            self.score_dtype = score.dtype
+            inst = Instances((x["height"], x["width"]))
+            inst.pred_boxes = Boxes(torch.tensor([[0.0, 0.0, x["width"], x["height"]]]))
+            inst.scores = score
+            outputs.append({"instances": inst})
+        return outputs
+
+
 class TestTrainer(unittest.TestCase):
     def _data_loader(self, device):
         device = torch.device(device)
@@ -158,3 +195,135 @@ class TestTrainer(unittest.TestCase):
             cfg = model_zoo.get_config("COCO-InstanceSegmentation/mask_rcnn_R_50_FPN_1x.py")
             cfg.train.output_dir = os.path.join(d, "omegaconf")
             default_setup(cfg, {})
+
+
+class TestDefaultPredictor(unittest.TestCase):
+    def _predictor(self, precision):
+        cfg = get_cfg()
+        cfg.MODEL.META_ARCHITECTURE = "_LinearDetector"
+        cfg.MODEL.DEVICE = "cpu"
+        cfg.MODEL.WEIGHTS = ""
+        cfg.TEST.PRECISION = precision
+        torch.manual_seed(0)
+        return DefaultPredictor(cfg)
+
+    def test_bf16(self):
+        image = np.random.RandomState(0).randint(0, 255, (20, 30, 3), dtype=np.uint8)
+        ref = self._predictor("fp32")(image)["instances"]
+        pred = self._predictor("bf16")
+        out = pred(image)["instances"]
+        self.assertEqual(pred.model.score_dtype, torch.bfloat16)
+        # outputs are cast back, so callers see the same dtypes as in fp32
+        self.assertEqual(out.scores.dtype, torch.float32)
+        self.assertTrue(torch.allclose(out.scores, ref.scores, atol=1e-2))
+
+    def test_int8(self):
+        image = np.random.RandomState(0).randint(0, 255, (20, 30, 3), dtype=np.uint8)
+        ref = self._predictor("fp32")(image)["instances"]
+        pred = self._predictor("int8")
+        self.assertIsInstance(pred.model.mod, torch.ao.nn.quantized.dynamic.Linear)
+        out = pred(image)["instances"]
+        self.assertTrue(torch.allclose(out.scores, ref.scores, atol=5e-2))
+
+    def test_unsupported_precision(self):
+        with self.assertRaises(ValueError):
+            self._predictor("fp16")  # needs CUDA
+        with self.assertRaises(ValueError):
+            self._predictor("fp8")
+
+    def test_preprocess_on_device(self):
+        pred = self._predictor("fp32")
+        rng = np.random.RandomState(0)
+        for shape in [(20, 30, 3), (1200, 1700, 3)]:  # upscaled, downscaled
+            image = rng.randint(0, 255, shape, dtype=np.uint8)
+            for input_format in ["BGR", "RGB"]:
+                pred.input_format = input_format
+                pred.preprocess_on = "host"
+                ref = pred.preprocess(image)
+                pred.preprocess_on = "device"
+                out = pred.preprocess(image)
+                self.assertEqual(out["image"].shape, ref["image"].shape)
+                self.assertEqual((out["height"], out["width"]), shape[:2])
+                # same filters as PIL, up to rounding
+                self.assertLessEqual((out["image"] - ref["image"]).abs().max().item(), 1)
+
+    def test_preprocess_with_transform(self):
+        pred = self._predictor("fp32")
+        image = np.random.RandomState(0).randint(0, 255, (20, 30, 3), dtype=np.uint8)
+        transform = T.ResizeTransform(20, 30, 32, 48)
+        for preprocess_on in ["host", "device"]:
+            pred.preprocess_on = preprocess_on
+            out = pred.preprocess(image, transform)
+            self.assertEqual(tuple(out["image"].shape), (3, 32, 48))
+            self.assertEqual((out["height"], out["width"]), (20, 30))
+
+    def test_postprocess_casts_roi_masks(self):
+        instances = Instances((20, 30))
+        instances.scores = torch.ones(2, dtype=torch.bfloat16)
+        instances.pred_masks = ROIMasks(torch.ones(2, 28, 28, dtype=torch.bfloat16))
+        out = self._predictor("bf16").postprocess({"instances": instances})["instances"]
+        self.assertEqual(out.scores.dtype, torch.float32)
+        self.assertEqual(out.pred_masks.tensor.dtype, torch.float32)
+
+
+class TestBatchPredictor(unittest.TestCase):
+    def _cfg(self):
+        cfg = get_cfg()
+        cfg.MODEL.META_ARCHITECTURE = "_LinearDetector"
+        cfg.MODEL.DEVICE = "cpu"
+        cfg.MODEL.WEIGHTS = ""
+        return cfg
+
+    def _images(self):
+        rng = np.random.RandomState(0)
+        sizes = [(20, 30), (40, 25), (33, 33), (15, 60), (50, 20)]
+        return [rng.randint(0, 255, (h, w, 3), dtype=np.uint8) for h, w in sizes]
+
+    def test_matches_default_predictor(self):
+        torch.manual_seed(0)
+        single = DefaultPredictor(self._cfg())
+        torch.manual_seed(0)
+        batched = BatchPredictor(self._cfg(), batch_size=2)
+        images = self._images()
+        with mock.patch.object(batched.model, "forward", wraps=batched.model.forward) as forward:
+            outputs = batched(images)
+        self.assertEqual([len(c.args[0]) for c in forward.call_args_list], [2, 2, 1])
+        self.assertEqual(len(outputs), len(images))
+        for img, out in zip(images, outputs):
+            ref = single(img)["instances"]
+            self.assertEqual(out["instances"].image_size, img.shape[:2])
+            self.assertTrue(torch.allclose(out["instances"].scores, ref.scores))
+
+    def test_tuned_batch_size_on_cpu(self):
+        pred = BatchPredictor(self._cfg(), max_batch_size=3, num_workers=0)
+        self.assertEqual(len(pred(self._images())), 5)
+        self.assertEqual(pred.batch_size, 3)
+
+    def test_out_of_memory_halves_batch(self):
+        pred = BatchPredictor(self._cfg(), batch_size=4)
+        forward = pred.model.forward
+
+        def limited(batch):
+            if len(batch) > 2:
+                raise torch.cuda.OutOfMemoryError("out of memory")
+            return forward(batch)
+
+        with mock.patch.object(pred.model, "forward", side_effect=limited):
+            outputs = pred(self._images())
+        self.assertEqual(pred.batch_size, 2)
+        self.assertEqual(
+            [o["instances"].image_size for o in outputs], [i.shape[:2] for i in self._images()]
+        )
+
+    def test_close_shuts_down_pool(self):
+        pred = BatchPredictor(self._cfg(), batch_size=2)
+        pool = pred._pool
+        pred.close()
+        self.assertTrue(pool._shutdown)
+        self.assertEqual(len(pred(self._images())), 5)
+
+        pred = BatchPredictor(self._cfg(), batch_size=2)
+        pool = pred._pool
+        del pred
+        gc.collect()
+        self.assertTrue(pool._shutdown)
@@ -0,0 +1,478 @@
+"""
+Load test of the analysis API: replays a corpus of images against /predict and reports
+throughput, latency percentiles (end to end and per server-side step), errors and peak
+memory as JSON, optionally compared with the report of an earlier commit.
+
+The app is started on a free port with stub models (fixed latencies, no weights needed;
+thread inference pool only) or the real ones, with the detection cache disabled so
+repeated images are analyzed every time. --url benchmarks a server that is already
+running instead, --in-process runs the app in this process without uvicorn.
+
+Load is either closed-loop (--concurrency clients, each sending its next request when
+the last one returned) or open-loop (--rate requests/s arriving on a Poisson or uniform
+schedule whatever the server does; latency counts from the scheduled arrival, so
+queueing is not hidden).
+
+    python scripts/bench_api.py --models stub --concurrency 8 --requests 200 --output bench.json
+    python scripts/bench_api.py --models real --images data/photos --rate 4 --duration 60 \\
+        --compare bench_main.json
+"""
+import argparse
+import asyncio
+import contextlib
+import glob
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+import cv2
+import httpx
+import numpy as np
+import torch
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+PERCENTILES = (50, 95, 99)
+# Report fields compared by --compare, and whether a higher value is better
+COMPARED = {
+    ("summary", "throughput_rps"): True,
+    ("summary", "latency_ms", "p50"): False,
+    ("summary", "latency_ms", "p95"): False,
+    ("summary", "latency_ms", "p99"): False,
+    ("memory", "server_peak_mb"): False,
+}
+
+
+# --- STUB MODELS ---
+class _StubBox:
+    def __init__(self, xyxy, conf):
+        self.xyxy = torch.tensor([xyxy], dtype=torch.float32)
+        self.conf = torch.tensor([conf])
+
+
+class StubYOLO:
+    """Stands in for an Ultralytics model: one fixed box per image after a batch latency."""
+
+    def __init__(self, box: tuple, ms: float, ms_per_image: float):
+        self.box = box
+        self.ms = ms
+        self.ms_per_image = ms_per_image
+
+    def __call__(self, images, **kwargs):
+        images = images if isinstance(images, list) else [images]
+        time.sleep((self.ms + self.ms_per_image * len(images)) / 1000.0)
+        out = []
+        for img in images:
+            h, w = img.shape[:2]
+            x1, y1, x2, y2 = self.box
+            out.append(SimpleNamespace(boxes=[_StubBox([x1 * w, y1 * h, x2 * w, y2 * h], 0.9)]))
+        return out
+
+    predict = __call__
+
+
+class StubMaskRCNN(torch.nn.Module):
+    """Stands in for PercepTree's model: a trunk over the middle fifth of every crop."""
+
+    def __init__(self, ms: float, ms_per_image: float):
+        super().__init__()
+        self.ms = ms
+        self.ms_per_image = ms_per_image
+
+    def forward(self, inputs):
+        return self.inference(inputs)
+
+    def inference(self, inputs, do_postprocess=True):
+        from detectron2.modeling.postprocessing import detector_postprocess
+        from detectron2.structures import Boxes, Instances
+
+        time.sleep((self.ms + self.ms_per_image * len(inputs)) / 1000.0)
+        results = []
+        for x in inputs:
+            # Raw outputs are at the input resolution, with 28x28 masks
+            h, w = x["image"].shape[-2:]
+            instances = Instances((h, w))
+            instances.pred_boxes = Boxes(torch.tensor([[w * 0.4, 0, w * 0.6, h]], dtype=torch.float32))
+            instances.scores = torch.tensor([0.9])
+            instances.pred_classes = torch.tensor([0])
+            instances.pred_masks = torch.ones((1, 1, 28, 28))
+            results.append(instances)
+        if not do_postprocess:
+            return results
+        return [{"instances": detector_postprocess(r, x["height"], x["width"])} for r, x in zip(results, inputs)]
+
+
+class StubPredictor:
+    def __init__(self, ms: float, ms_per_image: float):
+        from detectron2.data import transforms as T
+
+        self.model = StubMaskRCNN(ms, ms_per_image)
+        self.aug = T.ResizeShortestEdge([800, 800], 1333)
+        self.input_format = "BGR"
+
+    def preprocess(self, original_image, transform=None):
+        if transform is None:
+            transform = self.aug.get_transform(original_image)
+        height, width = original_image.shape[:2]
+        image = torch.as_tensor(transform.apply_image(original_image).astype("float32").transpose(2, 0, 1))
+        return {"image": image, "height": height, "width": width}
+
+    def postprocess(self, predictions):
+        return predictions
+
+
+def parse_latencies(spec: str) -> Dict[str, tuple]:
+    """ "person=10+2,tree=20+5,trunk=40+10" → {"person": (10.0, 2.0), ...}: ms per batch + ms per image."""
+    out = {}
+    for part in spec.split(","):
+        name, value = part.split("=")
+        base, _, per_image = value.partition("+")
+        out[name.strip()] = (float(base), float(per_image or 0))
+    return out
+
+
+def install_stub_models(main, latencies: Dict[str, tuple]):
+    """Make api.main load the stub models instead of the real ones."""
+    if main.INFERENCE_ENGINE == "batch" and main.INFERENCE_POOL == "process":
+        sys.exit("Stub models only work with the thread inference pool (PERCEPTREE_INFERENCE_POOL=thread).")
+
+    def load_models(shared=None):
+        main.models["yolo_person"] = StubYOLO((0.05, 0.5, 0.15, 0.95), *latencies["person"])
+        main.models["yolo_tree"] = StubYOLO((0.4, 0.1, 0.6, 0.95), *latencies["tree"])
+        main.models["perceptree"] = StubPredictor(*latencies["trunk"])
+
+    main.load_models = load_models
+
+
+# --- SERVER ---
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve(args):
+    """Entry point of the server subprocess."""
+    import uvicorn
+
+    import api.main as main
+
+    if args.models == "stub":
+        install_stub_models(main, parse_latencies(args.stub_latency))
+    uvicorn.run(main.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+def start_server(args) -> subprocess.Popen:
+    env = dict(os.environ)
+    if not args.cache:
+        env["PERCEPTREE_CACHE_MAX_ENTRIES"] = "0"
+    cmd = [
+        sys.executable, os.path.abspath(__file__), "--serve", "--port", str(args.port),
+        "--models", args.models, "--stub-latency", args.stub_latency,
+    ]
+    return subprocess.Popen(cmd, cwd=ROOT, env=env)
+
+
+async def wait_ready(client: httpx.AsyncClient, timeout_s: float, server: Optional[subprocess.Popen] = None):
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        if server is not None and server.poll() is not None:
+            sys.exit(f"Server exited with code {server.returncode} during startup.")
+        try:
+            if (await client.get("/ready")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.5)
+    sys.exit(f"Server not ready after {timeout_s:g}s.")
+
+
+# --- CORPUS ---
+def load_corpus(args) -> List[bytes]:
+    if args.images:
+        files = sorted(
+            f for f in glob.glob(os.path.join(args.images, "**", "*"), recursive=True)
+            if f.lower().endswith((".jpg", ".jpeg", ".png", ".webp", ".bmp"))
+        )
+        if not files:
+            sys.exit(f"No images found in {args.images}")
+        corpus = []
+        for f in files:
+            with open(f, "rb") as fh:
+                corpus.append(fh.read())
+        return corpus
+    # Smooth noise compresses like a photo rather than like white noise
+    w, h = (int(n) for n in args.synthetic_size.lower().split("x"))
+    rng = np.random.default_rng(args.seed)
+    corpus = []
+    for _ in range(args.synthetic):
+        small = rng.integers(0, 256, (max(1, h // 16), max(1, w // 16), 3), dtype=np.uint8)
+        img = cv2.resize(small, (w, h), interpolation=cv2.INTER_CUBIC)
+        img = cv2.add(img, rng.integers(0, 24, img.shape, dtype=np.uint8))
+        corpus.append(cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes())
+    return corpus
+
+
+# --- LOAD ---
+class Recorder:
+    def __init__(self):
+        self.samples: List[dict] = []
+
+    async def send(self, client: httpx.AsyncClient, img: bytes, args, scheduled: Optional[float] = None):
+        start = time.perf_counter()
+        sample = {"start": start}
+        try:
+            r = await client.post(
+                "/predict", params={"debug": "true"},
+                files={"file": ("image.jpg", img)}, data={"person_height": str(args.person_height)},
+            )
+            sample["status"] = r.status_code
+            if r.status_code == 200:
+                sample["stages_ms"] = r.json().get("timings_ms", {})
+        except httpx.HTTPError as e:
+            sample["status"] = type(e).__name__
+        end = time.perf_counter()
+        sample["latency_ms"] = (end - (scheduled if scheduled is not None else start)) * 1000.0
+        sample["end"] = end
+        self.samples.append(sample)
+
+
+def should_stop(args, sent: int, t0: float) -> bool:
+    if args.duration:
+        return time.perf_counter() - t0 >= args.duration
+    return sent >= args.requests
+
+
+async def closed_loop(client: httpx.AsyncClient, corpus: List[bytes], args, rec: Recorder):
+    sent = 0
+    t0 = time.perf_counter()
+
+    async def user():
+        nonlocal sent
+        while not should_stop(args, sent, t0):
+            img = corpus[sent % len(corpus)]
+            sent += 1
+            await rec.send(client, img, args)
+
+    await asyncio.gather(*(user() for _ in range(args.concurrency)))
+
+
+async def open_loop(client: httpx.AsyncClient, corpus: List[bytes], args, rec: Recorder):
+    rng = random.Random(args.seed)
+    tasks = []
+    t0 = time.perf_counter()
+    next_at = t0
+    while not should_stop(args, len(tasks), t0):
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        img = corpus[len(tasks) % len(corpus)]
+        tasks.append(asyncio.create_task(rec.send(client, img, args, scheduled=next_at)))
+        next_at += rng.expovariate(args.rate) if args.arrival == "poisson" else 1.0 / args.rate
+    await asyncio.gather(*tasks)
+
+
+# --- REPORT ---
+def distribution(values: List[float]) -> dict:
+    if not values:
+        return {}
+    out = {f"p{p}": float(np.percentile(values, p)) for p in PERCENTILES}
+    out.update(mean=float(np.mean(values)), max=float(np.max(values)))
+    return {k: round(v, 2) for k, v in out.items()}
+
+
+async def server_peak_mb(client: httpx.AsyncClient) -> Dict[str, float]:
+    """Peak memory per device from the server's /metrics."""
+    peaks = {}
+    try:
+        text = (await client.get("/metrics")).text
+    except httpx.HTTPError:
+        return peaks
+    for line in text.splitlines():
+        if line.startswith("perceptree_memory_high_water_bytes{"):
+            device = line.split('device="', 1)[1].split('"', 1)[0]
+            peaks[device] = round(float(line.rsplit(" ", 1)[1]) / 2**20, 1)
+    return peaks
+
+
+def git_info() -> dict:
+    def git(*cmd):
+        try:
+            return subprocess.run(["git", *cmd], cwd=ROOT, capture_output=True, text=True, timeout=30).stdout.strip()
+        except Exception:
+            return ""
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def build_report(args, rec: Recorder, memory: Dict[str, float], corpus: List[bytes]) -> dict:
+    samples = rec.samples
+    ok = [s for s in samples if s["status"] == 200]
+    errors: Dict[str, int] = {}
+    for s in samples:
+        if s["status"] != 200:
+            errors[str(s["status"])] = errors.get(str(s["status"]), 0) + 1
+    wall = (max(s["end"] for s in samples) - min(s["start"] for s in samples)) if samples else 0.0
+    stages = sorted({name for s in ok for name in s.get("stages_ms", {})})
+    options = {k: v for k, v in vars(args).items() if k not in ("serve", "compare", "output")}
+    return {
+        "meta": {
+            **git_info(),
+            "created": time.time(),
+            "host": platform.node(),
+            "cpus": os.cpu_count(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "options": options,
+            "env": {k: v for k, v in os.environ.items() if k.startswith("PERCEPTREE_")},
+            "corpus": {"images": len(corpus), "mean_kb": round(float(np.mean([len(c) for c in corpus])) / 1024, 1)},
+        },
+        "summary": {
+            "requests": len(samples),
+            "ok": len(ok),
+            "errors": errors,
+            "duration_s": round(wall, 3),
+            "throughput_rps": round(len(ok) / wall, 3) if wall > 0 else 0.0,
+            "latency_ms": distribution([s["latency_ms"] for s in ok]),
+        },
+        "stages_ms": {
+            name: distribution([s["stages_ms"][name] for s in ok if name in s.get("stages_ms", {})])
+            for name in stages
+        },
+        "memory": {"server_peak_mb": max(memory.values(), default=0.0), "server_peak_mb_by_device": memory},
+    }
+
+
+def compare(report: dict, baseline: dict, max_regression: float) -> bool:
+    """Print the compared fields side by side; False if any is worse than `max_regression` (relative)."""
+    passed = True
+    load_keys = ("models", "stub_latency", "concurrency", "rate", "arrival", "requests", "duration", "images")
+    old_load = {k: baseline.get("meta", {}).get("options", {}).get(k) for k in load_keys}
+    new_load = {k: report["meta"]["options"].get(k) for k in load_keys}
+    if old_load != new_load:
+        diff = {k: (old_load[k], new_load[k]) for k in load_keys if old_load[k] != new_load[k]}
+        print(f"\n⚠️ The baseline ran a different load: {diff}")
+    print(f"\n{'metric':28} {'baseline':>10} {'now':>10} {'change':>8}")
+    for path, higher_is_better in COMPARED.items():
+        old, new = baseline, report
+        for key in path:
+            old, new = (old or {}).get(key), (new or {}).get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        flag = "❌" if worse > max_regression else ""
+        passed &= not flag
+        print(f"{'.'.join(path[1:]) or path[0]:28} {old:10.2f} {new:10.2f} {change:+7.1%} {flag}")
+    return passed
+
+
+def print_report(report: dict):
+    s = report["summary"]
+    print(f"\n{s['ok']}/{s['requests']} ok in {s['duration_s']:.1f}s: {s['throughput_rps']:.2f} req/s"
+          + (f", errors {s['errors']}" if s["errors"] else ""))
+    print(f"{'step':12} {'p50':>9} {'p95':>9} {'p99':>9} {'mean':>9}  (ms)")
+    for name, d in [("end-to-end", s["latency_ms"]), *report["stages_ms"].items()]:
+        if d:
+            print(f"{name:12} {d['p50']:9.1f} {d['p95']:9.1f} {d['p99']:9.1f} {d['mean']:9.1f}")
+    print(f"Peak server memory: {report['memory']['server_peak_mb_by_device']} MB")
+
+
+async def run(args):
+    corpus = load_corpus(args)
+    server = app = None
+    if args.url:
+        base_url = args.url.rstrip("/")
+        transport = None
+    elif args.in_process:
+        if not args.cache:
+            os.environ["PERCEPTREE_CACHE_MAX_ENTRIES"] = "0"
+        import api.main as main
+
+        if args.models == "stub":
+            install_stub_models(main, parse_latencies(args.stub_latency))
+        app = main.app
+        base_url, transport = "http://bench", httpx.ASGITransport(app=app)
+    else:
+        args.port = args.port or free_port()
+        server = start_server(args)
+        base_url, transport = f"http://127.0.0.1:{args.port}", None
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    rec = Recorder()
+    try:
+        lifespan = app.router.lifespan_context(app) if app is not None else contextlib.nullcontext()
+        async with lifespan, httpx.AsyncClient(
+            base_url=base_url, transport=transport, timeout=args.timeout, limits=limits
+        ) as client:
+            await wait_ready(client, args.startup_timeout, server)
+            warmup = Recorder()
+            for i in range(args.warmup):
+                await warmup.send(client, corpus[i % len(corpus)], args)
+            print(f"{len(corpus)} images, {args.warmup} warm-up requests, "
+                  + (f"open loop at {args.rate:g}/s ({args.arrival})" if args.rate else f"closed loop x{args.concurrency}"))
+            if args.rate:
+                await open_loop(client, corpus, args, rec)
+            else:
+                await closed_loop(client, corpus, args, rec)
+            memory = await server_peak_mb(client)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+    return build_report(args, rec, memory, corpus)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", choices=["stub", "real"], default="stub")
+    parser.add_argument("--stub-latency", default="person=15+3,tree=25+5,trunk=40+10",
+                        help="stub model latencies, ms per batch + ms per image")
+    parser.add_argument("--url", help="benchmark this running server instead of starting one")
+    parser.add_argument("--in-process", action="store_true", help="run the app in this process, without uvicorn")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--cache", action="store_true", help="keep the server's detection cache enabled")
+    parser.add_argument("--images", help="directory of images to replay (default: synthetic ones)")
+    parser.add_argument("--synthetic", type=int, default=8, help="number of synthetic images")
+    parser.add_argument("--synthetic-size", default="4000x3000", help="WxH of the synthetic images")
+    parser.add_argument("--person-height", type=float, default=170.0)
+    parser.add_argument("--concurrency", type=int, default=8, help="closed loop: concurrent clients")
+    parser.add_argument("--rate", type=float, default=0.0, help="open loop: arrivals per second (0: closed loop)")
+    parser.add_argument("--arrival", choices=["poisson", "uniform"], default="poisson")
+    parser.add_argument("--requests", type=int, default=200, help="requests to send (without --duration)")
+    parser.add_argument("--duration", type=float, default=0.0, help="send for this many seconds instead")
+    parser.add_argument("--warmup", type=int, default=4, help="sequential requests before measuring")
+    parser.add_argument("--timeout", type=float, default=300.0, help="per-request timeout (s)")
+    parser.add_argument("--startup-timeout", type=float, default=600.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--compare", help="JSON report of an earlier run to compare with")
+    parser.add_argument("--max-regression", type=float, default=0.10,
+                        help="fail on a throughput, latency or memory regression larger than this fraction")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(report, baseline, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
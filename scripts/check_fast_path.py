@@ -0,0 +1,114 @@
+"""
+Accuracy check for the PercepTree top-1 fast path (PERCEPTREE_DETECTIONS / PERCEPTREE_PROPOSALS).
+
+Runs the trunk model with the model zoo budgets (1000 proposals, 100 detections) and with
+one detection and each candidate proposal cap over a held-out set of trunk crops, and
+checks that the top instance is unchanged:
+  - the same crops have an instance,
+  - IoU of its box and of its mask,
+  - relative error of the trunk width the DBH is computed from (as check_precision.py),
+  - mean latency per crop.
+
+Exits with 1 if a cap is outside the tolerances, and prints the smallest one that passes.
+
+    python scripts/check_fast_path.py --images data/heldout_crops --proposals 0,300,100,50
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from detectron2.engine import DefaultPredictor  # noqa: E402
+from detectron2.structures import pairwise_iou  # noqa: E402
+
+from api.main import PERCEPTREE_MODEL_WEIGHTS, perceptree_cfg  # noqa: E402
+from check_precision import load_images, mask_iou, run, width_error  # noqa: E402
+
+# Budgets of the model zoo config, i.e. before the fast path
+FULL_DETECTIONS = 100
+
+
+def build(args, proposals: int, detections: int = 1) -> DefaultPredictor:
+    cfg = perceptree_cfg(args.device, detections=detections, proposals=proposals)
+    cfg.MODEL.WEIGHTS = args.weights
+    return DefaultPredictor(cfg)
+
+
+def box_iou(a, b) -> float:
+    if len(a) == 0 or len(b) == 0:
+        return float(len(a) == len(b))
+    return pairwise_iou(a.pred_boxes[0], b.pred_boxes[0]).item()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", required=True, help="directory of held-out trunk crops")
+    parser.add_argument("--proposals", default="0,300,100,50", help="proposal caps to check (0: no cap)")
+    parser.add_argument("--weights", default=PERCEPTREE_MODEL_WEIGHTS)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--min-box-iou", type=float, default=0.99, help="lowest acceptable top-1 box IoU of any crop")
+    parser.add_argument("--min-iou", type=float, default=0.99, help="lowest acceptable mean top-1 mask IoU")
+    parser.add_argument("--max-width-error", type=float, default=0.005, help="highest acceptable mean relative width error")
+    parser.add_argument("--output", help="also write the report to this JSON file")
+    args = parser.parse_args()
+
+    images = load_images(args.images)
+    if not images:
+        sys.exit(f"No images found in {args.images}")
+    print(f"{len(images)} crops, device {args.device}")
+
+    reference, ref_s = run(build(args, 0, FULL_DETECTIONS), images)
+    report = {"images": len(images), "device": args.device, "reference": {"latency_s": ref_s}, "proposals": {}}
+
+    caps = {int(p) for p in args.proposals.split(",") if p.strip()}
+    for proposals in sorted(caps, key=lambda p: p or float("inf"), reverse=True):  # 0: no cap, first
+        outputs, seconds = run(build(args, proposals), images)
+        box_ious = [box_iou(r, o) for r, o in zip(reference, outputs)]
+        ious = [mask_iou(r, o) for r, o in zip(reference, outputs)]
+        errors = [width_error(r, o, img.shape[0]) for r, o, (_, img) in zip(reference, outputs, images)]
+        result = {
+            "latency_s": seconds,
+            "speedup": ref_s / seconds,
+            "found_mismatches": sum((len(r) == 0) != (len(o) == 0) for r, o in zip(reference, outputs)),
+            "box_iou_min": float(np.min(box_ious)),
+            "mask_iou_mean": float(np.mean(ious)),
+            "mask_iou_min": float(np.min(ious)),
+            "width_error_mean": float(np.mean(errors)),
+            "width_error_max": float(np.max(errors)),
+        }
+        result["passed"] = (
+            result["found_mismatches"] == 0
+            and result["box_iou_min"] >= args.min_box_iou
+            and result["mask_iou_mean"] >= args.min_iou
+            and result["width_error_mean"] <= args.max_width_error
+        )
+        report["proposals"][proposals] = result
+
+    print(f"{'proposals':>9} {'latency':>9} {'speedup':>8} {'box IoU min':>12} {'IoU mean':>9} {'width err':>10}  ok")
+    print(f"{'reference':>9} {ref_s:8.3f}s {1.0:7.2f}x")
+    for proposals, r in report["proposals"].items():
+        print(
+            f"{proposals or 'no cap':>9} {r['latency_s']:8.3f}s {r['speedup']:7.2f}x {r['box_iou_min']:12.4f} "
+            f"{r['mask_iou_mean']:9.4f} {r['width_error_mean']:9.2%}  {'✅' if r['passed'] else '❌'}"
+        )
+
+    passing = [p for p, r in report["proposals"].items() if r["passed"]]
+    if passing:
+        # 0 (no cap) is the largest budget
+        smallest = min(passing, key=lambda p: p or float("inf"))
+        report["smallest_passing"] = smallest
+        print(f"Smallest proposal cap within tolerance: {smallest or 'none'} (set PERCEPTREE_PROPOSALS={smallest})")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if len(passing) < len(report["proposals"]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
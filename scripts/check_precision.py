@@ -0,0 +1,145 @@
+"""
+Accuracy regression check for the PercepTree precision modes (TEST.PRECISION).
+
+Runs the trunk model in fp32 and in each candidate mode over a held-out set of trunk
+crops (images like the ones the API hands to PercepTree), and compares every mode
+with fp32:
+  - mask IoU of the top instance,
+  - relative error of the trunk width the DBH is computed from, sampled at rows
+    10%..90% down the crop,
+  - mean latency per crop.
+
+Exits with 1 if a mode is outside the tolerances, and prints the fastest one that passes.
+
+    python scripts/check_precision.py --images data/heldout_crops --modes bf16,int8
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from detectron2.engine import DefaultPredictor  # noqa: E402
+
+from api.main import PERCEPTREE_MODEL_WEIGHTS, perceptree_cfg  # noqa: E402
+from api.measure import TrunkProfile  # noqa: E402
+
+ROW_FRACTIONS = np.linspace(0.1, 0.9, 9)
+
+
+def load_images(path: str) -> list:
+    files = sorted(
+        f for f in glob.glob(os.path.join(path, "**", "*"), recursive=True)
+        if f.lower().endswith((".jpg", ".jpeg", ".png", ".bmp"))
+    )
+    images = [(f, cv2.imread(f)) for f in files]
+    return [(f, img) for f, img in images if img is not None]
+
+
+def build(args, precision: str) -> DefaultPredictor:
+    cfg = perceptree_cfg(args.device, precision)
+    cfg.MODEL.WEIGHTS = args.weights
+    return DefaultPredictor(cfg)
+
+
+def run(predictor: DefaultPredictor, images: list) -> tuple:
+    outputs, seconds = [], []
+    for _, img in images:
+        start = time.perf_counter()
+        instances = predictor(img)["instances"].to("cpu")
+        seconds.append(time.perf_counter() - start)
+        outputs.append(instances)
+    return outputs, float(np.mean(seconds))
+
+
+def mask_iou(a, b) -> float:
+    if len(a) == 0 or len(b) == 0:
+        return float(len(a) == len(b))
+    ma, mb = a.pred_masks[0], b.pred_masks[0]
+    union = (ma | mb).sum().item()
+    return (ma & mb).sum().item() / union if union else 1.0
+
+
+def width_error(a, b, height: int) -> float:
+    """Mean relative difference of the measured trunk width (mask, else box) over the sample rows."""
+    if len(a) == 0 or len(b) == 0:
+        return 0.0 if len(a) == len(b) else 1.0
+    rows = (ROW_FRACTIONS * (height - 1)).astype(int)
+    pa, pb = TrunkProfile.from_instances(a), TrunkProfile.from_instances(b)
+    errors = []
+    for wa, wb in zip(pa.widths_at(rows), pb.widths_at(rows)):
+        wa = pa.box_width if wa is None else wa
+        wb = pb.box_width if wb is None else wb
+        errors.append(abs(wb - wa) / max(wa, 1.0))
+    return float(np.mean(errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", required=True, help="directory of held-out trunk crops")
+    parser.add_argument("--modes", default="bf16,int8", help="precisions to compare with fp32")
+    parser.add_argument("--weights", default=PERCEPTREE_MODEL_WEIGHTS)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--min-iou", type=float, default=0.95, help="lowest acceptable mean mask IoU")
+    parser.add_argument("--max-width-error", type=float, default=0.02, help="highest acceptable mean relative width error")
+    parser.add_argument("--output", help="also write the report to this JSON file")
+    args = parser.parse_args()
+
+    images = load_images(args.images)
+    if not images:
+        sys.exit(f"No images found in {args.images}")
+    print(f"{len(images)} crops, device {args.device}")
+
+    reference, ref_s = run(build(args, "fp32"), images)
+    report = {"images": len(images), "device": args.device, "modes": {"fp32": {"latency_s": ref_s}}}
+
+    for mode in [m.strip() for m in args.modes.split(",") if m.strip()]:
+        try:
+            predictor = build(args, mode)
+        except ValueError as e:
+            print(f"{mode}: skipped ({e})")
+            continue
+        outputs, seconds = run(predictor, images)
+        ious = [mask_iou(r, o) for r, o in zip(reference, outputs)]
+        errors = [width_error(r, o, img.shape[0]) for r, o, (_, img) in zip(reference, outputs, images)]
+        result = {
+            "latency_s": seconds,
+            "speedup": ref_s / seconds,
+            "mask_iou_mean": float(np.mean(ious)),
+            "mask_iou_min": float(np.min(ious)),
+            "width_error_mean": float(np.mean(errors)),
+            "width_error_max": float(np.max(errors)),
+        }
+        result["passed"] = result["mask_iou_mean"] >= args.min_iou and result["width_error_mean"] <= args.max_width_error
+        report["modes"][mode] = result
+
+    print(f"{'mode':6} {'latency':>9} {'speedup':>8} {'IoU mean':>9} {'IoU min':>8} {'width err':>10}  ok")
+    for mode, r in report["modes"].items():
+        if mode == "fp32":
+            print(f"{mode:6} {r['latency_s']:8.3f}s {1.0:7.2f}x")
+            continue
+        print(
+            f"{mode:6} {r['latency_s']:8.3f}s {r['speedup']:7.2f}x {r['mask_iou_mean']:9.4f} "
+            f"{r['mask_iou_min']:8.4f} {r['width_error_mean']:9.2%}  {'✅' if r['passed'] else '❌'}"
+        )
+
+    passing = [m for m, r in report["modes"].items() if r.get("passed", m == "fp32")]
+    fastest = min(passing, key=lambda m: report["modes"][m]["latency_s"])
+    report["fastest_passing"] = fastest
+    print(f"Fastest mode within tolerance: {fastest} (set PERCEPTREE_PRECISION={fastest})")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if any(not r.get("passed", True) for r in report["modes"].values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
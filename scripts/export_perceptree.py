@@ -0,0 +1,172 @@
+"""
+Export the PercepTree trunk model to a TorchScript and/or ONNX artifact for serving
+(PERCEPTREE_BACKEND=torchscript|onnxruntime), and check it against the eager model.
+
+The artifact takes one preprocessed CHW float image of any size and returns the
+Instances at that size, flattened (boxes, classes, 28x28 mask probabilities, scores,
+image size). The serving side rebuilds them from the outputs schema saved in
+export.json, rescales them to the crop and pastes the masks.
+
+Every held-out crop (or, without --images, a few random ones) is then run through the
+eager model and through each artifact; the export fails if detections differ.
+
+    python scripts/export_perceptree.py --formats torchscript,onnx --images data/heldout_crops
+"""
+import argparse
+import inspect
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from detectron2.config.instantiate import dump_dataclass  # noqa: E402
+from detectron2.engine import DefaultPredictor  # noqa: E402
+from detectron2.export import TracingAdapter  # noqa: E402
+
+from api.exported import ARTIFACT_FILES, METADATA_FILE, ExportedPredictor  # noqa: E402
+from api.main import PERCEPTREE_MODEL_WEIGHTS, perceptree_cfg  # noqa: E402
+from check_precision import load_images, mask_iou  # noqa: E402
+
+BACKENDS = {"torchscript": "torchscript", "onnx": "onnxruntime"}
+# The TorchScript-based exporter. `dynamo` only exists from torch 2.5 (older releases, such
+# as the 2.2 of api/requirements.txt, always use this exporter) and defaults to True from 2.9
+ONNX_EXPORT_KWARGS = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+
+
+def build(args, device: str) -> DefaultPredictor:
+    cfg = perceptree_cfg(device)
+    cfg.MODEL.WEIGHTS = args.weights
+    return DefaultPredictor(cfg)
+
+
+def sample_input(predictor: DefaultPredictor, image: np.ndarray) -> torch.Tensor:
+    if predictor.input_format == "RGB":
+        image = image[:, :, ::-1]
+    image = predictor.aug.get_transform(image).apply_image(image)
+    return torch.as_tensor(image.astype("float32").transpose(2, 0, 1)).to(predictor.cfg.MODEL.DEVICE)
+
+
+def inference(model, inputs):
+    # Up to the fixed-size mask logits; pasting depends on the output size and stays in Python
+    return [{"instances": model.inference(inputs, do_postprocess=False)[0]}]
+
+
+def export(predictor: DefaultPredictor, fmt: str, image: torch.Tensor, path: str) -> TracingAdapter:
+    adapter = TracingAdapter(predictor.model, [{"image": image}], inference)
+    with torch.no_grad():
+        if fmt == "torchscript":
+            torch.jit.trace(adapter, (image,)).save(path)
+        else:
+            torch.onnx.export(
+                adapter, (image,), path, opset_version=16,
+                input_names=["image"], dynamic_axes={"image": {1: "height", 2: "width"}}, **ONNX_EXPORT_KWARGS,
+            )
+    predictor.model.eval()  # the ONNX exporter leaves the model in training mode
+    return adapter
+
+
+def compare(reference, outputs) -> dict:
+    counts_match = [len(r) == len(o) for r, o in zip(reference, outputs)]
+    box_errors = [
+        (r.pred_boxes.tensor.cpu() - o.pred_boxes.tensor.cpu()).abs().max().item()
+        for r, o in zip(reference, outputs) if len(r) and len(r) == len(o)
+    ]
+    score_errors = [
+        (r.scores.cpu() - o.scores.cpu()).abs().max().item()
+        for r, o in zip(reference, outputs) if len(r) and len(r) == len(o)
+    ]
+    ious = [mask_iou(r.to("cpu"), o.to("cpu")) for r, o in zip(reference, outputs)]
+    return {
+        "count_mismatches": counts_match.count(False),
+        "box_error_max_px": max(box_errors, default=0.0),
+        "score_error_max": max(score_errors, default=0.0),
+        "mask_iou_min": float(np.min(ious)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--formats", default="torchscript,onnx", help="artifacts to write: torchscript, onnx")
+    parser.add_argument("--output", default="output/perceptree_export", help="directory for the artifacts")
+    parser.add_argument("--weights", default=PERCEPTREE_MODEL_WEIGHTS)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu",
+                        help="device the TorchScript artifact is traced for (ONNX is always exported on CPU)")
+    parser.add_argument("--images", help="directory of held-out trunk crops to validate on")
+    parser.add_argument("--max-box-error", type=float, default=1.0, help="largest acceptable box difference (px)")
+    parser.add_argument("--min-iou", type=float, default=0.98, help="lowest acceptable top-instance mask IoU")
+    args = parser.parse_args()
+
+    formats = [f.strip() for f in args.formats.split(",") if f.strip()]
+    for fmt in formats:
+        if fmt not in ARTIFACT_FILES:
+            sys.exit(f"Unknown format {fmt!r}; expected one of {', '.join(ARTIFACT_FILES)}")
+    if args.images:
+        images = [img for _, img in load_images(args.images)]
+        if not images:
+            sys.exit(f"No images found in {args.images}")
+    else:
+        rng = np.random.default_rng(0)
+        images = [rng.integers(0, 256, (h, w, 3), dtype=np.uint8) for h, w in [(900, 300), (640, 480), (1200, 500)]]
+    os.makedirs(args.output, exist_ok=True)
+
+    metadata = {"formats": [], "weights": args.weights, "torch": torch.__version__, "created": time.time()}
+    report, failed = {}, False
+    for fmt in formats:
+        device = args.device if fmt == "torchscript" else "cpu"
+        predictor = build(args, device)
+        path = os.path.join(args.output, ARTIFACT_FILES[fmt])
+        start = time.perf_counter()
+        adapter = export(predictor, fmt, sample_input(predictor, images[0]), path)
+        print(f"{fmt}: wrote {path} in {time.perf_counter() - start:.1f}s")
+
+        cfg = predictor.cfg
+        metadata.update(
+            input_format=predictor.input_format,
+            min_size_test=cfg.INPUT.MIN_SIZE_TEST,
+            max_size_test=cfg.INPUT.MAX_SIZE_TEST,
+            outputs_schema=dump_dataclass(adapter.outputs_schema),
+        )
+        metadata["formats"].append(fmt)
+        metadata.setdefault("devices", {})[fmt] = device
+        with open(os.path.join(args.output, METADATA_FILE), "w") as f:
+            json.dump(metadata, f, indent=2)
+
+        exported = ExportedPredictor(args.output, BACKENDS[fmt], device)
+        reference, outputs, eager_s, exported_s = [], [], 0.0, 0.0
+        for img in images:
+            start = time.perf_counter()
+            reference.append(predictor(img)["instances"])
+            eager_s += time.perf_counter() - start
+            start = time.perf_counter()
+            outputs.append(exported(img)["instances"])
+            exported_s += time.perf_counter() - start
+        result = compare(reference, outputs)
+        result.update(eager_latency_s=eager_s / len(images), latency_s=exported_s / len(images))
+        result["passed"] = (
+            result["count_mismatches"] == 0
+            and result["box_error_max_px"] <= args.max_box_error
+            and result["mask_iou_min"] >= args.min_iou
+        )
+        failed |= not result["passed"]
+        report[fmt] = result
+        print(
+            f"{fmt}: {len(images)} images, {result['count_mismatches']} count mismatches, "
+            f"box error {result['box_error_max_px']:.3f}px, min mask IoU {result['mask_iou_min']:.4f}, "
+            f"{result['latency_s']:.3f}s vs eager {result['eager_latency_s']:.3f}s  "
+            f"{'✅' if result['passed'] else '❌'}"
+        )
+
+    metadata["validation"] = report
+    with open(os.path.join(args.output, METADATA_FILE), "w") as f:
+        json.dump(metadata, f, indent=2)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()